@@ -0,0 +1,88 @@
+#────────────────────────────── ❑ ──────────────────────────────
+# Микро-бенчмарк поиска слов благодарности: старый contains_thank_word против ThankMatcher
+# Запуск из корня репозитория: python benchmarks/thank_matcher.py
+#────────────────────────────── ❑ ──────────────────────────────
+import os
+import sys
+import random
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)  # rating.py читает token.txt, lang.txt и translations.json из текущей папки
+
+import rating
+
+MESSAGES = 20000
+REPEAT = 5
+
+PLAIN_MESSAGES = [
+    "Кто-нибудь знает, как настроить роутер?",
+    "Привет всем! Сегодня созвон в 19:00",
+    "Я думаю, что проблема в драйвере видеокарты",
+    "Попробуй перезагрузить и очистить кэш браузера",
+    "Ссылку на документацию скинул выше",
+    "Нет, это не поможет, там другая ошибка в логах",
+    "ok, gonna check it later",
+    "Можешь прислать скрин настроек?",
+    "Спорный вопрос, надо смотреть конфиг",
+    "Пойду проверю, отпишусь позже",
+]
+THANK_MESSAGES = [
+    "Спасибо, заработало!",
+    "спс, помогло",
+    "От души, брат",
+    "Благодарю за подробный ответ",
+    "thanks a lot",
+    "Спасиииибо огромное!!!",
+    "мерси",
+    "пасиб, гляну",
+]
+
+def legacy_contains_thank_word(text):
+    """Исходная реализация: отдельный поиск подстроки для каждого слова"""
+    if not text:
+        return False
+
+    text_lower = text.lower()
+    for word in rating.THANK_WORDS:
+        if word.lower() in text_lower:
+            return True
+    return False
+
+def build_corpus(size, seed=42):
+    """Ответы в чате: в основном обычные сообщения, примерно каждое пятое - благодарность"""
+    rnd = random.Random(seed)
+    corpus = []
+    for _ in range(size):
+        if rnd.random() < 0.2:
+            text = rnd.choice(THANK_MESSAGES)
+        else:
+            # Склеиваем 1-4 фразы, чтобы получить сообщения разной длины
+            text = " ".join(rnd.choice(PLAIN_MESSAGES) for _ in range(rnd.randint(1, 4)))
+        corpus.append(text)
+    return corpus
+
+def bench(name, func, corpus):
+    timer = timeit.Timer(lambda: [func(text) for text in corpus])
+    best = min(timer.repeat(repeat=REPEAT, number=1))
+    per_message_ns = best / len(corpus) * 1e9
+    print(f"{name:<32} {best * 1000:8.2f} мс  {per_message_ns:8.0f} нс/сообщение")
+    return best
+
+if __name__ == '__main__':
+    corpus = build_corpus(MESSAGES)
+    substring_matcher = rating.ThankMatcher(rating.THANK_WORDS, word_boundary=False)
+    boundary_matcher = rating.ThankMatcher(rating.THANK_WORDS, word_boundary=True)
+
+    print(f"\nКорпус: {len(corpus)} сообщений, лучшее из {REPEAT} прогонов\n")
+    legacy = bench("contains_thank_word (старый)", legacy_contains_thank_word, corpus)
+    compiled = bench("ThankMatcher (подстрока)", substring_matcher.matches, corpus)
+    bench("ThankMatcher (целые слова)", boundary_matcher.matches, corpus)
+    print(f"\nУскорение: x{legacy / compiled:.1f}")
+
+    # Расхождения со старой реализацией (ожидаются только из-за нормализации: ё, повторы букв)
+    diff = [text for text in corpus if legacy_contains_thank_word(text) != substring_matcher.matches(text)]
+    print(f"Расхождений со старой реализацией: {len(diff)}")
+    for text in sorted(set(diff))[:5]:
+        print(f"   {text!r}")
@@ -0,0 +1,95 @@
+#────────────────────────────── ❑ ──────────────────────────────
+# Нагрузочная проверка очереди благодарностей: тысячи одновременных благодарностей
+# в нескольких чатах, ни одна не должна потеряться
+# Запуск из корня репозитория: python benchmarks/thank_stress.py [благодарностей] [чатов] [пользователей]
+#────────────────────────────── ❑ ──────────────────────────────
+import os
+import sys
+import time
+import random
+import shutil
+import asyncio
+import tempfile
+from collections import Counter
+
+ROOT = os.path.dirname(os.path.abspath(os.path.dirname(__file__)))
+sys.path.insert(0, ROOT)
+
+# Данные пишутся во временную папку, чтобы не трогать рабочие файлы бота
+WORK_DIR = tempfile.mkdtemp(prefix="rating_stress_")
+for name in ("translations.json", "token.txt", "lang.txt"):
+    shutil.copy(os.path.join(ROOT, name), WORK_DIR)
+os.chdir(WORK_DIR)
+
+import rating
+
+THANKS = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+CHATS = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+USERS = int(sys.argv[3]) if len(sys.argv) > 3 else 30
+API_LATENCY = 0.002  # секунд на один вызов API
+
+message_ids = iter(range(1, 10 ** 9))
+api_calls = Counter()
+max_actors = 0
+
+async def fake_request(self, method, data=None, files=None, **kwargs):
+    """Заглушка Bot API: без сети и без ограничения частоты"""
+    global max_actors
+    api_calls[method] += 1
+    max_actors = max(max_actors, len(rating.chat_actors))
+    await asyncio.sleep(API_LATENCY)
+    if method == "sendMessage":
+        return {"message_id": next(message_ids), "date": int(time.time()),
+                "chat": {"id": int(data["chat_id"]), "type": "supergroup"}, "text": data.get("text", "")}
+    if method == "getChatAdministrators":
+        return [{"user": {"id": 1, "is_bot": False, "first_name": "owner"}, "status": "creator"}]
+    if method == "getChatMember":
+        return {"user": {"id": int(data["user_id"]), "is_bot": False, "first_name": "u"}, "status": "member"}
+    return True
+
+async def main():
+    # Подменяем и планировщик запросов: проверяется очередь, а не лимиты Telegram
+    rating.RateLimitedBot.request = fake_request
+    rating.THANK_COALESCE_DELAY = 0.01
+
+    rnd = random.Random(1)
+    expected = Counter()
+    futures = []
+    started = time.perf_counter()
+    for i in range(THANKS):
+        chat_id = -1000 - rnd.randrange(CHATS)
+        target = 100 + rnd.randrange(USERS)
+        expected[(chat_id, target)] += 1
+        futures.append(rating.add_thank_to_queue(chat_id, 2, target, f"user{target}", i + 1))
+        # Благодарности приходят пачками вперемешку с обработкой
+        if i % 50 == 0:
+            await asyncio.sleep(0)
+
+    results = await asyncio.gather(*futures)
+    elapsed = time.perf_counter() - started
+    rating.ledger_cache.flush_all()
+    rating.storage_io.wait()
+
+    # Сверяем баллы с файлов, а не из кэша
+    rating.ledger_cache = rating.LedgerCache(rating.LEDGER_CACHE_SIZE)
+    lost = 0
+    for (chat_id, target), count in sorted(expected.items()):
+        points = rating.get_chat_ledger(chat_id).get_points(target)
+        if points != count:
+            lost += count - points
+            print(f"❌ Чат {chat_id}, пользователь {target}: ожидалось {count}, получено {points}")
+
+    print(f"Благодарностей: {THANKS}, чатов: {CHATS}, пользователей в чате: {USERS}")
+    print(f"Время: {elapsed:.2f} с ({THANKS / elapsed:.0f} благодарностей/с)")
+    print(f"Неудачных обработок: {results.count(False)}")
+    print(f"Одновременно активных чатов (максимум): {max_actors}")
+    print(f"Вызовы API: {dict(api_calls)}")
+    print("✅ Ни одна благодарность не потеряна" if lost == 0 else f"❌ Потеряно баллов: {lost}")
+    return lost == 0
+
+if __name__ == "__main__":
+    try:
+        ok = asyncio.run(main())
+    finally:
+        shutil.rmtree(WORK_DIR, ignore_errors=True)
+    sys.exit(0 if ok else 1)
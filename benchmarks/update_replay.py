@@ -0,0 +1,261 @@
+#────────────────────────────── ❑ ──────────────────────────────
+# Бенчмарк пропускной способности: синтетические обновления подаются прямо в dp с заглушкой Bot API
+# Сценарии: шторм благодарностей, спам /top, массовые вступления, /update в чатах на 1k, 10k и 100k участников
+# Запуск из корня репозитория:
+#   python benchmarks/update_replay.py                       - все сценарии, результат в benchmarks/results/
+#   python benchmarks/update_replay.py --quick                - без чата на 100k участников
+#   python benchmarks/update_replay.py --compare old.json     - сравнить с прошлым прогоном
+#────────────────────────────── ❑ ──────────────────────────────
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import random
+import asyncio
+import logging
+import argparse
+import platform
+import tempfile
+import contextlib
+import subprocess
+from collections import Counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(ROOT, "benchmarks", "results")
+sys.path.insert(0, ROOT)
+
+# Данные пишутся во временную папку, чтобы не трогать рабочие файлы бота
+WORK_DIR = tempfile.mkdtemp(prefix="rating_replay_")
+for name in ("translations.json", "token.txt", "lang.txt"):
+    shutil.copy(os.path.join(ROOT, name), WORK_DIR)
+os.chdir(WORK_DIR)
+
+with contextlib.redirect_stdout(io.StringIO()):
+    import rating
+from aiogram import Bot, Dispatcher, types
+
+CREATOR_ID = rating.CREATOR_ID
+OWNER_ID = 1
+BATCH_SIZE = 100  # обновлений обрабатывается одновременно, как пачка getUpdates
+
+# ──────────────── Заглушка Bot API ────────────────
+api_calls = Counter()
+admins = {}  # user_id -> custom_title: кого «бот» уже сделал админом
+message_ids = iter(range(1, 10 ** 9))
+
+async def fake_request(self, method, data=None, files=None, **kwargs):
+    """Отвечает как Telegram, без сети и без лимитов"""
+    api_calls[method] += 1
+    data = data or {}
+    if method in ("sendMessage", "editMessageText"):
+        return {"message_id": next(message_ids), "date": int(time.time()),
+                "chat": {"id": int(data["chat_id"]), "type": "supergroup"}, "text": data.get("text", "")}
+    if method == "getChatAdministrators":
+        return [{"user": {"id": OWNER_ID, "is_bot": False, "first_name": "owner"}, "status": "creator"}] + [
+            {"user": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}, "status": "administrator",
+             "custom_title": title, "can_be_edited": True}
+            for user_id, title in admins.items()]
+    if method == "getChatMember":
+        user_id = int(data["user_id"])
+        status = "creator" if user_id == OWNER_ID else ("administrator" if user_id in admins else "member")
+        return {"user": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}, "status": status}
+    if method == "promoteChatMember":
+        admins.setdefault(int(data["user_id"]), None)
+    if method == "setChatAdministratorCustomTitle":
+        admins[int(data["user_id"])] = data["custom_title"]
+    return True
+
+# ──────────────── Синтетические обновления ────────────────
+update_ids = iter(range(1, 10 ** 9))
+
+def user(user_id):
+    return {"id": user_id, "is_bot": False, "first_name": f"user{user_id}", "username": f"user{user_id}"}
+
+def message_update(chat_id, user_id, text, reply_to_user_id=None, **extra):
+    update_id = next(update_ids)
+    chat = {"id": chat_id, "type": "supergroup", "title": f"Чат {chat_id}"}
+    message = {"message_id": update_id, "date": int(time.time()), "chat": chat, "from": user(user_id), **extra}
+    if text is not None:
+        message["text"] = text
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    if reply_to_user_id:
+        message["reply_to_message"] = {"message_id": update_id - 1, "date": int(time.time()), "chat": chat,
+                                       "from": user(reply_to_user_id), "text": "вопрос"}
+    return types.Update(**{"update_id": update_id, "message": message})
+
+def preload_chat(chat_id, members, rnd):
+    """Создаёт на диске чат с members участниками и случайными баллами"""
+    users = {100 + i: {"username": f"user{100 + i}", "points": rnd.choice((0, 0, 3, 12, 17, 31))} for i in range(members)}
+    rating.save_chat_data(chat_id, users)
+
+def thank_storm(rnd, updates=20000, chats=10, users=500):
+    """Шквал благодарностей ответом на сообщения в нескольких чатах"""
+    return [message_update(-1000 - rnd.randrange(chats), 100 + rnd.randrange(users),
+                           rnd.choice(("спасибо!", "спс", "благодарю за помощь")), 100 + rnd.randrange(users))
+            for _ in range(updates)]
+
+def top_spam(rnd, updates=5000, members=10000):
+    chat_id = -2000
+    preload_chat(chat_id, members, rnd)
+    commands = ("/top", "/top 20", "/top page 3", "/my")
+    return [message_update(chat_id, 100 + rnd.randrange(members), rnd.choice(commands)) for _ in range(updates)]
+
+def mass_join(rnd, updates=2000, per_update=5):
+    chat_id = -3000
+    result = []
+    for i in range(updates):
+        joined = [user(500000 + i * per_update + k) for k in range(per_update)]
+        result.append(message_update(chat_id, joined[0]["id"], None, new_chat_members=joined))
+    return result
+
+def update_command(members):
+    def scenario(rnd):
+        chat_id = -4000 - members
+        preload_chat(chat_id, members, rnd)
+        return [message_update(chat_id, CREATOR_ID, "/update")]
+    scenario.__doc__ = f"/update в чате на {members} участников"
+    return scenario
+
+SCENARIOS = {
+    "thank_storm": thank_storm,
+    "top_spam": top_spam,
+    "mass_join": mass_join,
+    "update_1k": update_command(1000),
+    "update_10k": update_command(10000),
+    "update_100k": update_command(100000),
+}
+
+# ──────────────── Прогон ────────────────
+def reset_state():
+    """Чистое состояние бота перед сценарием"""
+    api_calls.clear()
+    admins.clear()
+    rating.ledger_cache = rating.LedgerCache(rating.LEDGER_CACHE_SIZE)
+    rating.chat_rosters.clear()
+    rating.thank_cooldowns = rating.CooldownStore(0)  # без кулдауна: меряем обработку, а не отказы
+    for path in os.listdir("."):
+        if path.startswith(("points_", "rank_", "thank_", "points_journal")):
+            os.remove(path)
+
+def bytes_written():
+    return sum(rating.STORAGE_BYTES.values.values())
+
+async def drain():
+    """Ждёт, пока отработают очередь благодарностей и исполнители чатов"""
+    while rating.pending_thanks or rating.thanks_in_flight or rating.chat_actors or rating.thank_queue.qsize():
+        await asyncio.sleep(0.01)
+
+async def run_scenario(name, seed):
+    reset_state()
+    rnd = random.Random(seed)
+    updates = SCENARIOS[name](rnd)
+    api_calls.clear()
+    bytes_before = bytes_written()
+    latencies = []
+
+    async def timed(update):
+        started = time.perf_counter()
+        await rating.dp.process_update(update)
+        latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for offset in range(0, len(updates), BATCH_SIZE):
+            await asyncio.gather(*(timed(update) for update in updates[offset:offset + BATCH_SIZE]))
+        await drain()
+        rating.ledger_cache.flush_all()
+        rating.storage_io.wait()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    total_api = sum(api_calls.values())
+    return {
+        "description": (SCENARIOS[name].__doc__ or "").strip(),
+        "updates": len(updates),
+        "seconds": round(elapsed, 3),
+        "updates_per_sec": round(len(updates) / elapsed, 1),
+        "p50_ms": round(latencies[len(latencies) // 2] * 1000, 3),
+        "p99_ms": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000, 3),
+        "bytes_written": int(bytes_written() - bytes_before),
+        "api_calls": total_api,
+        "api_calls_per_update": round(total_api / len(updates), 3),
+        "api_by_method": dict(api_calls),
+    }
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "-C", ROOT, "rev-parse", "--short", "HEAD"], text=True).strip()
+    except Exception:
+        return None
+
+def compare(results, baseline_path, threshold):
+    """Печатает изменения относительно прошлого прогона, возвращает True при регрессии"""
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = json.load(f)["scenarios"]
+
+    regressed = False
+    print(f"\nСравнение с {baseline_path} (порог {threshold:.0%}):")
+    for name, current in results.items():
+        old = baseline.get(name)
+        if not old:
+            continue
+        speed = current["updates_per_sec"] / old["updates_per_sec"] - 1
+        p99 = current["p99_ms"] / old["p99_ms"] - 1 if old["p99_ms"] else 0
+        bad = speed < -threshold or p99 > threshold
+        regressed |= bad
+        print(f"  {'❌' if bad else '✅'} {name}: обновлений/с {speed:+.0%}, p99 {p99:+.0%}, "
+              f"байт {current['bytes_written'] - old['bytes_written']:+d}, "
+              f"API/обновление {current['api_calls_per_update'] - old['api_calls_per_update']:+.3f}")
+    return regressed
+
+async def main(args):
+    rating.RateLimitedBot.request = fake_request
+    rating.THANK_COALESCE_DELAY = 0
+    for name in rating.LOG_LEVELS:
+        logging.getLogger(name).setLevel(logging.WARNING)
+    Bot.set_current(rating.bot)
+    Dispatcher.set_current(rating.dp)
+    rating.start_thank_workers()
+
+    names = args.scenarios or [name for name in SCENARIOS if not (args.quick and name == "update_100k")]
+    results = {}
+    for name in names:
+        print(f"▶ {name}...", flush=True)
+        results[name] = await run_scenario(name, args.seed)
+        r = results[name]
+        print(f"  {r['updates']} обновлений за {r['seconds']} с: {r['updates_per_sec']}/с, "
+              f"p50 {r['p50_ms']} мс, p99 {r['p99_ms']} мс, записано {r['bytes_written']} байт, "
+              f"API {r['api_calls_per_update']}/обновление")
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Бенчмарк обработки обновлений rating.py")
+    parser.add_argument("--scenarios", nargs="*", choices=list(SCENARIOS))
+    parser.add_argument("--quick", action="store_true", help="пропустить update_100k")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="файл результатов (по умолчанию benchmarks/results/replay-<время>.json)")
+    parser.add_argument("--compare", help="JSON прошлого прогона для сравнения")
+    parser.add_argument("--threshold", type=float, default=0.2, help="допустимое ухудшение (0.2 = 20%%)")
+    args = parser.parse_args()
+
+    try:
+        results = asyncio.run(main(args))
+    finally:
+        shutil.rmtree(WORK_DIR, ignore_errors=True)
+
+    output = args.output or os.path.join(RESULTS_DIR, f"replay-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump({
+            "revision": git_revision(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "scenarios": results,
+        }, f, ensure_ascii=False, indent=4)
+    print(f"\n💾 Результаты: {output}")
+
+    if args.compare and compare(results, args.compare, args.threshold):
+        sys.exit(1)
@@ -38,23 +38,33 @@ def set_lang(lang):
         f.write(lang)
     Debug.info(f"Language changed to {lang}")
 
+def build_username_index(user_data):
+    return {data["username"].lstrip("@").lower(): uid for uid, data in user_data.items() if data.get("username")}
+
+# Loaded user_points.json and its username index, reused while the file is unchanged
+user_points_cache = {"mtime": None, "data": None, "index": None}
+
+def load_user_points():
+    mtime = os.stat(USER_POINTS_FILE).st_mtime_ns
+    if user_points_cache["mtime"] != mtime:
+        with open(USER_POINTS_FILE, "r") as f:
+            user_data = json.load(f)
+        user_points_cache.update(mtime=mtime, data=user_data, index=build_username_index(user_data))
+    return user_points_cache["data"], user_points_cache["index"]
+
 def set_points(username, points):
 
     if username[0] == "@":
         username = username[1:]
     
     try:
-        with open(USER_POINTS_FILE, "r") as f:
-            user_data = json.load(f)
+        # Case-insensitive username -> id index, same matching as the bot
+        user_data, username_index = load_user_points()
     except FileNotFoundError:
         Debug.error(f"File {USER_POINTS_FILE} not found.")
         return
 
-    user_id = None
-    for uid, data in user_data.items():
-        if data.get("username") == username:
-            user_id = uid
-            break
+    user_id = username_index.get(username.lower())
 
     if not user_id:
         Debug.error(f"User with username '{username}' not found.")
@@ -65,6 +75,8 @@ def set_points(username, points):
         user_data[user_id]["points"] = points
         with open(USER_POINTS_FILE, "w") as f:
             json.dump(user_data, f, indent=4)
+        # Our own write: the loaded data and index already match the file
+        user_points_cache["mtime"] = os.stat(USER_POINTS_FILE).st_mtime_ns
         Debug.info(f"Points for user {username} set to {points}.")
         Debug.warn(f"Send this command to the chat: /u {user_id}")
     except ValueError:
@@ -4,23 +4,40 @@ import asyncio
 import time
 import re
 import glob
+import sys
+import sqlite3
+import heapq
+import bisect
 import threading
 import queue
+import contextlib
+import contextvars
+import itertools
+import signal
+import multiprocessing
+import atexit
+import logging
+import logging.handlers
+import concurrent.futures
+from array import array
 from datetime import datetime, timedelta
-from collections import defaultdict
+from collections import defaultdict, deque, OrderedDict
+from collections.abc import MutableMapping
 # aiogram==2.25.1
-from aiogram.utils import executor
+from aiogram.utils import executor, exceptions
 from aiogram import Bot, Dispatcher, types
+from aiogram.bot.api import TelegramAPIServer, TELEGRAM_PRODUCTION
 from aiogram.types import ChatAdministratorRights
-from aiogram.contrib.middlewares.logging import LoggingMiddleware
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiogram.dispatcher.handler import current_handler
+from aiohttp import web
+try:
+    import orjson  # необязательно: pip install orjson - кодирует и разбирает JSON в несколько раз быстрее
+except ImportError:
+    orjson = None
 
 # Глобальные очереди для обработки благодарностей
 thank_queue = asyncio.Queue()
-processing_tasks = {}
-processing_lock = asyncio.Lock()
-
-# ДОБАВЛЕНО: Словарь для блокировок файлов (упрощенный)
-file_locks = {}
 
 def load_translations(file_path="translations.json"):
     with open(file_path, "r", encoding="utf-8") as f:
@@ -36,14 +53,148 @@ CREATOR_ID = 8331388910 # ID создателя (ваш ID) - ЗАЩИЩЕННЫ
 # Слова для автоматического повышения баллов
 THANK_WORDS = ["спасибо", "благодарю", "спс", "саул", "от души", "мерси", "спасибки",
                "thanks", "thank you", "thx", "благодарствуйте", "пасиб"]
+# True - слово благодарности должно стоять отдельно ("спс" внутри других слов не считается)
+THANK_WORD_BOUNDARY = False
+# Дополнительные слова благодарности для отдельных чатов: {chat_id: [слова]}
+CUSTOM_THANK_WORDS_FILE = "thank_words.json"
 
-# Время между благодарностями (5 минут в секундах) - НЕ ИСПОЛЬЗУЕТСЯ
+# Время между благодарностями одного участника в чате (5 минут в секундах)
 THANK_COOLDOWN = 300  # 5 минут
+# Снимок активных кулдаунов (сохраняется при остановке, чтобы перезапуск их не сбрасывал)
+THANK_COOLDOWN_SNAPSHOT_FILE = "thank_cooldowns.json"
+# Обработчики очереди благодарностей
+THANK_WORKERS = 4
+THANK_COALESCE_DELAY = 1.0  # секунд: благодарности одному человеку за это время объединяются
+
+# Режим webhook (python rating.py --webhook) вместо long polling
+# Параметры можно переопределить при запуске: --host, --port, --path, --url, --secret
+WEBHOOK_HOST = "0.0.0.0"
+WEBHOOK_PORT = 8080
+WEBHOOK_PATH = "/webhook"
+WEBHOOK_URL = ""  # публичный адрес (https://example.com); пусто - webhook у Telegram не регистрируется
+WEBHOOK_SECRET = ""  # заголовок X-Telegram-Bot-Api-Secret-Token; пусто - без проверки
+WEBHOOK_QUEUE_SIZE = 1000  # обновлений в очереди; при переполнении Telegram получает 503 и повторит позже
+WEBHOOK_WORKERS = 8
+ALLOWED_UPDATES = ["message", "chat_member", "my_chat_member"]
+
+# Рейтинг: /top показывает TOP_DEFAULT_SIZE мест, /top N - не больше TOP_MAX_SIZE, /top page P - страницы по TOP_PAGE_SIZE
+TOP_DEFAULT_SIZE = 5
+TOP_MAX_SIZE = 50
+TOP_PAGE_SIZE = 10
 
 # Время удаления командных сообщений (30 секунд) - по умолчанию
 COMMAND_DELETE_TIME = 30
 # Время удаления уведомлений о повышении ранга (5 минут)
 RANKUP_DELETE_TIME = 300
+# Отложенные удаления сохраняются на диск и переживают перезапуск
+PENDING_DELETIONS_FILE = "pending_deletions.json"
+DELETION_BATCH_WINDOW = 2  # секунд: удаления одного чата в пределах окна идут одним запросом
+DELETION_SAVE_INTERVAL = 5  # секунд между сохранениями очереди удалений
+
+# Кэш данных чатов: сколько чатов держать в памяти и как часто писать на диск
+LEDGER_CACHE_SIZE = 256
+LEDGER_FLUSH_INTERVAL = 5  # секунд
+LEDGER_FLUSH_THRESHOLD = 50  # изменений в чате до немедленной записи
+
+# Хранилище данных: "json" (файлы points_/rank_) или "sqlite" (одна база)
+STORAGE_BACKEND = "json"
+SQLITE_DB_FILE = "rating.db"
+# Формат JSON-файлов: False - с отступами (удобно читать глазами), True - компактно (файлы примерно в 1,5 раза меньше,
+# с установленным orjson кодирование и разбор ещё быстрее). Читаются оба формата
+JSON_COMPACT = False
+STORAGE_IO_THREADS = 2  # потоков для чтения, кодирования и записи файлов (цикл событий их не ждёт)
+
+# Журнал изменений баллов: каждое изменение дописывается сюда до применения
+POINTS_JOURNAL_FILE = "points_journal.log"
+JOURNAL_SNAPSHOT_INTERVAL = 300  # секунд между снимками (после снимка журнал очищается)
+JOURNAL_FSYNC = False  # True - fsync после каждой записи (надёжнее, но медленнее)
+
+# Кэш администраторов чата (обновляется по событиям chat_member)
+ROSTER_TTL = 600  # секунд
+ADMIN_STATUSES = ['administrator', 'creator']
+OWNER_STATUSES = ['creator', 'владелец', 'Владелец']
+
+# Лимиты Telegram Bot API (все запросы проходят через планировщик)
+API_GLOBAL_RATE = 30  # запросов в секунду на бота
+API_GROUP_MESSAGES_PER_MINUTE = 20  # сообщений в минуту в одну группу
+API_PRIVATE_MESSAGES_PER_SECOND = 1  # сообщений в секунду в личный чат
+API_MAX_RETRIES = 3  # повторов после RetryAfter
+# Методы, на которые действует лимит сообщений в чат
+CHAT_LIMITED_METHODS = {"sendMessage", "editMessageText", "forwardMessage", "copyMessage"}
+# Адрес Bot API: пусто - api.telegram.org; для нагрузочных тестов - http://127.0.0.1:8081 (tools/fake_bot_api.py)
+# Переопределяется параметром --api-base или переменной окружения RATING_API_BASE
+API_BASE_URL = ""
+API_BASE_ENV = "RATING_API_BASE"
+
+# Структурированные логи: JSON-строки, которые пишет фоновый поток, а не цикл событий
+LOG_FILE = ""  # пусто - stdout
+LOG_QUEUE_SIZE = 10000  # при переполнении записи отбрасываются (с подсчётом), обработчики не ждут
+# Уровни по категориям (имя логгера); неуказанные наследуют уровень "rating"
+LOG_LEVELS = {
+    "rating": "INFO",
+    "rating.updates": "WARNING",  # каждое обновление - включать DEBUG только для отладки
+    "rating.messages": "INFO",  # DEBUG - каждое сообщение в чатах (с ограничением частоты)
+    "rating.thanks": "INFO",
+    "rating.api": "INFO",
+    "rating.access": "INFO",
+}
+# Не больше N записей в секунду для частых категорий (WARNING и выше не ограничиваются)
+LOG_RATE_LIMITS = {
+    "rating.messages": 5,
+    "rating.thanks": 50,
+    "rating.access": 5,
+}
+
+# Метрики в формате Prometheus: http://METRICS_HOST:METRICS_PORT/metrics (0 - не запускать)
+# Процессы-шарды слушают METRICS_PORT + номер шарда
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9108
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# Фоновая сверка после запуска (префиксы и уведомление о перезапуске) - бот отвечает сразу, не дожидаясь её
+# Порядок: чаты, активные за RECONCILE_RECENT секунд, затем крупные, затем спящие (без активности CHAT_ACTIVE_DAYS)
+RECONCILE_CONCURRENCY = 8  # сколько чатов сверяется одновременно
+RECONCILE_RECENT = 86400
+RECONCILE_BACKOFF = 0.5  # секунд паузы, пока пользователи ждут ответов или исчерпан общий лимит API
+RECONCILE_STATE_FILE = "reconcile_state.json"  # прогресс: после перезапуска сверка продолжается с места остановки
+RESTART_NOTICE = True  # отправлять в чат уведомление о перезапуске после его сверки
+
+# Реестр чатов: настоящий chat_id, название, активность и состояние бота (в SQLite - таблица chats)
+CHAT_REGISTRY_FILE = "chats.json"
+CHAT_ACTIVE_DAYS = 30  # чат без сообщений дольше этого и без бота фоновые задачи пропускают
+CHAT_ACTIVITY_RESOLUTION = 60  # секунд: чаще время активности не обновляется (меньше лишних записей)
+
+# Шардирование (python rating.py --shards N): чаты делятся между N процессами по abs(chat_id) % N
+# Номер шарда процесс получает от управляющего процесса через переменную окружения
+SHARD_ENV = "RATING_SHARD"
+SHARD_ID, SHARD_COUNT = (int(part) for part in os.environ.get(SHARD_ENV, "0/1").split("/"))
+SHARD_COMMAND_TIMEOUT = 10  # секунд на ответ всех шардов на межшардовую команду
+SHARD_RETRY_DELAY = 0.1  # секунд до повторной попытки, если очередь шарда заполнена
+
+def cli_option(name, default=None):
+    """Значение параметра командной строки вида --name value"""
+    if name in sys.argv:
+        index = sys.argv.index(name)
+        if index + 1 < len(sys.argv):
+            return sys.argv[index + 1]
+    return default
+
+def shard_file(path):
+    """Имя файла процесса-шарда: points_journal.log -> points_journal.shard2.log"""
+    if SHARD_COUNT == 1:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.shard{SHARD_ID}{ext}"
+
+def shard_for_chat(chat_id):
+    return abs(int(chat_id)) % SHARD_COUNT if chat_id is not None else 0
+
+# Общие для процесса файлы у каждого шарда свои (файлы чатов и так принадлежат одному шарду)
+POINTS_JOURNAL_FILE = shard_file(POINTS_JOURNAL_FILE)
+THANK_COOLDOWN_SNAPSHOT_FILE = shard_file(THANK_COOLDOWN_SNAPSHOT_FILE)
+PENDING_DELETIONS_FILE = shard_file(PENDING_DELETIONS_FILE)
+RECONCILE_STATE_FILE = shard_file(RECONCILE_STATE_FILE)
+CHAT_REGISTRY_FILE = shard_file(CHAT_REGISTRY_FILE)
 
 LANG = ""
 
@@ -80,20 +231,498 @@ except (FileNotFoundError, ValueError):
         file.write(API_TOKEN)
     print("The token is saved.")
 
-bot = Bot(token=API_TOKEN)
+# НОВОЕ: Неблокирующее структурированное логирование (logging + очередь + фоновый поток)
+class JsonLogFormatter(logging.Formatter):
+    """Одна запись - одна строка JSON: время, уровень, категория, сообщение и поля события"""
+
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "cat": record.name,
+            "msg": record.getMessage(),
+        }
+        fields = getattr(record, "fields", None)
+        if fields:
+            entry.update(fields)
+        dropped = getattr(record, "dropped", 0)
+        if dropped:
+            entry["dropped"] = dropped
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class LogRateLimiter(logging.Filter):
+    """Ограничивает частые категории по LOG_RATE_LIMITS; число пропущенных попадает в следующую запись"""
+
+    def __init__(self, limits):
+        super().__init__()
+        self.limits = limits
+        self.state = {}  # категория -> [токены, время обновления, пропущено]
+
+    def filter(self, record):
+        rate = self.limits.get(record.name)
+        if rate is None or record.levelno >= logging.WARNING:
+            return True
+        now = time.monotonic()
+        state = self.state.get(record.name)
+        if state is None:
+            state = self.state[record.name] = [rate, now, 0]
+        state[0] = min(rate, state[0] + (now - state[1]) * rate)
+        state[1] = now
+        if state[0] < 1:
+            state[2] += 1
+            return False
+        state[0] -= 1
+        if state[2]:
+            record.dropped = state[2]
+            state[2] = 0
+        return True
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """Кладёт запись в очередь как есть: форматирование и вывод - в потоке QueueListener"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+def setup_logging():
+    """Настраивает логгеры rating.* и запускает фоновую запись"""
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    queue_handler = NonBlockingQueueHandler(log_queue)
+    queue_handler.addFilter(LogRateLimiter(LOG_RATE_LIMITS))
+
+    if LOG_FILE:
+        output = logging.FileHandler(shard_file(LOG_FILE), encoding="utf-8")
+    else:
+        output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(JsonLogFormatter())
+
+    root_logger = logging.getLogger("rating")
+    root_logger.handlers[:] = [queue_handler]
+    root_logger.propagate = False
+    for name, level in LOG_LEVELS.items():
+        logging.getLogger(name).setLevel(level)
+
+    listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=False)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener, queue_handler
+
+def log_event(logger, level, message, **fields):
+    """Запись со структурированными полями (ничего не делает, если уровень выключен)"""
+    if logger.isEnabledFor(level):
+        logger.log(level, message, extra={"fields": fields})
+
+log_listener, log_queue_handler = setup_logging()
+log = logging.getLogger("rating")
+updates_log = logging.getLogger("rating.updates")
+messages_log = logging.getLogger("rating.messages")
+thanks_log = logging.getLogger("rating.thanks")
+api_log = logging.getLogger("rating.api")
+access_log = logging.getLogger("rating.access")
+
+class UpdateLogMiddleware(BaseMiddleware):
+    """Замена LoggingMiddleware: пишет обновления в категорию rating.updates (по умолчанию выключена)"""
+
+    async def on_pre_process_update(self, update, data):
+        data["log_started"] = time.perf_counter()
+        log_event(updates_log, logging.DEBUG, "update received", update_id=update.update_id)
+
+    async def on_post_process_update(self, update, results, data):
+        started = data.get("log_started")
+        if started is not None:
+            log_event(updates_log, logging.DEBUG, "update processed", update_id=update.update_id,
+                      ms=round((time.perf_counter() - started) * 1000, 2))
+
+# НОВОЕ: Метрики в текстовом формате Prometheus (без внешних зависимостей)
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", " ")
+
+def format_labels(labelnames, values, extra=""):
+    pairs = [f'{name}="{escape_label(value)}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class MetricCounter:
+    """Счётчик, который только растёт"""
+
+    kind = "counter"
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.values = defaultdict(float)
+
+    def inc(self, amount=1, **labels):
+        self.values[tuple(labels.get(name, "") for name in self.labelnames)] += amount
+
+    def samples(self):
+        for values, value in sorted(self.values.items()):
+            yield f"{self.name}{format_labels(self.labelnames, values)} {value:g}"
+
+class MetricHistogram:
+    """Гистограмма длительностей по корзинам METRICS_BUCKETS"""
+
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), buckets=METRICS_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.values = {}  # метки -> [счётчики корзин..., сумма, количество]
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        state = self.values.get(key)
+        if state is None:
+            state = self.values[key] = [0] * len(self.buckets) + [0.0, 0]
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            state[index] += 1
+        state[-2] += value
+        state[-1] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        for values, state in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, state):
+                cumulative += count
+                le = 'le="%g"' % bound
+                yield f"{self.name}_bucket{format_labels(self.labelnames, values, le)} {cumulative}"
+            le = 'le="+Inf"'
+            yield f"{self.name}_bucket{format_labels(self.labelnames, values, le)} {state[-1]}"
+            yield f"{self.name}_sum{format_labels(self.labelnames, values)} {state[-2]:.6f}"
+            yield f"{self.name}_count{format_labels(self.labelnames, values)} {state[-1]}"
+
+class MetricGauge:
+    """Текущее значение, которое считается при каждом запросе /metrics"""
+
+    kind = "gauge"
+
+    def __init__(self, name, help_text, func):
+        self.name = name
+        self.help_text = help_text
+        self.func = func
+
+    def samples(self):
+        try:
+            value = self.func()
+        except Exception:
+            return
+        yield f"{self.name} {value:g}"
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, labelnames=()):
+        return self.register(MetricCounter(name, help_text, labelnames))
+
+    def histogram(self, name, help_text, labelnames=()):
+        return self.register(MetricHistogram(name, help_text, labelnames))
+
+    def gauge(self, name, help_text, func):
+        return self.register(MetricGauge(name, help_text, func))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+HANDLER_SECONDS = metrics.histogram("rating_handler_seconds", "Время обработки обновления по обработчикам", ["handler"])
+API_REQUESTS = metrics.counter("rating_api_requests_total", "Запросы к Bot API по методам и результату", ["method", "status"])
+API_SECONDS = metrics.histogram("rating_api_request_seconds", "Длительность запроса к Bot API", ["method"])
+API_WAIT_SECONDS = metrics.histogram("rating_api_wait_seconds", "Ожидание в планировщике лимитов", ["method"])
+STORAGE_SECONDS = metrics.histogram("rating_storage_seconds", "Время чтения и записи данных", ["operation"])
+STORAGE_BYTES = metrics.counter("rating_storage_bytes_written_total", "Записано байт на диск", ["file"])
+
+def api_error_status(error):
+    """Код ответа Telegram для метрик по типу исключения aiogram"""
+    if isinstance(error, exceptions.RetryAfter):
+        return "429"
+    if isinstance(error, exceptions.BadRequest):
+        return "400"
+    if isinstance(error, exceptions.Unauthorized):
+        return "403"
+    if isinstance(error, exceptions.ConflictError):
+        return "409"
+    if isinstance(error, exceptions.NetworkError):
+        return "network"
+    return "error"
+
+def timed_storage(operation):
+    """Декоратор: время операции хранилища попадает в rating_storage_seconds"""
+    def decorator(func):
+        def wrapper(*args, **kwargs):
+            with STORAGE_SECONDS.time(operation=operation):
+                return func(*args, **kwargs)
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+    return decorator
+
+class MetricsMiddleware(BaseMiddleware):
+    """Замеряет время обработки обновлений по имени обработчика"""
+
+    def pre_process(self, data):
+        data["metrics_started"] = time.perf_counter()
+
+    def process(self, data):
+        handler = current_handler.get(None)
+        data["metrics_handler"] = getattr(handler, "__name__", "unknown")
+
+    def post_process(self, data):
+        started = data.get("metrics_started")
+        if started is not None:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, handler=data.get("metrics_handler", "unhandled"))
+
+    async def on_pre_process_message(self, message, data):
+        self.pre_process(data)
+
+    async def on_process_message(self, message, data):
+        self.process(data)
+
+    async def on_post_process_message(self, message, results, data):
+        self.post_process(data)
+
+    async def on_pre_process_chat_member(self, update, data):
+        self.pre_process(data)
+
+    async def on_process_chat_member(self, update, data):
+        self.process(data)
+
+    async def on_post_process_chat_member(self, update, results, data):
+        self.post_process(data)
+
+    async def on_pre_process_my_chat_member(self, update, data):
+        self.pre_process(data)
+
+    async def on_process_my_chat_member(self, update, data):
+        self.process(data)
+
+    async def on_post_process_my_chat_member(self, update, results, data):
+        self.post_process(data)
+
+async def metrics_handler(request):
+    return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+
+async def start_metrics_server():
+    """Поднимает /metrics на отдельном порту (у каждого шарда свой)"""
+    if not METRICS_PORT:
+        return None
+    port = METRICS_PORT + (SHARD_ID if SHARD_COUNT > 1 else 0)
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_handler)
+    runner = web.AppRunner(app)
+    try:
+        await runner.setup()
+        await web.TCPSite(runner, METRICS_HOST, port).start()
+        print(f"📈 Метрики: http://{METRICS_HOST}:{port}/metrics")
+        return runner
+    except OSError as e:
+        print(f"⚠️ Не удалось запустить сервер метрик на порту {port}: {e}")
+        await runner.cleanup()
+        return None
+
+# НОВОЕ: Планировщик запросов к Telegram вместо ручных asyncio.sleep
+PRIORITY_INTERACTIVE = 0  # ответы пользователям
+PRIORITY_BACKGROUND = 1  # фоновые задачи (префиксы, рассылки)
+api_priority = contextvars.ContextVar("api_priority", default=PRIORITY_INTERACTIVE)
+
+@contextlib.contextmanager
+def background_api_calls():
+    """Запросы внутри блока уступают очередь ответам пользователям"""
+    token = api_priority.set(PRIORITY_BACKGROUND)
+    try:
+        yield
+    finally:
+        api_priority.reset(token)
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше capacity подряд"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+
+    def wait_time(self):
+        """Сколько секунд ждать до свободного токена (0 - можно сейчас)"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def block(self, seconds):
+        """Telegram ответил RetryAfter - не выдаём токены указанное время"""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def is_idle(self):
+        return self.wait_time() == 0 and self.tokens >= self.capacity
+
+class SlidingWindow:
+    """Не больше limit запросов за любые period секунд - так Telegram считает сообщения в группу.
+    Ведро токенов тут не подходит: полное ведро плюс пополнение за ту же минуту дают почти двойной лимит"""
+
+    def __init__(self, limit, period):
+        self.limit = limit
+        self.period = period
+        self.sent = deque()
+        self.blocked_until = 0
+
+    def wait_time(self):
+        now = time.monotonic()
+        while self.sent and self.sent[0] <= now - self.period:
+            self.sent.popleft()
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if len(self.sent) < self.limit:
+            return 0
+        return self.sent[0] + self.period - now
+
+    def take(self):
+        self.sent.append(time.monotonic())
+
+    def block(self, seconds):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def is_idle(self):
+        return self.wait_time() == 0 and not self.sent
+
+class ApiScheduler:
+    """Общий и початовые лимиты запросов с приоритетом интерактивных ответов"""
+
+    MAX_CHAT_BUCKETS = 10000
+
+    def __init__(self):
+        # Общий лимит бота делится поровну между процессами-шардами
+        global_rate = API_GLOBAL_RATE / SHARD_COUNT
+        self.global_bucket = TokenBucket(global_rate, max(1, global_rate))
+        self.chat_buckets = {}
+        self.interactive_waiting = 0
+
+    def chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) >= self.MAX_CHAT_BUCKETS:
+                # Выбрасываем вёдра чатов, которые давно ничего не отправляли
+                self.chat_buckets = {k: v for k, v in self.chat_buckets.items() if not v.is_idle()}
+            if int(chat_id) < 0:
+                bucket = SlidingWindow(API_GROUP_MESSAGES_PER_MINUTE, 60)
+            else:
+                bucket = TokenBucket(API_PRIVATE_MESSAGES_PER_SECOND, API_PRIVATE_MESSAGES_PER_SECOND)
+            self.chat_buckets[chat_id] = bucket
+        return bucket
+
+    async def acquire(self, chat_id=None, priority=PRIORITY_INTERACTIVE):
+        """Ждёт, пока запрос можно отправить, не нарушая лимиты"""
+        interactive = priority == PRIORITY_INTERACTIVE
+        if interactive:
+            self.interactive_waiting += 1
+        try:
+            while True:
+                buckets = [self.global_bucket]
+                if chat_id is not None:
+                    buckets.append(self.chat_bucket(chat_id))
+                wait = max(bucket.wait_time() for bucket in buckets)
+                if not interactive and self.interactive_waiting:
+                    wait = max(wait, 0.05)
+                if wait <= 0:
+                    for bucket in buckets:
+                        bucket.take()
+                    return
+                await asyncio.sleep(wait)
+        finally:
+            if interactive:
+                self.interactive_waiting -= 1
+
+    def retry_after(self, chat_id, seconds):
+        """Приостанавливает чат (или все запросы) на время из RetryAfter"""
+        bucket = self.chat_bucket(chat_id) if chat_id is not None else self.global_bucket
+        bucket.block(seconds)
+
+api_scheduler = ApiScheduler()
+
+class RateLimitedBot(Bot):
+    """Bot, все запросы которого проходят через планировщик лимитов"""
+
+    async def request(self, method, data=None, files=None, **kwargs):
+        chat_id = data.get("chat_id") if data and method in CHAT_LIMITED_METHODS else None
+        priority = api_priority.get()
+
+        for attempt in range(API_MAX_RETRIES + 1):
+            with API_WAIT_SECONDS.time(method=method):
+                await api_scheduler.acquire(chat_id, priority)
+            started = time.perf_counter()
+            try:
+                result = await super().request(method, data, files, **kwargs)
+                API_REQUESTS.inc(method=method, status="ok")
+                return result
+            except exceptions.RetryAfter as e:
+                API_REQUESTS.inc(method=method, status="429")
+                if attempt >= API_MAX_RETRIES:
+                    raise
+                log_event(api_log, logging.WARNING, "flood control", method=method, retry_after=e.timeout)
+                api_scheduler.retry_after(chat_id, e.timeout)
+            except Exception as e:
+                API_REQUESTS.inc(method=method, status=api_error_status(e))
+                raise
+            finally:
+                API_SECONDS.observe(time.perf_counter() - started, method=method)
+
+def api_server():
+    """Сервер Bot API из --api-base, RATING_API_BASE или API_BASE_URL"""
+    base = cli_option("--api-base") or os.environ.get(API_BASE_ENV) or API_BASE_URL
+    return TelegramAPIServer.from_base(base) if base else TELEGRAM_PRODUCTION
+
+bot = RateLimitedBot(token=API_TOKEN, server=api_server())
 dp = Dispatcher(bot)
-dp.middleware.setup(LoggingMiddleware())
+dp.middleware.setup(UpdateLogMiddleware())
+dp.middleware.setup(MetricsMiddleware())
 
 def get_points_file(chat_id):
     """Возвращает путь к файлу с баллами для конкретного чата"""
     chat_id_str = str(chat_id).replace('-', '')
     return f"points_{chat_id_str}.json"
 
-def get_thank_file(chat_id):
-    """Возвращает путь к файлу с временем последних благодарностей"""
-    chat_id_str = str(chat_id).replace('-', '')
-    return f"thank_{chat_id_str}.json"
-
 def get_rank_file(chat_id):
     """Возвращает путь к файлу с последними рангами"""
     chat_id_str = str(chat_id).replace('-', '')
@@ -127,17 +756,139 @@ def get_rank_for_title(points, is_owner=False):
     stars = get_stars(points)
     return f"{stars} [{points}]"
 
+# НОВОЕ: Файловый ввод-вывод в отдельном пуле потоков, запись через временный файл и os.replace
+def dump_json(data, compact=None):
+    """Кодирует данные в байты: с отступами или компактно (через orjson, если установлен)"""
+    if not (JSON_COMPACT if compact is None else compact):
+        return json.dumps(data, ensure_ascii=False, indent=4).encode("utf-8")
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+def read_json_file(path):
+    """Читает и разбирает JSON-файл (любого из двух форматов)"""
+    with open(path, "rb") as f:
+        raw = f.read()
+    return orjson.loads(raw) if orjson is not None else json.loads(raw)
+
+def write_json_atomic(path, data, compact=None):
+    """Записывает JSON во временный файл и подменяет им старый - сбой не оставит обрезанный файл.
+    Возвращает число записанных байт"""
+    payload = dump_json(data, compact)
+    tmp_file = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp_file, "wb") as f:
+        f.write(payload)
+    os.replace(tmp_file, path)
+    return len(payload)
+
+class StorageIO:
+    """Пул потоков для файлов: цикл событий снимает копию данных, кодирование и запись идут в потоке.
+    Записи одного файла не обгоняют друг друга, устаревшие снимки пропускаются"""
+
+    def __init__(self, threads=STORAGE_IO_THREADS):
+        self.executor = concurrent.futures.ThreadPoolExecutor(threads, thread_name_prefix="storage-io")
+        self.lock = threading.Lock()
+        self.path_locks = {}
+        self.versions = {}  # путь -> номер последнего заказанного снимка
+        self.inflight = {}  # путь -> Future последней заказанной записи
+        self.failed = {}  # путь -> kind: последняя запись файла не удалась
+
+    def __len__(self):
+        return len(self.inflight)
+
+    def write(self, path, data, kind, compact=None):
+        """Заказывает запись снимка data в path (kind - метка метрик), не дожидаясь её.
+        Результат Future: True - записано, False - ошибка, None - пропущено ради более нового снимка"""
+        with self.lock:
+            version = self.versions.get(path, 0) + 1
+            self.versions[path] = version
+            path_lock = self.path_locks.setdefault(path, threading.Lock())
+            future = self.executor.submit(self._write, path, path_lock, version, data, kind, compact)
+            self.inflight[path] = future
+        future.add_done_callback(lambda done: self._done(path, done))
+        return future
+
+    def _write(self, path, path_lock, version, data, kind, compact):
+        with path_lock:
+            # Пока запись ждала очереди, заказали снимок новее - он всё равно перезапишет файл
+            if version < self.versions.get(path, 0):
+                return None
+            try:
+                with STORAGE_SECONDS.time(operation=f"write_{kind}"):
+                    written = write_json_atomic(path, data, compact)
+                STORAGE_BYTES.inc(written, file=kind)
+            except Exception as e:
+                print(f"ERROR writing {path}: {e}")
+                with self.lock:
+                    self.failed[path] = kind
+                return False
+            with self.lock:
+                self.failed.pop(path, None)
+            return True
+
+    def failed_paths(self, kind=None):
+        """Файлы, последняя запись которых не удалась (kind - только этого типа)"""
+        with self.lock:
+            return [path for path, failed_kind in self.failed.items() if kind is None or failed_kind == kind]
+
+    def _done(self, path, future):
+        with self.lock:
+            if self.inflight.get(path) is future:
+                del self.inflight[path]
+
+    async def settle(self, path):
+        """Ждёт заказанную запись файла, чтобы следующее чтение не получило старые данные"""
+        future = self.inflight.get(path)
+        if future is not None:
+            await asyncio.wrap_future(future)
+
+    def settle_now(self, path):
+        """То же, что settle, для синхронного кода цикла событий (в потоках пула не вызывать)"""
+        future = self.inflight.get(path)
+        if future is not None:
+            concurrent.futures.wait([future])
+
+    async def run(self, func, *args):
+        """Выполняет func(*args) в пуле, не блокируя цикл событий"""
+        return await asyncio.get_running_loop().run_in_executor(self.executor, lambda: func(*args))
+
+    def wait(self):
+        """Ждёт все заказанные записи (при остановке и перед очисткой журнала)"""
+        with self.lock:
+            futures = list(self.inflight.values())
+        concurrent.futures.wait(futures)
+
+    async def join(self):
+        """То же, что wait, но не блокируя цикл событий"""
+        with self.lock:
+            futures = list(self.inflight.values())
+        if futures:
+            await asyncio.wait([asyncio.wrap_future(future) for future in futures])
+
+storage_io = StorageIO()
+
+async def load_in_pool(load, chat_id, path):
+    """Вызывает load(chat_id) в пуле потоков после заказанной записи path.
+    SQLite - сразу здесь: чтение по индексу короткое, а запись в базу и так идёт в цикле событий"""
+    if sqlite_storage:
+        return load(chat_id)
+    await storage_io.settle(path)
+    return await storage_io.run(load, chat_id)
+
 # УПРОЩЕННЫЕ ФУНКЦИИ ДЛЯ РАБОТЫ С ФАЙЛАМИ
+@timed_storage("load_points")
 def load_chat_data(chat_id):
     """Загружает данные для конкретного чата"""
+    if sqlite_storage:
+        return sqlite_storage.load_points(chat_id)
+
     points_file = get_points_file(chat_id)
 
     if os.path.exists(points_file):
         try:
-            with open(points_file, "r", encoding="utf-8") as f:
-                data = json.load(f)
-                return {int(k): v for k, v in data.items()}
-        except json.JSONDecodeError:
+            data = read_json_file(points_file)
+            return {int(k): v for k, v in data.items()}
+        except ValueError:
             print(f"ERROR: Error reading points file for chat {chat_id}. Starting with empty data.")
             return {}
         except Exception as e:
@@ -145,98 +896,1084 @@ def load_chat_data(chat_id):
             return {}
     return {}
 
-def save_chat_data(chat_id, data):
-    """Сохраняет данные для конкретного чата"""
-    points_file = get_points_file(chat_id)
+@timed_storage("save_points")
+def save_chat_data(chat_id, data, changed=None):
+    """Сохраняет данные для конкретного чата (changed - изменённые user_id, если известны).
+    JSON: здесь снимается копия, кодирование и запись идут в пуле storage_io - возвращается Future записи"""
+    if sqlite_storage:
+        sqlite_storage.save_points(chat_id, data, changed)
+        return None
 
-    try:
-        with open(points_file, "w", encoding="utf-8") as f:
-            data_to_save = {str(k): v for k, v in data.items()}
-            json.dump(data_to_save, f, ensure_ascii=False, indent=4)
-    except Exception as e:
-        print(f"ERROR saving chat data: {e}")
+    data_to_save = data.snapshot() if isinstance(data, ColumnarUsers) else {str(k): dict(v) for k, v in data.items()}
+    return storage_io.write(get_points_file(chat_id), data_to_save, "points")
+
+def load_chat_columns(chat_id):
+    return ColumnarUsers(load_chat_data(chat_id))
+
+async def load_chat_data_async(chat_id):
+    """Как load_chat_data, но чтение, разбор файла и раскладка по колонкам идут в пуле потоков"""
+    return await load_in_pool(load_chat_columns, chat_id, get_points_file(chat_id))
+
+# НОВОЕ: Участники чата хранятся по колонкам: параллельные массивы вместо словаря на каждого
+class UserRecord(MutableMapping):
+    """Запись участника в виде словаря {"username", "points", "title"} поверх колонок ColumnarUsers"""
+
+    __slots__ = ("columns", "slot")
+
+    def __init__(self, columns, slot):
+        self.columns = columns
+        self.slot = slot
+
+    def __getitem__(self, key):
+        return self.columns.get_field(self.slot, key)
+
+    def __setitem__(self, key, value):
+        self.columns.set_field(self.slot, key, value)
+
+    def __delitem__(self, key):
+        self.columns.get_field(self.slot, key)
+        self.columns.set_field(self.slot, key, None)
+
+    def __iter__(self):
+        return iter(self.columns.record(self.slot))
+
+    def __len__(self):
+        return len(self.columns.record(self.slot))
+
+    def __repr__(self):
+        return repr(self.columns.record(self.slot))
 
-def load_last_thanks(chat_id):
-    """Загружает время последних благодарностей для чата"""
-    thank_file = get_thank_file(chat_id)
+class ColumnarUsers(MutableMapping):
+    """user_id -> запись участника, как раньше словарь словарей, но данные лежат в колонках:
+    user_id в array('q'), баллы в array('i'), username и префиксы - интернированные строки, общие для всех чатов.
+    Слот (номер строки) задаёт порядок добавления"""
 
-    if os.path.exists(thank_file):
+    def __init__(self, users=None):
+        self.ids = array("q")
+        self.points = array("i")
+        self.usernames = []
+        self.titles = []
+        self.extra = {}  # слот -> прочие поля записи (в файлах чатов их обычно нет)
+        self.slots = {}  # user_id -> слот
+        for user_id, user_data in (users or {}).items():
+            self[user_id] = user_data
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __contains__(self, user_id):
+        return user_id in self.slots
+
+    def __getitem__(self, user_id):
+        return UserRecord(self, self.slots[user_id])
+
+    def __setitem__(self, user_id, user_data):
+        slot = self.slots.get(user_id)
+        if slot is None:
+            slot = self.slots[user_id] = len(self.ids)
+            self.ids.append(user_id)
+            self.points.append(0)
+            self.usernames.append(None)
+            self.titles.append(None)
+        else:
+            self.titles[slot] = None
+            self.extra.pop(slot, None)
+        for key, value in user_data.items():
+            self.set_field(slot, key, value)
+
+    def __delitem__(self, user_id):
+        """Удаляет запись, переставляя последнюю на её место (индекс рейтинга после этого строится заново)"""
+        slot = self.slots.pop(user_id)
+        last = len(self.ids) - 1
+        if slot != last:
+            moved_id = self.ids[last]
+            self.ids[slot] = moved_id
+            self.points[slot] = self.points[last]
+            self.usernames[slot] = self.usernames[last]
+            self.titles[slot] = self.titles[last]
+            if last in self.extra:
+                self.extra[slot] = self.extra.pop(last)
+            else:
+                self.extra.pop(slot, None)
+            self.slots[moved_id] = slot
+        else:
+            self.extra.pop(slot, None)
+        for column in (self.ids, self.points, self.usernames, self.titles):
+            column.pop()
+
+    def get_points(self, user_id, default=0):
+        slot = self.slots.get(user_id)
+        return self.points[slot] if slot is not None else default
+
+    def get_field(self, slot, key):
+        if key == "points":
+            return self.points[slot]
+        if key == "username":
+            # username есть в каждой записи, даже пустой ("" или None) - как в файле чата
+            return self.usernames[slot]
+        if key == "title":
+            value = self.titles[slot]
+        else:
+            value = self.extra.get(slot, {}).get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def set_field(self, slot, key, value):
+        if key == "points":
+            try:
+                self.points[slot] = value
+            except OverflowError:
+                # Баллы вышли за int32 - расширяем колонку до int64
+                self.points = array("q", self.points)
+                self.points[slot] = value
+        elif key == "username":
+            self.usernames[slot] = sys.intern(value) if value else value
+        elif key == "title":
+            self.titles[slot] = sys.intern(value) if value else None
+        elif value is None:
+            self.extra.get(slot, {}).pop(key, None)
+        else:
+            self.extra.setdefault(slot, {})[key] = value
+
+    def record(self, slot):
+        """Запись слота обычным словарем (как в файле чата)"""
+        user_data = {"username": self.usernames[slot], "points": self.points[slot]}
+        if self.titles[slot] is not None:
+            user_data["title"] = self.titles[slot]
+        if slot in self.extra:
+            user_data.update(self.extra[slot])
+        return user_data
+
+    def snapshot(self):
+        """Копия для записи на диск: {"user_id": запись}"""
+        return {str(user_id): self.record(slot) for slot, user_id in enumerate(self.ids)}
+
+# НОВОЕ: Упорядоченный индекс рейтинга чата, обновляется при каждом изменении баллов
+class LeaderboardIndex:
+    """Отсортированный список (-баллы, слот, user_id) с двоичным поиском.
+    Слот - порядок добавления, он разрешает ничьи так же, как раньше стабильная сортировка словаря"""
+
+    def __init__(self, users):
+        self.users = users
+        self.entries = sorted((-points, slot, user_id)
+                              for slot, (user_id, points) in enumerate(zip(users.ids, users.points)))
+        self.zero_count = users.points.count(0)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def update(self, user_id, old_points, points):
+        """Переставляет пользователя после изменения баллов (old_points=None - новый пользователь)"""
+        if old_points == points:
+            return
+        slot = self.users.slots[user_id]
+        if old_points is not None:
+            del self.entries[bisect.bisect_left(self.entries, (-old_points, slot, user_id))]
+            self.zero_count -= old_points == 0
+        bisect.insort(self.entries, (-points, slot, user_id))
+        self.zero_count += points == 0
+
+    def top(self, limit, offset=0):
+        """Список (место, user_id, баллы) начиная с места offset + 1"""
+        return [(offset + i + 1, user_id, -neg_points)
+                for i, (neg_points, _, user_id) in enumerate(self.entries[offset:offset + limit])]
+
+    def rank(self, user_id):
+        """Место пользователя в рейтинге (с 1) или None, если его нет"""
+        slot = self.users.slots.get(user_id)
+        if slot is None:
+            return None
+        return bisect.bisect_left(self.entries, (-self.users.points[slot], slot, user_id)) + 1
+
+# НОВОЕ: Индекс username → user_id (без учёта регистра) по чатам и общий для всех загруженных чатов
+def normalize_username(username):
+    return username.lstrip("@").lower() if username else ""
+
+username_directory = {}
+
+# НОВОЕ: Данные чатов держатся в памяти и сбрасываются на диск отложенно
+class ChatLedger:
+    """Баллы одного чата, загруженные в память"""
+
+    def __init__(self, chat_id, users):
+        self.chat_id = chat_id
+        self.users = users if isinstance(users, ColumnarUsers) else ColumnarUsers(users)
+        self.dirty = 0
+        self.changed = set()
+        self.write = None  # (Future, changed) последней записи в пуле, пока не проверен её результат
+        self.index = None
+        self.usernames = {}
+        for user_id, username in zip(self.users.ids, self.users.usernames):
+            self.index_username(user_id, None, username)
+
+    def __contains__(self, user_id):
+        return user_id in self.users
+
+    def __len__(self):
+        return len(self.users)
+
+    def items(self):
+        """Снимок пар (user_id, данные) - безопасен для итерации с await внутри"""
+        return list(self.users.items())
+
+    def get_points(self, user_id, default=0):
+        return self.users.get_points(user_id, default)
+
+    def get_username(self, user_id, default=None):
+        slot = self.users.slots.get(user_id)
+        return self.users.usernames[slot] if slot is not None else default
+
+    def find_user(self, username):
+        """user_id по username (регистр и @ не важны) или None"""
+        return self.usernames.get(normalize_username(username))
+
+    def index_username(self, user_id, old_username, new_username):
+        old_key = normalize_username(old_username)
+        if old_key and self.usernames.get(old_key) == user_id:
+            del self.usernames[old_key]
+        if old_key and username_directory.get(old_key) == user_id:
+            del username_directory[old_key]
+        new_key = sys.intern(normalize_username(new_username))
+        if new_key:
+            self.usernames[new_key] = user_id
+            username_directory[new_key] = user_id
+
+    def unindex_usernames(self):
+        """Убирает username этого чата из общего индекса (при вытеснении чата из кэша)"""
+        for key, user_id in self.usernames.items():
+            if username_directory.get(key) == user_id:
+                del username_directory[key]
+
+    def get_title(self, user_id):
+        """Последний префикс, который бот установил пользователю"""
+        slot = self.users.slots.get(user_id)
+        return self.users.titles[slot] if slot is not None else None
+
+    def leaderboard(self):
+        """Индекс рейтинга (строится при первом обращении, дальше обновляется по изменениям)"""
+        if self.index is None:
+            self.index = LeaderboardIndex(self.users)
+        return self.index
+
+    def set_title(self, user_id, title):
+        """Запоминает установленный префикс (в журнал не пишется - это не баллы)"""
+        slot = self.users.slots.get(user_id)
+        if slot is not None and self.users.titles[slot] != title:
+            self.users.set_field(slot, "title", title)
+            self.mark_dirty(user_id)
+
+    def register(self, user_id, username, sender_id=None, reason="register"):
+        """Добавляет пользователя с 0 баллов, возвращает True если он новый"""
+        if user_id in self.users:
+            return False
+        points_journal.append(self.chat_id, user_id, sender_id, 0, 0, reason, username)
+        self.apply(user_id, 0, username)
+        return True
+
+    def register_many(self, members, reason="register"):
+        """Добавляет пачку (user_id, username) одной записью в журнал, на диск - отложенно, как остальные изменения.
+        Новые получают 0 баллов, у известных обновляется username. Возвращает (добавлено, обновлено)"""
+        changes = []
+        for user_id, username in members:
+            if user_id not in self.users:
+                changes.append((self.chat_id, user_id, None, 0, 0, reason, username))
+            elif username and self.get_username(user_id) != username:
+                changes.append((self.chat_id, user_id, None, 0, self.get_points(user_id), "rename", username))
+        if not changes:
+            return 0, 0
+
+        points_journal.append_many(changes)
+        inserted = 0
+        for _, user_id, _, _, points, _, username in changes:
+            inserted += user_id not in self.users
+            self.store(user_id, points, username)
+            self.changed.add(user_id)
+        self.dirty += len(changes)
+        if self.dirty >= LEDGER_FLUSH_THRESHOLD:
+            self.flush()
+        return inserted, len(changes) - inserted
+
+    def set_points(self, user_id, points, username=None, sender_id=None, reason=""):
+        """Устанавливает баллы пользователю (регистрируя его при необходимости)"""
+        delta = points - self.get_points(user_id)
+        points_journal.append(self.chat_id, user_id, sender_id, delta, points, reason, username)
+        self.apply(user_id, points, username)
+
+    def add_points(self, user_id, delta, username=None, sender_id=None, reason=""):
+        """Прибавляет delta баллов (не ниже 0), возвращает (было, стало)"""
+        old_points = self.get_points(user_id)
+        new_points = max(0, old_points + delta)
+        self.set_points(user_id, new_points, username, sender_id, reason)
+        return old_points, new_points
+
+    def apply(self, user_id, points, username=None):
+        """Применяет изменение без записи в журнал (используется и при восстановлении)"""
+        self.store(user_id, points, username)
+        self.mark_dirty(user_id)
+
+    def store(self, user_id, points, username=None):
+        """Меняет данные в памяти и индексы, не помечая чат изменённым"""
+        users = self.users
+        slot = users.slots.get(user_id)
+        if slot is None:
+            old_points = None
+            users[user_id] = {"username": username or f"user_{user_id}", "points": points}
+            self.index_username(user_id, None, username or f"user_{user_id}")
+        else:
+            old_points = users.points[slot]
+            if username and users.usernames[slot] != username:
+                # Пользователь сменил username - обновляем запись и индекс
+                self.index_username(user_id, users.usernames[slot], username)
+                users.set_field(slot, "username", username)
+            users.set_field(slot, "points", points)
+        if self.index is not None:
+            self.index.update(user_id, old_points, points)
+
+    def mark_dirty(self, user_id):
+        self.dirty += 1
+        self.changed.add(user_id)
+        if self.dirty >= LEDGER_FLUSH_THRESHOLD:
+            self.flush()
+
+    def check_write(self):
+        """Если прошлая запись в пуле не удалась, снова помечает её изменения - их запишет следующий flush.
+        Возвращает True, если запись не удалась"""
+        if self.write is None or not self.write[0].done():
+            return False
+        future, changed = self.write
+        self.write = None
+        if future.result() is not False:
+            return False
+        self.changed |= changed
+        self.dirty += max(1, len(changed))
+        return True
+
+    def flush(self):
+        """Записывает данные чата на диск, если были изменения"""
+        self.check_write()
+        if not self.dirty:
+            return False
+        future = save_chat_data(self.chat_id, self.users, self.changed)
+        chat_registry.set_members(self.chat_id, len(self.users))
+        if future is not None:
+            # Изменения прошлой неудачной записи ещё в self.changed - они попадут и в повтор этой
+            self.write = (future, self.changed)
+        self.dirty = 0
+        self.changed = set()
+        return True
+
+class LedgerCache:
+    """LRU-кэш загруженных чатов с отложенной записью"""
+
+    def __init__(self, max_chats=LEDGER_CACHE_SIZE):
+        self.max_chats = max_chats
+        self.ledgers = OrderedDict()
+        self.loading = {}  # chat key -> задача чтения файла
+
+    def get(self, chat_id):
+        # Ключ совпадает с именем файла: чаты 100 и -100 хранятся в одном points_100.json
+        key = abs(chat_id)
+        ledger = self.ledgers.get(key)
+        if ledger is not None:
+            self.ledgers.move_to_end(key)
+            return ledger
+
+        storage_io.settle_now(get_points_file(chat_id))
+        ledger = ChatLedger(chat_id, load_chat_data(chat_id))
+        self.add(key, ledger)
+        return ledger
+
+    def add(self, key, ledger):
+        self.ledgers[key] = ledger
+        while len(self.ledgers) > self.max_chats:
+            _, evicted = self.ledgers.popitem(last=False)
+            evicted.flush()
+            evicted.unindex_usernames()
+
+    async def preload(self, chat_id):
+        """Загружает чат в пуле потоков, чтобы обработчики не читали файл в цикле событий"""
+        key = abs(chat_id)
+        if key in self.ledgers:
+            return
+        loading = self.loading.get(key)
+        if loading is None:
+            loading = self.loading[key] = asyncio.ensure_future(load_chat_data_async(chat_id))
         try:
-            with open(thank_file, "r", encoding="utf-8") as f:
-                data = json.load(f)
-                return {int(k): float(v) for k, v in data.items()}
-        except Exception as e:
-            print(f"ERROR loading last thanks: {e}")
-    return {}
+            users = await loading
+        finally:
+            self.loading.pop(key, None)
+        # Пока файл читался, чат мог загрузить синхронный get - тогда он уже актуальнее
+        if key not in self.ledgers:
+            self.add(key, ChatLedger(chat_id, users))
 
-def save_last_thanks(chat_id, data):
-    """Сохраняет время последних благодарностей для чата"""
-    thank_file = get_thank_file(chat_id)
+    def flush_all(self):
+        """Сбрасывает на диск все изменённые чаты, возвращает их количество"""
+        return sum(1 for ledger in list(self.ledgers.values()) if ledger.flush())
 
-    try:
-        with open(thank_file, "w", encoding="utf-8") as f:
-            data_to_save = {str(k): v for k, v in data.items()}
-            json.dump(data_to_save, f, ensure_ascii=False, indent=4)
-    except Exception as e:
-        print(f"ERROR saving last thanks: {e}")
+    def check_writes(self):
+        """После ожидания записей: чаты с неудачной записью снова помечаются изменёнными.
+        Возвращает их количество"""
+        return sum(1 for ledger in list(self.ledgers.values()) if ledger.check_write())
 
+ledger_cache = LedgerCache()
+
+class LedgerPreloadMiddleware(BaseMiddleware):
+    """Подгружает данные группы до обработчиков - с диска читает пул потоков, а не цикл событий"""
+
+    async def preload(self, chat):
+        if chat.type in ("group", "supergroup"):
+            try:
+                await ledger_cache.preload(chat.id)
+            except Exception as e:
+                print(f"ERROR preloading chat {chat.id}: {e}")
+
+    async def on_pre_process_message(self, message, data):
+        await self.preload(message.chat)
+
+    async def on_pre_process_chat_member(self, update, data):
+        await self.preload(update.chat)
+
+dp.middleware.setup(LedgerPreloadMiddleware())
+
+def get_chat_ledger(chat_id):
+    """Возвращает резидентные данные чата (загружает с диска при первом обращении)"""
+    return ledger_cache.get(chat_id)
+
+# НОВОЕ: Журнал изменений баллов (append-only) со снимками и восстановлением
+class PointsJournal:
+    """Дописывает каждое изменение баллов одной строкой JSON до его применения"""
+
+    def __init__(self, path=POINTS_JOURNAL_FILE):
+        self.path = path
+        self.rotated_path = path + ".old"  # журнал до снимка, пока снимок пишется на диск
+        self.file = None
+        self.entries = 0
+
+    def append(self, chat_id, user_id, sender_id, delta, points, reason, username=None):
+        """Записывает изменение: чат, кому, от кого, на сколько, итог, причина, время"""
+        self.append_many([(chat_id, user_id, sender_id, delta, points, reason, username)])
+
+    def append_many(self, changes):
+        """Записывает несколько изменений одной записью в файл"""
+        lines = []
+        now = round(time.time(), 3)
+        for chat_id, user_id, sender_id, delta, points, reason, username in changes:
+            entry = {"c": chat_id, "u": user_id, "s": sender_id, "d": delta, "p": points,
+                     "r": reason, "t": now}
+            if username:
+                entry["n"] = username
+            lines.append(json.dumps(entry, ensure_ascii=False, separators=(",", ":")) + "\n")
+        if not lines:
+            return
+
+        if self.file is None:
+            self.file = open(self.path, "a", encoding="utf-8")
+        text = "".join(lines)
+        with STORAGE_SECONDS.time(operation="journal_append"):
+            self.file.write(text)
+            self.file.flush()
+            if JOURNAL_FSYNC:
+                os.fsync(self.file.fileno())
+        STORAGE_BYTES.inc(len(text.encode("utf-8")), file="journal")
+        self.entries += len(lines)
+
+    def replay(self):
+        """Применяет хвост журнала поверх последнего снимка, возвращает число записей"""
+        replayed = 0
+        # Сначала журнал незавершённого снимка (если процесс упал, пока снимок писался), затем текущий
+        for path in (self.rotated_path, self.path):
+            if not os.path.exists(path):
+                continue
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Последняя строка могла оборваться при сбое - пропускаем её
+                        print(f"⚠️ Пропущена повреждённая запись журнала: {line[:80]!r}")
+                        continue
+                    # В записи хранится итоговое значение, поэтому повторное применение безопасно
+                    get_chat_ledger(entry["c"]).apply(entry["u"], entry["p"], entry.get("n"))
+                    replayed += 1
+        return replayed
+
+    def rotate(self):
+        """Начинает новый файл журнала; старый нужен, пока снимок не записан на диск"""
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if os.path.exists(self.path):
+            if os.path.exists(self.rotated_path):
+                # Прошлый снимок не завершился - его записи должны остаться в журнале
+                with open(self.path, "rb") as src, open(self.rotated_path, "ab") as dst:
+                    dst.write(src.read())
+                os.remove(self.path)
+            else:
+                os.replace(self.path, self.rotated_path)
+        self.entries = 0
+
+    def drop_rotated(self):
+        if os.path.exists(self.rotated_path):
+            os.remove(self.rotated_path)
+
+    def snapshot(self):
+        """Сбрасывает все чаты на диск и очищает журнал (ждёт записи файлов)"""
+        self.rotate()
+        ledger_cache.flush_all()
+        storage_io.wait()
+        self.finish_snapshot()
+
+    async def snapshot_async(self):
+        """То же, что snapshot, но запись файлов ожидается без блокировки цикла событий"""
+        self.rotate()
+        ledger_cache.flush_all()
+        await storage_io.join()
+        self.finish_snapshot()
+
+    def finish_snapshot(self):
+        """Старый журнал удаляется, только если все файлы баллов записаны.
+        Иначе он остаётся (следующий снимок допишет к нему новый), а чаты повторят запись"""
+        failed_chats = ledger_cache.check_writes()
+        failed_files = storage_io.failed_paths("points")
+        if failed_chats or failed_files:
+            print(f"⚠️ Снимок не записан полностью ({len(failed_files)} файлов с ошибкой) - журнал сохранён")
+            return False
+        self.drop_rotated()
+        return True
+
+points_journal = PointsJournal()
+
+def restore_from_journal():
+    """При запуске: загружает снимок, применяет хвост журнала и делает новый снимок"""
+    replayed = points_journal.replay()
+    if replayed:
+        print(f"♻️ Восстановлено изменений из журнала: {replayed}")
+    points_journal.snapshot()
+
+async def journal_snapshot_loop():
+    """Периодически делает снимок данных и очищает журнал"""
+    while True:
+        await asyncio.sleep(JOURNAL_SNAPSHOT_INTERVAL)
+        try:
+            if points_journal.entries:
+                await points_journal.snapshot_async()
+        except Exception as e:
+            print(f"ERROR making journal snapshot: {e}")
+
+async def ledger_flush_loop():
+    """Периодически сбрасывает изменённые чаты на диск"""
+    while True:
+        await asyncio.sleep(LEDGER_FLUSH_INTERVAL)
+        try:
+            ledger_cache.flush_all()
+            chat_registry.save()
+        except Exception as e:
+            print(f"ERROR flushing chat data: {e}")
+
+@timed_storage("load_last_ranks")
 def load_last_ranks(chat_id):
     """Загружает последние ранги для чата"""
+    if sqlite_storage:
+        return sqlite_storage.load_last_ranks(chat_id)
+
     rank_file = get_rank_file(chat_id)
 
     if os.path.exists(rank_file):
         try:
-            with open(rank_file, "r", encoding="utf-8") as f:
-                data = json.load(f)
-                return {int(k): v for k, v in data.items()}
+            data = read_json_file(rank_file)
+            return {int(k): v for k, v in data.items()}
         except Exception as e:
             print(f"ERROR loading last ranks: {e}")
     return {}
 
+@timed_storage("save_last_ranks")
 def save_last_ranks(chat_id, data):
     """Сохраняет последние ранги для чата"""
-    rank_file = get_rank_file(chat_id)
+    if sqlite_storage:
+        sqlite_storage.save_last_ranks(chat_id, data)
+        return
 
-    try:
-        with open(rank_file, "w", encoding="utf-8") as f:
-            data_to_save = {str(k): v for k, v in data.items()}
-            json.dump(data_to_save, f, ensure_ascii=False, indent=4)
-    except Exception as e:
-        print(f"ERROR saving last ranks: {e}")
+    storage_io.write(get_rank_file(chat_id), {str(k): v for k, v in data.items()}, "ranks")
+
+# НОВОЕ: Хранилище SQLite (WAL) - все чаты в одной базе вместо отдельных JSON файлов
+class SqliteStorage:
+    """Баллы и ранги всех чатов в одной базе SQLite"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS points (
+            chat_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            username TEXT,
+            points INTEGER NOT NULL DEFAULT 0,
+            title TEXT,
+            PRIMARY KEY (chat_id, user_id)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS points_by_score ON points (chat_id, points DESC);
+        CREATE TABLE IF NOT EXISTS last_ranks (
+            chat_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            rank TEXT NOT NULL,
+            PRIMARY KEY (chat_id, user_id)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS chats (
+            chat_id INTEGER PRIMARY KEY,
+            title TEXT,
+            type TEXT,
+            first_seen REAL,
+            last_activity REAL,
+            bot_status TEXT,
+            members INTEGER
+        );
+    """
+
+    def __init__(self, db_file=SQLITE_DB_FILE):
+        self.db_file = db_file
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_file, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(self.SCHEMA)
+        # Базы, созданные до появления колонки title
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(points)")]
+        if "title" not in columns:
+            self.conn.execute("ALTER TABLE points ADD COLUMN title TEXT")
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(chats)")]
+        if "members" not in columns:
+            self.conn.execute("ALTER TABLE chats ADD COLUMN members INTEGER")
+
+    def _write(self, sql, rows):
+        """Выполняет пакет изменений в одной транзакции"""
+        with self.lock:
+            self.conn.execute("BEGIN")
+            try:
+                self.conn.executemany(sql, rows)
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def _read(self, sql, params):
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def load_points(self, chat_id):
+        rows = self._read("SELECT user_id, username, points, title FROM points WHERE chat_id = ?", (chat_id,))
+        data = {}
+        for user_id, username, points, title in rows:
+            data[user_id] = {"username": username, "points": points}
+            if title is not None:
+                data[user_id]["title"] = title
+        return data
+
+    def save_points(self, chat_id, data, changed=None):
+        """Записывает только изменённых пользователей (или всех, если changed не передан)"""
+        user_ids = data.keys() if changed is None else changed
+        rows = [(chat_id, user_id, data[user_id]["username"], data[user_id]["points"], data[user_id].get("title"))
+                for user_id in user_ids if user_id in data]
+        self._write(
+            "INSERT INTO points (chat_id, user_id, username, points, title) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT (chat_id, user_id) DO UPDATE SET username = excluded.username, "
+            "points = excluded.points, title = excluded.title",
+            rows
+        )
+
+    def load_last_ranks(self, chat_id):
+        rows = self._read("SELECT user_id, rank FROM last_ranks WHERE chat_id = ?", (chat_id,))
+        return dict(rows)
+
+    def save_last_ranks(self, chat_id, data):
+        self._write(
+            "INSERT INTO last_ranks (chat_id, user_id, rank) VALUES (?, ?, ?) "
+            "ON CONFLICT (chat_id, user_id) DO UPDATE SET rank = excluded.rank",
+            [(chat_id, user_id, rank) for user_id, rank in data.items()]
+        )
+
+    def chat_ids(self):
+        return [row[0] for row in self._read("SELECT DISTINCT chat_id FROM points", ())]
+
+    def load_chats(self):
+        rows = self._read("SELECT chat_id, title, type, first_seen, last_activity, bot_status, members FROM chats", ())
+        return {row[0]: dict(zip(ChatRegistry.FIELDS, row[1:])) for row in rows}
+
+    def delete_chats(self, chat_ids):
+        self._write("DELETE FROM chats WHERE chat_id = ?", [(chat_id,) for chat_id in chat_ids])
+
+    def save_chats(self, chats):
+        """chats - {chat_id: запись реестра}"""
+        self._write(
+            "INSERT INTO chats (chat_id, title, type, first_seen, last_activity, bot_status, members) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (chat_id) DO UPDATE SET title = excluded.title, "
+            "type = excluded.type, first_seen = excluded.first_seen, last_activity = excluded.last_activity, "
+            "bot_status = excluded.bot_status, members = excluded.members",
+            [(chat_id, *(record.get(field) for field in ChatRegistry.FIELDS)) for chat_id, record in chats.items()]
+        )
+
+sqlite_storage = SqliteStorage() if STORAGE_BACKEND == "sqlite" else None
+
+def import_json_to_sqlite(db_file=SQLITE_DB_FILE):
+    """Однократно переносит points_*.json и rank_*.json в базу SQLite.
+    Старые thank_*.json не переносятся: кулдауны благодарностей теперь живут в CooldownStore"""
+    storage = sqlite_storage or SqliteStorage(db_file)
+    imported = {"points": 0, "rank": 0}
+
+    for prefix in imported:
+        for file_name in glob.glob(f"{prefix}_*.json"):
+            try:
+                # В именах файлов минус убран; бот работает только в группах, а у них ID отрицательные
+                chat_id = -int(file_name[len(prefix) + 1:-len(".json")])
+                with open(file_name, "r", encoding="utf-8") as f:
+                    data = {int(k): v for k, v in json.load(f).items()}
+            except (ValueError, json.JSONDecodeError) as e:
+                print(f"⚠️ Пропускаю {file_name}: {e}")
+                continue
+
+            if prefix == "points":
+                storage.save_points(chat_id, data)
+            else:
+                storage.save_last_ranks(chat_id, data)
+            imported[prefix] += 1
+            print(f"✅ Импортирован {file_name} → чат {chat_id} ({len(data)} записей)")
+
+    print(f"✅ Импорт завершён: points={imported['points']}, rank={imported['rank']}")
+    return imported
+
+# НОВОЕ: Реестр чатов вместо поиска points_*.json - хранит настоящий chat_id (с минусом)
+BOT_PRESENT_STATUSES = ("member", "administrator", "creator", "restricted")
+
+class ChatRegistry:
+    """chat_id -> {title, type, first_seen, last_activity, bot_status, members}; None - неизвестно"""
+
+    FIELDS = ("title", "type", "first_seen", "last_activity", "bot_status", "members")
+
+    def __init__(self, path=CHAT_REGISTRY_FILE):
+        self.path = path
+        self.chats = None  # загружается при первом обращении
+        self.dirty = set()
+        self.removed = set()
+
+    def load(self):
+        if self.chats is not None:
+            return self.chats
+        if sqlite_storage:
+            self.chats = sqlite_storage.load_chats()
+        elif os.path.exists(self.path):
+            try:
+                self.chats = {int(k): v for k, v in read_json_file(self.path).items()}
+            except Exception as e:
+                print(f"ERROR loading chat registry: {e}")
+                self.chats = {}
+        else:
+            self.chats = {}
+        # Личные чаты и каналы в реестр попадать не должны - убираем записанные раньше по ошибке
+        for chat_id in [chat_id for chat_id, record in self.chats.items() if not self.is_group(chat_id, record)]:
+            del self.chats[chat_id]
+            self.removed.add(chat_id)
+        if self.removed:
+            print(f"🧹 Из реестра чатов убраны не группы: {len(self.removed)}")
+        if not self.chats:
+            self.bootstrap()
+        return self.chats
+
+    @staticmethod
+    def is_group(chat_id, record):
+        """Группа или супергруппа; у записей из сохранённых баллов тип неизвестен - тогда по знаку ID"""
+        if record.get("type"):
+            return record["type"] in ("group", "supergroup")
+        return chat_id < 0
+
+    def bootstrap(self):
+        """Первый запуск с реестром: чаты берутся из сохранённых баллов"""
+        now = time.time()
+        if sqlite_storage:
+            found = {chat_id: now for chat_id in sqlite_storage.chat_ids()}
+        else:
+            found = {}
+            for points_file in glob.glob("points_*.json"):
+                try:
+                    # В имени файла минус убран; бот работает только в группах, а у них ID отрицательные
+                    chat_id = -int(points_file[len("points_"):-len(".json")])
+                except ValueError:
+                    print(f"⚠️ Пропускаю файл с некорректным именем: {points_file}")
+                    continue
+                found[chat_id] = os.path.getmtime(points_file)
+        for chat_id, seen_at in found.items():
+            if shard_for_chat(chat_id) == SHARD_ID:
+                self.chats[chat_id] = {"title": None, "type": None, "first_seen": seen_at,
+                                       "last_activity": seen_at, "bot_status": None, "members": None}
+                self.dirty.add(chat_id)
+        if self.dirty:
+            print(f"📇 Реестр чатов создан по сохранённым данным: {len(self.dirty)} чатов")
+            self.save()
+
+    def __len__(self):
+        return len(self.load())
+
+    def get(self, chat_id):
+        return self.load().get(chat_id)
+
+    def record(self, chat_id):
+        chats = self.load()
+        record = chats.get(chat_id)
+        if record is None:
+            now = time.time()
+            record = chats[chat_id] = {"title": None, "type": None, "first_seen": now,
+                                       "last_activity": now, "bot_status": None, "members": None}
+            self.dirty.add(chat_id)
+        return record
+
+    def touch(self, chat):
+        """Обновление из чата: запоминаем название и время активности"""
+        record = self.record(chat.id)
+        now = time.time()
+        if (chat.title and record["title"] != chat.title) or record["type"] != chat.type:
+            record["title"] = chat.title or record["title"]
+            record["type"] = chat.type
+            self.dirty.add(chat.id)
+        if now - (record["last_activity"] or 0) >= CHAT_ACTIVITY_RESOLUTION:
+            record["last_activity"] = now
+            self.dirty.add(chat.id)
+        # Раз из чата приходят обновления, бот в нём есть
+        if record["bot_status"] not in BOT_PRESENT_STATUSES:
+            record["bot_status"] = "member"
+            self.dirty.add(chat.id)
+
+    def set_members(self, chat_id, members):
+        record = self.record(chat_id)
+        if record.get("members") != members:
+            record["members"] = members
+            self.dirty.add(chat_id)
+
+    def set_bot_status(self, chat_id, status):
+        record = self.record(chat_id)
+        if record["bot_status"] != status:
+            record["bot_status"] = status
+            self.dirty.add(chat_id)
+
+    def is_active(self, chat_id, now=None):
+        """Бот в чате (или это неизвестно) либо в чате недавно писали"""
+        record = self.load().get(chat_id)
+        if record is None or not self.is_group(chat_id, record):
+            return False
+        if record["bot_status"] is None or record["bot_status"] in BOT_PRESENT_STATUSES:
+            return True
+        now = now or time.time()
+        return now - (record["last_activity"] or 0) < CHAT_ACTIVE_DAYS * 86400
+
+    def chat_ids(self, active_only=True):
+        now = time.time()
+        if active_only:
+            return [chat_id for chat_id in self.load() if self.is_active(chat_id, now)]
+        return [chat_id for chat_id, record in self.load().items() if self.is_group(chat_id, record)]
+
+    def save(self):
+        """Записывает изменённые записи (JSON - снимком в пуле storage_io)"""
+        if not (self.dirty or self.removed) or self.chats is None:
+            return
+        if sqlite_storage:
+            sqlite_storage.save_chats({chat_id: self.chats[chat_id] for chat_id in self.dirty if chat_id in self.chats})
+            sqlite_storage.delete_chats(self.removed)
+        else:
+            storage_io.write(self.path, {str(chat_id): dict(record) for chat_id, record in self.chats.items()},
+                             "registry")
+        self.dirty, self.removed = set(), set()
+
+chat_registry = ChatRegistry()
+
+def list_chat_ids(active_only=True):
+    """ID чатов этого процесса из реестра (по умолчанию - только с ботом или недавно активные)"""
+    return chat_registry.chat_ids(active_only)
+
+class ChatRegistryMiddleware(BaseMiddleware):
+    """Отмечает активность групп в реестре чатов"""
+
+    async def on_pre_process_message(self, message, data):
+        if message.chat.type in ("group", "supergroup"):
+            chat_registry.touch(message.chat)
+            # В чате пишут прямо сейчас - его сверка идёт первой
+            reconciler.promote(message.chat.id)
+
+    async def on_pre_process_my_chat_member(self, update, data):
+        # Личный чат появляется, когда пользователь запускает бота - его в реестр не записываем
+        if update.chat.type in ("group", "supergroup"):
+            chat_registry.touch(update.chat)
+            chat_registry.set_bot_status(update.chat.id, update.new_chat_member.status)
+
+dp.middleware.setup(ChatRegistryMiddleware())
 
 def get_translation(key, **kwargs):
     template = translations.get(LANG, {}).get(key, key)
     return template.format(**kwargs)
 
-def contains_thank_word(text):
-    """Проверяет, содержит ли текст слова благодарности (включая внутри других слов)"""
-    if not text:
-        return False
+# НОВОЕ: Слова благодарности ищутся одним заранее скомпилированным регулярным выражением
+REPEATED_CHAR_RE = re.compile(r"(.)\1+")
+
+def normalize_thank_word(word):
+    """Нижний регистр, ё → е и схлопывание повторов ("спасиииибо" → "спасибо")"""
+    return REPEATED_CHAR_RE.sub(r"\1", word.strip().lower().replace("ё", "е"))
+
+class ThankMatcher:
+    """Ищет любое из слов благодарности за один проход по тексту"""
+
+    def __init__(self, words, word_boundary=THANK_WORD_BOUNDARY):
+        self.words = sorted({normalize_thank_word(word) for word in words if word.strip()})
+        pattern = self._build_pattern(self.words, keep_longer=word_boundary, repeat_first=word_boundary)
+        if word_boundary:
+            pattern = rf"(?<!\w){pattern}(?!\w)"
+        self.regex = re.compile(pattern)
+
+    @staticmethod
+    def _build_pattern(words, keep_longer=False, repeat_first=False):
+        """Собирает слова в префиксное дерево: общие начала проверяются один раз.
+        Каждая буква кроме первой может повторяться ("спасиииибо") - так не нужно
+        нормализовать каждый входящий текст, а первая буква остаётся литералом,
+        по которому re быстро пропускает неподходящие позиции.
+        Для целых слов повторяться может и первая буква ("сспасибо"): поиск со следующей
+        позиции тут не поможет - перед ней стоит та же буква, и граница слова не совпадёт."""
+        trie = {}
+        for word in words:
+            node = trie
+            for char in word:
+                node = node.setdefault(char, {})
+            node[""] = {}
+
+        def build(node, first):
+            # Более короткое слово уже совпало - при поиске подстроки продолжение не нужно,
+            # а для целых слов длинный вариант остаётся необязательным продолжением
+            if "" in node and (not keep_longer or len(node) == 1):
+                return ""
+            branches = [re.escape(char) + ("" if first and not repeat_first else "+") + build(child, False)
+                        for char, child in sorted(node.items()) if char]
+            pattern = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+            if "" in node:
+                return f"(?:{pattern})?"
+            return pattern
+
+        return build(trie, True)
+
+    def matches(self, text):
+        if not text:
+            return False
+        return self.regex.search(text.lower().replace("ё", "е")) is not None
 
-    text_lower = text.lower()
-    for word in THANK_WORDS:
-        if word.lower() in text_lower:  # Сравниваем в нижнем регистре
-            return True
-    return False
+def load_custom_thank_words():
+    """Загружает дополнительные слова благодарности для чатов"""
+    if os.path.exists(CUSTOM_THANK_WORDS_FILE):
+        try:
+            return {int(k): list(v) for k, v in read_json_file(CUSTOM_THANK_WORDS_FILE).items()}
+        except Exception as e:
+            print(f"ERROR loading custom thank words: {e}")
+    return {}
 
-# ИЗМЕНЕННАЯ: Функция для проверки кулдауна - ВСЕГДА ВОЗВРАЩАЕТ True
-async def can_thank_now(chat_id, user_id):
-    """Проверяет, можно ли пользователю отправить благодарность"""
+def save_custom_thank_words(data):
+    """Сохраняет дополнительные слова благодарности для чатов"""
     try:
-        # ОБНОВЛЕНО: Теперь всегда возвращаем True, без кулдауна
-        thanks_data = load_last_thanks(chat_id)
-        current_time = time.time()
+        # Пишется сразу, а не в пуле: другие шарды перечитывают файл сразу после сохранения
+        write_json_atomic(CUSTOM_THANK_WORDS_FILE, {str(k): v for k, v in data.items()})
+    except Exception as e:
+        print(f"ERROR saving custom thank words: {e}")
+
+custom_thank_words = load_custom_thank_words()
+default_thank_matcher = ThankMatcher(THANK_WORDS)
+chat_thank_matchers = {}
+
+def get_thank_matcher(chat_id=None):
+    """Возвращает матчер для чата (общие слова + слова этого чата)"""
+    words = custom_thank_words.get(chat_id)
+    if not words:
+        return default_thank_matcher
+    matcher = chat_thank_matchers.get(chat_id)
+    if matcher is None:
+        matcher = chat_thank_matchers[chat_id] = ThankMatcher(THANK_WORDS + words)
+    return matcher
+
+def set_chat_thank_words(chat_id, words):
+    """Задаёт дополнительные слова благодарности для чата"""
+    if words:
+        custom_thank_words[chat_id] = words
+    else:
+        custom_thank_words.pop(chat_id, None)
+    chat_thank_matchers.pop(chat_id, None)
+    save_custom_thank_words(custom_thank_words)
+    # Файл общий для всех шардов - остальные перечитывают его, чтобы не затереть изменение
+    if shard_link:
+        shard_link.broadcast("reload_thank_words")
+
+def reload_custom_thank_words():
+    """Перечитывает слова благодарности с диска (после изменения в другом шарде)"""
+    custom_thank_words.clear()
+    custom_thank_words.update(load_custom_thank_words())
+    chat_thank_matchers.clear()
+
+def contains_thank_word(text, chat_id=None):
+    """Проверяет, содержит ли текст слова благодарности (включая внутри других слов)"""
+    return get_thank_matcher(chat_id).matches(text)
+
+# НОВОЕ: Кулдауны благодарностей хранятся в памяти и истекают сами
+class CooldownStore:
+    """Время окончания кулдауна по ключу; просроченные записи удаляются при обращении"""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.expires = {}
+        self.heap = []
+
+    def __len__(self):
+        self._purge(time.time())
+        return len(self.expires)
+
+    def _purge(self, now):
+        while self.heap and self.heap[0][0] <= now:
+            expires_at, key = heapq.heappop(self.heap)
+            # Ключ мог быть продлён позже - удаляем только если это его последняя запись
+            if self.expires.get(key) == expires_at:
+                del self.expires[key]
+
+    def remaining(self, key):
+        """Сколько секунд осталось до конца кулдауна (0 - кулдауна нет)"""
+        now = time.time()
+        self._purge(now)
+        expires_at = self.expires.get(key)
+        return expires_at - now if expires_at else 0
+
+    def start(self, key, expires_at=None):
+        expires_at = expires_at or time.time() + self.ttl
+        self.expires[key] = expires_at
+        heapq.heappush(self.heap, (expires_at, key))
+
+    def save(self, path):
+        """Сохраняет активные кулдауны на диск"""
+        self._purge(time.time())
+        try:
+            write_json_atomic(path, [[*key, expires_at] for key, expires_at in self.expires.items()], compact=True)
+        except Exception as e:
+            print(f"ERROR saving thank cooldowns: {e}")
 
-        # Обновляем время (для совместимости)
-        thanks_data[user_id] = current_time
-        save_last_thanks(chat_id, thanks_data)
+    def load(self, path):
+        """Восстанавливает ещё не истёкшие кулдауны"""
+        if not os.path.exists(path):
+            return
+        try:
+            now = time.time()
+            for *key, expires_at in read_json_file(path):
+                if expires_at > now:
+                    self.start(tuple(key), expires_at)
+        except Exception as e:
+            print(f"ERROR loading thank cooldowns: {e}")
 
-        return True, 0  # Всегда разрешаем поблагодарить
+thank_cooldowns = CooldownStore(THANK_COOLDOWN)
 
-    except Exception as e:
-        print(f"⚠️ Ошибка в can_thank_now: {e}")
-        # В случае ошибки также разрешаем поблагодарить
-        return True, 0
+async def can_thank_now(chat_id, user_id):
+    """Проверяет, можно ли пользователю отправить благодарность, и запускает кулдаун"""
+    wait_time = thank_cooldowns.remaining((chat_id, user_id))
+    if wait_time > 0:
+        return False, int(wait_time) + 1
+
+    thank_cooldowns.start((chat_id, user_id))
+    return True, 0
 
 def extract_points_from_command(text):
     """Извлекает количество баллов и причину из команды /plus или /minus"""
@@ -263,32 +2000,119 @@ def extract_points_from_command(text):
     return 0, ""
 
 async def get_user_id_from_mention(chat_id, username_input):
-    """Получает ID пользователя по username - исправленная версия"""
+    """Получает ID пользователя по username: сначала в этом чате, затем во всех загруженных"""
     try:
-        username = username_input.lstrip('@')
+        user_id = get_chat_ledger(chat_id).find_user(username_input)
+        if user_id is None:
+            user_id = username_directory.get(normalize_username(username_input))
+        return user_id
 
-        chat_points = load_chat_data(chat_id)
+    except Exception as e:
+        print(f"ERROR: Не удалось найти пользователя @{username_input}: {e}")
+        return None
 
-        for user_id, user_data in chat_points.items():
-            user_username = user_data.get('username', '').lstrip('@')
-            if user_username and user_username.lower() == username.lower():
-                return user_id
+MENTION_ARG_RE = re.compile(r"^@(\w+)\s*(.*)$", re.S)
+
+async def resolve_command_target(message):
+    """Цель команды без ответа на сообщение: /plus @user 10 ... или упоминание без username.
+    Возвращает ((user_id, username) или None, текст аргументов без упоминания)"""
+    args = message.get_args() or ""
+
+    # Упоминание пользователя без username приходит сущностью text_mention
+    for entity in message.entities or []:
+        if entity.type == "text_mention" and entity.user:
+            user = entity.user
+            mention = entity.get_text(message.text)
+            rest = args.replace(mention, "", 1).strip()
+            return (user.id, user.username or user.first_name or f"user_{user.id}"), rest
+
+    match = MENTION_ARG_RE.match(args.strip())
+    if not match:
+        return None, args
+
+    username, rest = match.groups()
+    user_id = await get_user_id_from_mention(message.chat.id, username)
+    if user_id is None:
+        return None, rest
+    stored = get_chat_ledger(message.chat.id).get_username(user_id)
+    return (user_id, stored or username), rest
+
+# НОВОЕ: Кэш статусов участников - вместо get_chat_member на каждую проверку
+class ChatRoster:
+    """Администраторы одного чата: {user_id: {"status", "custom_title"}}"""
+
+    def __init__(self):
+        self.admins = {}
+        self.members = {}  # статусы, полученные поштучно, если список админов недоступен
+        self.loaded_at = 0
+        self.lock = asyncio.Lock()
+
+    def is_fresh(self):
+        return time.time() - self.loaded_at < ROSTER_TTL
+
+    def set_member(self, user_id, status, custom_title=None):
+        """Обновляет статус участника (по событию chat_member или после наших действий)"""
+        if status in ADMIN_STATUSES:
+            self.admins[user_id] = {"status": status, "custom_title": custom_title}
+        else:
+            self.admins.pop(user_id, None)
+        self.members[user_id] = (status, time.time())
+
+    def invalidate(self):
+        self.loaded_at = 0
+        self.members.clear()
+
+chat_rosters = defaultdict(ChatRoster)
+
+async def refresh_chat_roster(chat_id):
+    """Загружает список администраторов одним запросом get_chat_administrators"""
+    roster = chat_rosters[chat_id]
+    async with roster.lock:
+        if roster.is_fresh():
+            return roster
+        admins = await bot.get_chat_administrators(chat_id)
+        roster.admins = {
+            admin.user.id: {"status": admin.status, "custom_title": getattr(admin, "custom_title", None)}
+            for admin in admins
+        }
+        roster.members.clear()
+        roster.loaded_at = time.time()
+    return roster
+
+async def get_member_status(chat_id, user_id):
+    """Возвращает статус участника из кэша (None - если узнать не удалось)"""
+    roster = chat_rosters[chat_id]
+
+    cached = roster.members.get(user_id)
+    if cached and time.time() - cached[1] < ROSTER_TTL:
+        return cached[0]
 
-        return None
+    try:
+        if not roster.is_fresh():
+            await refresh_chat_roster(chat_id)
+        admin = roster.admins.get(user_id)
+        return admin["status"] if admin else "member"
+    except Exception as e:
+        print(f"DEBUG: Не удалось получить список администраторов чата {chat_id}: {e}")
 
+    # Список администраторов недоступен - спрашиваем конкретного участника
+    try:
+        member = await bot.get_chat_member(chat_id, user_id)
+        roster.members[user_id] = (member.status, time.time())
+        return member.status
     except Exception as e:
-        print(f"ERROR: Не удалось найти пользователя @{username_input}: {e}")
+        print(f"DEBUG: Не удалось получить статус пользователя {user_id}: {e}")
         return None
 
+async def is_chat_owner(chat_id, user_id):
+    """Проверяет, является ли пользователь владельцем чата"""
+    return await get_member_status(chat_id, user_id) in OWNER_STATUSES
+
 async def make_user_admin_for_prefix(chat_id, user_id):
     """Делает пользователя администратором с минимальными правами для установки префикса"""
     try:
-        try:
-            member_status = await bot.get_chat_member(chat_id, user_id)
-            if member_status.status in ['administrator', 'creator']:
-                return True
-        except Exception as e:
-            print(f"DEBUG: Ошибка при получении статуса: {e}")
+        if await get_member_status(chat_id, user_id) in ADMIN_STATUSES:
+            return True
 
         # Делаем пользователя администратором с МИНИМАЛЬНЫМИ правами
         try:
@@ -309,7 +2133,7 @@ async def make_user_admin_for_prefix(chat_id, user_id):
             )
 
             if success:
-                await asyncio.sleep(2)
+                chat_rosters[chat_id].set_member(user_id, 'administrator')
                 return True
             else:
                 return False
@@ -322,108 +2146,153 @@ async def make_user_admin_for_prefix(chat_id, user_id):
         print(f"ERROR: Общая ошибка при назначении администратора: {e}")
         return False
 
-async def set_user_prefix(chat_id, user_id, points, is_owner=False):
-    """Устанавливает префикс пользователю - ИСПРАВЛЕННАЯ ВЕРСИЯ"""
+# Результаты синхронизации префикса
+PREFIX_UPDATED = "updated"
+PREFIX_UNCHANGED = "unchanged"
+PREFIX_FAILED = "failed"
+
+def get_applied_title(chat_id, user_id):
+    """Префикс, который сейчас стоит у пользователя (по кэшу админов или по нашей записи)"""
+    roster = chat_rosters[chat_id]
+    if roster.is_fresh() and user_id in roster.admins:
+        return roster.admins[user_id]["custom_title"]
+    return get_chat_ledger(chat_id).get_title(user_id)
+
+def remember_applied_title(chat_id, user_id, title):
+    """Запоминает префикс после успешной установки"""
+    get_chat_ledger(chat_id).set_title(user_id, title)
+    admin = chat_rosters[chat_id].admins.get(user_id)
+    if admin is not None:
+        admin["custom_title"] = title
+
+async def apply_user_prefix(chat_id, user_id, points, is_owner=False):
+    """Приводит префикс пользователя к баллам; API вызывается только при реальном отличии"""
     try:
         # Формируем префикс с баллами (только звезды и баллы)
-        prefix = get_rank_for_title(points, is_owner=is_owner)
+        # Ограничение Telegram: максимум 16 символов для префикса
+        prefix_to_set = get_rank_for_title(points, is_owner=is_owner)[:16]
 
         # Проверяем статус пользователя
-        try:
-            member_status = await bot.get_chat_member(chat_id, user_id)
-            user_is_admin = member_status.status in ['administrator', 'creator']
-
-            if not user_is_admin:
-                admin_success = await make_user_admin_for_prefix(chat_id, user_id)
-                if not admin_success:
-                    return False
-                await asyncio.sleep(2)
-
-            # Теперь пробуем установить префикс
-            # Ограничение Telegram: максимум 16 символов для префикса
-            prefix_to_set = prefix[:16]
-
-            # Попробуем установить префикс несколько раз
-            max_attempts = 2
-            for attempt in range(max_attempts):
-                try:
-                    await bot.set_chat_administrator_custom_title(
-                        chat_id=chat_id,
-                        user_id=user_id,
-                        custom_title=prefix_to_set
-                    )
-                    return True
-
-                except Exception as e:
-                    if attempt < max_attempts - 1:
-                        await asyncio.sleep(2)
-                    else:
-                        return False
+        member_status = await get_member_status(chat_id, user_id)
+        if member_status is None:
+            return PREFIX_FAILED
+        user_is_admin = member_status in ADMIN_STATUSES
+
+        if user_is_admin and get_applied_title(chat_id, user_id) == prefix_to_set:
+            return PREFIX_UNCHANGED
+
+        if not user_is_admin:
+            admin_success = await make_user_admin_for_prefix(chat_id, user_id)
+            if not admin_success:
+                return PREFIX_FAILED
+
+        # Попробуем установить префикс несколько раз
+        max_attempts = 2
+        for attempt in range(max_attempts):
+            try:
+                await bot.set_chat_administrator_custom_title(
+                    chat_id=chat_id,
+                    user_id=user_id,
+                    custom_title=prefix_to_set
+                )
+                remember_applied_title(chat_id, user_id, prefix_to_set)
+                return PREFIX_UPDATED
 
-        except Exception as e:
-            return False
+            except Exception as e:
+                # Сразу после назначения админом Telegram может ещё не применить права
+                if attempt < max_attempts - 1:
+                    await asyncio.sleep(2)
+
+        return PREFIX_FAILED
 
     except Exception as e:
-        return False
+        return PREFIX_FAILED
+
+async def set_user_prefix(chat_id, user_id, points, is_owner=False):
+    """Устанавливает префикс пользователю - ИСПРАВЛЕННАЯ ВЕРСИЯ"""
+    return await apply_user_prefix(chat_id, user_id, points, is_owner) != PREFIX_FAILED
+
+async def reconcile_chat_prefixes(chat_id, on_progress=None):
+    """Обновляет префиксы чата, пропуская пользователей с уже актуальным префиксом"""
+    chat_points = get_chat_ledger(chat_id)
+    stats = {"total": len(chat_points), PREFIX_UPDATED: 0, PREFIX_UNCHANGED: 0, PREFIX_FAILED: 0}
+
+    for user_id, user_data in chat_points.items():
+        try:
+            with background_api_calls():
+                # Проверяем, является ли пользователь владельцем
+                is_owner = await is_chat_owner(chat_id, user_id)
+                result = await apply_user_prefix(chat_id, user_id, user_data["points"], is_owner)
+        except Exception as e:
+            print(f"❌ Ошибка при обновлении префикса для пользователя {user_id}: {e}")
+            result = PREFIX_FAILED
+
+        stats[result] += 1
+        if result == PREFIX_UNCHANGED:
+            continue
+
+        if result == PREFIX_UPDATED:
+            print(f"✅ Префикс обновлен для пользователя {user_id}")
+        else:
+            print(f"⚠️ Не удалось обновить префикс для пользователя {user_id}")
+
+        # Сообщаем о прогрессе каждые 5 реально обработанных пользователей
+        if on_progress and (stats[PREFIX_UPDATED] + stats[PREFIX_FAILED]) % 5 == 0:
+            await on_progress(stats)
+
+    return stats
 
 async def register_user_if_not_exists(chat_id, user_id, username):
     """Регистрирует пользователя в базе данных, если его там еще нет"""
     try:
-        chat_points = load_chat_data(chat_id)
+        chat_points = get_chat_ledger(chat_id)
 
-        if user_id not in chat_points:
-            chat_points[user_id] = {"username": username, "points": 0}
-            save_chat_data(chat_id, chat_points)
-            print(f"✅ Зарегистрирован новый пользователь: @{username} (ID: {user_id})")
+        if chat_points.register(user_id, username, reason="register"):
+            log_event(thanks_log, logging.INFO, "user registered", chat_id=chat_id, user_id=user_id, username=username)
             return True
+
+        if username and chat_points.get_username(user_id) != username:
+            chat_points.set_points(user_id, chat_points.get_points(user_id), username, reason="rename")
+            log_event(thanks_log, logging.INFO, "user renamed", chat_id=chat_id, user_id=user_id, username=username)
         return False
     except Exception as e:
         print(f"❌ Ошибка при регистрации пользователя {user_id}: {e}")
         return False
 
-async def change_user_points_by_reply(message, points_change, is_addition=True, reason=""):
-    """Изменяет баллы пользователя в ответ на сообщение и обновляет префикс"""
+async def change_user_points_by_reply(message, points_change, is_addition=True, reason="", target=None):
+    """Изменяет баллы пользователя (из ответа или target=(user_id, username)) и обновляет префикс"""
     chat_id = message.chat.id
 
-    if not message.reply_to_message:
-        return False, "❌ Эта команда должна быть отправлена в ответ на сообщение пользователя!"
-
-    target_user_id = message.reply_to_message.from_user.id
-    target_username = message.reply_to_message.from_user.username or message.reply_to_message.from_user.first_name or f"user_{target_user_id}"
+    if target:
+        target_user_id, target_username = target
+    elif message.reply_to_message:
+        target_user_id = message.reply_to_message.from_user.id
+        target_username = message.reply_to_message.from_user.username or message.reply_to_message.from_user.first_name or f"user_{target_user_id}"
+    else:
+        return False, "❌ Эта команда должна быть отправлена в ответ на сообщение пользователя или с @username!"
 
     # АВТОМАТИЧЕСКАЯ РЕГИСТРАЦИЯ ПОЛЬЗОВАТЕЛЯ, ЕСЛИ ЕГО НЕТ В БАЗЕ
     await register_user_if_not_exists(chat_id, target_user_id, target_username)
 
     try:
-        # Загружаем данные
-        chat_points = load_chat_data(chat_id)
-        chat_last_ranks = load_last_ranks(chat_id)
+        # Загружаем данные: сначала ранги (с ожиданием пула), затем чат - между получением чата и
+        # начислением не должно быть await, иначе чат могут вытеснить из кэша и изменение потеряется
+        chat_last_ranks = await load_in_pool(load_last_ranks, chat_id, get_rank_file(chat_id))
+        chat_points = get_chat_ledger(chat_id)
 
         # Теперь пользователь точно есть в базе (мы его зарегистрировали)
-        old_points = chat_points[target_user_id]["points"]
+        delta = points_change if is_addition else -points_change
+        old_points, new_points = chat_points.add_points(
+            target_user_id, delta, target_username,
+            sender_id=message.from_user.id, reason=reason or ("plus" if is_addition else "minus")
+        )
+        action_word = "добавлено" if is_addition else "вычтено"
         old_level = get_level(old_points)
 
-        if is_addition:
-            new_points = old_points + points_change
-            action_word = "добавлено"
-        else:
-            new_points = max(0, old_points - points_change)
-            action_word = "вычтено"
-
-        chat_points[target_user_id]["points"] = new_points
-
-        is_owner = False
-        try:
-            member_status = await bot.get_chat_member(chat_id, target_user_id)
-            is_owner = member_status.status in ['creator', 'владелец', 'Владелец']
-        except:
-            pass
+        is_owner = await is_chat_owner(chat_id, target_user_id)
 
         new_level = get_level(new_points)
 
-        # Сохраняем данные
-        save_chat_data(chat_id, chat_points)
-
         rank_change = ""
         if old_level != new_level and not is_owner:
             rank_change = f"\n🎉 Изменение ранга: {old_level} → {new_level}"
@@ -461,108 +2330,184 @@ print("★★☆ [15-29]")
 print("★★★ [30+]")
 print("="*50 + "\n")
 
+# Изменения данных одного чата выполняются строго по очереди, разные чаты - параллельно
+class ChatActor:
+    """Единственный исполнитель изменений для одного чата"""
+
+    def __init__(self, chat_key):
+        self.chat_key = chat_key
+        self.mailbox = deque()
+        self.task = None
+
+    def submit(self, func, args, kwargs):
+        future = asyncio.get_running_loop().create_future()
+        self.mailbox.append((func, args, kwargs, future))
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+        return future
+
+    async def run(self):
+        while self.mailbox:
+            func, args, kwargs, future = self.mailbox.popleft()
+            try:
+                result = await func(*args, **kwargs)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                if not future.done():
+                    future.set_result(result)
+        # Почтовый ящик пуст - освобождаем исполнителя (между проверкой и выходом нет await)
+        self.task = None
+        chat_actors.pop(self.chat_key, None)
+
+chat_actors = {}
+
+def run_in_chat(chat_id, func, *args, **kwargs):
+    """Ставит корутину func в очередь исполнителя чата, возвращает future с её результатом"""
+    chat_key = abs(chat_id)  # как в ledger_cache: старые файлы хранят id без минуса
+    actor = chat_actors.get(chat_key)
+    if actor is None:
+        actor = chat_actors[chat_key] = ChatActor(chat_key)
+    return actor.submit(func, args, kwargs)
+
 # НОВАЯ: Улучшенная функция для обработки благодарностей
-async def process_thank_task(chat_id, sender_id, target_user_id, target_username, message_id):
-    """Обрабатывает одну благодарность"""
-    print(f"🔄 Обработка благодарности: от {sender_id} для {target_user_id} в чате {chat_id}")
+class ThankBatch:
+    """Благодарности одному пользователю в одном чате, ожидающие обработки"""
+
+    def __init__(self, chat_id, target_user_id, target_username):
+        self.chat_id = chat_id
+        self.target_user_id = target_user_id
+        self.target_username = target_username
+        self.sender_ids = []
+        self.message_ids = []
+        self.futures = []
+        self.created = time.monotonic()
+
+    def add(self, sender_id, message_id, target_username):
+        self.sender_ids.append(sender_id)
+        self.message_ids.append(message_id)
+        self.target_username = target_username
+        future = asyncio.get_running_loop().create_future()
+        self.futures.append(future)
+        return future
+
+    def resolve(self, result):
+        for future in self.futures:
+            if not future.done():
+                future.set_result(result)
+
+# Ожидающие пачки по ключу (chat_id, target_user_id) и ключи, которые сейчас обрабатываются
+pending_thanks = {}
+thanks_in_flight = set()
+thank_workers = []
+
+async def process_thank_batch(batch):
+    """Обрабатывает пачку благодарностей: одно начисление, одна проверка ранга, один префикс"""
+    chat_id = batch.chat_id
+    target_user_id = batch.target_user_id
+    target_username = batch.target_username
+    count = len(batch.sender_ids)
 
     try:
         # Регистрируем пользователя если нужно
         await register_user_if_not_exists(chat_id, target_user_id, target_username)
 
-        # Загружаем данные
-        chat_points = load_chat_data(chat_id)
-        chat_last_ranks = load_last_ranks(chat_id)
+        # Загружаем данные: сначала ранги (с ожиданием пула), затем чат - между получением чата и
+        # начислением не должно быть await, иначе чат могут вытеснить из кэша и изменение потеряется
+        chat_last_ranks = await load_in_pool(load_last_ranks, chat_id, get_rank_file(chat_id))
+        chat_points = get_chat_ledger(chat_id)
 
-        # Получаем текущие баллы
-        if target_user_id not in chat_points:
-            chat_points[target_user_id] = {"username": target_username, "points": 0}
-
-        old_points = chat_points[target_user_id]["points"]
+        # Добавляем баллы за все благодарности пачки разом
+        sender_id = batch.sender_ids[0] if count == 1 else batch.sender_ids
+        old_points, new_points = chat_points.add_points(target_user_id, count, target_username,
+                                                        sender_id=sender_id, reason="thank")
         old_level = get_level(old_points)
-
-        # Добавляем балл
-        chat_points[target_user_id]["points"] = old_points + 1
-        new_points = chat_points[target_user_id]["points"]
         new_level = get_level(new_points)
 
-        print(f"📊 Начислен балл: {target_user_id} ({old_points} → {new_points})")
-
-        # Сохраняем данные
-        save_chat_data(chat_id, chat_points)
+        log_event(thanks_log, logging.INFO, "thanks applied", chat_id=chat_id, user_id=target_user_id,
+                  count=count, old=old_points, new=new_points)
 
         # Проверяем повышение ранга
         if old_level != new_level:
             chat_last_ranks[target_user_id] = new_level
             save_last_ranks(chat_id, chat_last_ranks)
-            print(f"🎉 Повышение ранга: {old_level} → {new_level}")
+            log_event(thanks_log, logging.INFO, "rank up", chat_id=chat_id, user_id=target_user_id,
+                      old_level=old_level, new_level=new_level)
 
         # Устанавливаем префикс
-        try:
-            member_status = await bot.get_chat_member(chat_id, target_user_id)
-            is_owner = member_status.status in ['creator', 'владелец', 'Владелец']
-        except:
-            is_owner = False
+        is_owner = await is_chat_owner(chat_id, target_user_id)
 
         if not is_owner:
             await set_user_prefix(chat_id, target_user_id, new_points, is_owner)
 
-        # Отправляем уведомление
+        # Отправляем одно уведомление на всю пачку (ответом на последнюю благодарность)
         try:
-            thank_msg = "✅ +1 балл за благодарность!"
-            msg = await bot.send_message(chat_id=chat_id, text=thank_msg, reply_to_message_id=message_id)
+            thank_msg = "✅ +1 балл за благодарность!" if count == 1 else f"✅ +{count} баллов за благодарности!"
+            msg = await bot.send_message(chat_id=chat_id, text=thank_msg, reply_to_message_id=batch.message_ids[-1])
 
             # Удаляем через 10 секунд
-            await asyncio.sleep(10)
-            try:
-                await bot.delete_message(chat_id=chat_id, message_id=msg.message_id)
-            except:
-                pass
+            deletion_scheduler.schedule(chat_id, [msg.message_id], 10)
         except Exception as e:
-            print(f"⚠️ Не удалось отправить уведомление: {e}")
+            log_event(thanks_log, logging.WARNING, "thank notice failed", chat_id=chat_id, error=str(e))
 
         # Если было повышение ранга, отправляем уведомление
         if old_level != new_level and not is_owner:
             await send_rankup_notification(chat_id, target_username, old_level, new_level)
 
-        print(f"✅ Благодарность успешно обработана")
         return True
 
-    except Exception as e:
-        print(f"❌ Ошибка при обработке благодарности: {e}")
-        import traceback
-        traceback.print_exc()
+    except Exception:
+        thanks_log.exception("thank batch failed", extra={"fields": {"chat_id": chat_id, "user_id": target_user_id}})
         return False
 
-# НОВАЯ: Функция для добавления задачи в очередь
-async def add_thank_to_queue(chat_id, sender_id, target_user_id, target_username, message_id):
-    """Добавляет благодарность в очередь на обработку"""
-    try:
-        # Создаем уникальный ключ для этой операции
-        operation_key = f"{chat_id}_{sender_id}_{target_user_id}_{time.time()}"
-
-        # Создаем задачу обработки
-        task = asyncio.create_task(
-            process_thank_task(chat_id, sender_id, target_user_id, target_username, message_id)
-        )
-
-        # Сохраняем задачу
-        async with processing_lock:
-            processing_tasks[operation_key] = task
-
-        # Ждем завершения задачи
-        result = await task
-
-        # Удаляем задачу из списка
-        async with processing_lock:
-            if operation_key in processing_tasks:
-                del processing_tasks[operation_key]
-
-        return result
-
-    except Exception as e:
-        print(f"❌ Ошибка при добавлении в очередь: {e}")
-        return False
+async def thank_worker():
+    """Забирает пачки из thank_queue и обрабатывает их"""
+    while True:
+        key = await thank_queue.get()
+        try:
+            # Даём время накопиться остальным благодарностям этому же человеку
+            batch = pending_thanks[key]
+            delay = batch.created + THANK_COALESCE_DELAY - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            # Саму обработку выполняет исполнитель чата, обработчик сразу берёт следующую пачку
+            batch = pending_thanks.pop(key)
+            thanks_in_flight.add(key)
+            future = run_in_chat(batch.chat_id, process_thank_batch, batch)
+            future.add_done_callback(lambda f, key=key, batch=batch: finish_thank_batch(key, batch, f))
+        except Exception as e:
+            print(f"❌ Ошибка в обработчике очереди благодарностей: {e}")
+        finally:
+            thank_queue.task_done()
+
+def finish_thank_batch(key, batch, future):
+    """Отдаёт результат ожидающим и ставит в очередь благодарности, пришедшие во время обработки"""
+    batch.resolve(False if future.cancelled() or future.exception() else future.result())
+    thanks_in_flight.discard(key)
+    if key in pending_thanks:
+        thank_queue.put_nowait(key)
+
+def start_thank_workers():
+    """Запускает обработчики очереди благодарностей (один раз)"""
+    if not thank_workers:
+        thank_workers.extend(asyncio.create_task(thank_worker()) for _ in range(THANK_WORKERS))
+
+# ИЗМЕНЕНО: Благодарность ставится в очередь, обработчик сообщения не ждёт её обработки
+def add_thank_to_queue(chat_id, sender_id, target_user_id, target_username, message_id):
+    """Добавляет благодарность в очередь, возвращает future с результатом обработки"""
+    start_thank_workers()
+
+    key = (chat_id, target_user_id)
+    batch = pending_thanks.get(key)
+    if batch is None:
+        batch = pending_thanks[key] = ThankBatch(chat_id, target_user_id, target_username)
+        # Пачку этого ключа, которая сейчас обрабатывается, поставит в очередь сам обработчик
+        if key not in thanks_in_flight:
+            thank_queue.put_nowait(key)
+
+    return batch.add(sender_id, message_id, target_username)
 
 async def send_rankup_notification(chat_id, username, old_rank, new_rank):
     old_stars = "★☆☆" if old_rank == "BASIC" else ("★★☆" if old_rank == "PRO" else "★★★")
@@ -580,53 +2525,134 @@ async def send_rankup_notification(chat_id, username, old_rank, new_rank):
 
     try:
         msg = await bot.send_message(chat_id=chat_id, text=notification_text)
-        await asyncio.sleep(RANKUP_DELETE_TIME)
-        await bot.delete_message(chat_id=chat_id, message_id=msg.message_id)
+        deletion_scheduler.schedule(chat_id, [msg.message_id], RANKUP_DELETE_TIME)
     except Exception as e:
         print(f"ERROR sending rankup notification: {e}")
 
-async def delete_command_with_delay(message, response_msg, delay=COMMAND_DELETE_TIME):
-    """Удаляет сообщения с задержкой"""
-    await asyncio.sleep(delay)
+# НОВОЕ: Одна очередь отложенных удалений вместо отдельной спящей задачи на каждое сообщение
+class DeletionScheduler:
+    """Куча (время, чат, сообщения), которую обслуживает одна задача"""
+
+    def __init__(self, path=PENDING_DELETIONS_FILE):
+        self.path = path
+        self.heap = []
+        self.seq = 0
+        self.wakeup = asyncio.Event()
+        self.dirty = False
+        self.saved_at = 0
+
+    def __len__(self):
+        return len(self.heap)
+
+    def schedule(self, chat_id, message_ids, delay):
+        """Планирует удаление сообщений чата через delay секунд"""
+        self.seq += 1
+        heapq.heappush(self.heap, (time.time() + delay, self.seq, chat_id, list(message_ids)))
+        self.dirty = True
+        self.wakeup.set()
+
+    def load(self):
+        """Восстанавливает очередь после перезапуска (просроченное удалится сразу)"""
+        if not os.path.exists(self.path):
+            return
+        try:
+            for due, chat_id, message_ids in read_json_file(self.path):
+                self.seq += 1
+                heapq.heappush(self.heap, (due, self.seq, chat_id, message_ids))
+            print(f"♻️ Восстановлено отложенных удалений: {len(self.heap)}")
+        except Exception as e:
+            print(f"ERROR loading pending deletions: {e}")
+
+    def save(self):
+        """Заказывает запись очереди в пуле storage_io"""
+        snapshot = [[due, chat_id, list(message_ids)] for due, _, chat_id, message_ids in self.heap]
+        storage_io.write(self.path, snapshot, "deletions", compact=True)
+        self.dirty = False
+        self.saved_at = time.time()
+
+    def pop_due(self):
+        """Забирает всё, что пора удалить (с запасом окна), сгруппированное по чатам"""
+        horizon = time.time() + DELETION_BATCH_WINDOW
+        due_by_chat = defaultdict(list)
+        # Ближайшее удаление уже наступило - заодно забираем соседей по окну
+        if self.heap and self.heap[0][0] <= time.time():
+            while self.heap and self.heap[0][0] <= horizon:
+                _, _, chat_id, message_ids = heapq.heappop(self.heap)
+                due_by_chat[chat_id].extend(message_ids)
+            self.dirty = True
+        return due_by_chat
+
+    async def delete_batch(self, chat_id, message_ids):
+        """Удаляет сообщения одним deleteMessages, при ошибке - по одному"""
+        try:
+            await bot.request("deleteMessages", {"chat_id": chat_id, "message_ids": json.dumps(message_ids)})
+            return
+        except Exception as e:
+            print(f"DEBUG: deleteMessages не сработал в чате {chat_id}: {e}")
 
-    try:
-        await bot.delete_message(chat_id=message.chat.id, message_id=message.message_id)
-        await bot.delete_message(chat_id=response_msg.chat.id, message_id=response_msg.message_id)
-    except Exception as e:
-        print(f"ERROR deleting messages: {e}")
+        for message_id in message_ids:
+            try:
+                await bot.delete_message(chat_id=chat_id, message_id=message_id)
+            except Exception as e:
+                print(f"ERROR deleting messages: {e}")
+
+    async def run(self):
+        """Единственная задача, которая выполняет все отложенные удаления"""
+        while True:
+            with background_api_calls():
+                for chat_id, message_ids in self.pop_due().items():
+                    # Telegram принимает не больше 100 сообщений за раз
+                    for i in range(0, len(message_ids), 100):
+                        await self.delete_batch(chat_id, message_ids[i:i + 100])
+
+            if self.dirty and time.time() - self.saved_at >= DELETION_SAVE_INTERVAL:
+                self.save()
+
+            timeout = max(0, self.saved_at + DELETION_SAVE_INTERVAL - time.time()) if self.dirty else None
+            if self.heap:
+                next_due = max(0, self.heap[0][0] - time.time())
+                timeout = next_due if timeout is None else min(timeout, next_due)
+
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+deletion_scheduler = DeletionScheduler()
+
+def delete_command_with_delay(message, response_msg, delay=COMMAND_DELETE_TIME):
+    """Планирует удаление команды и ответа бота через delay секунд"""
+    if message.chat.id == response_msg.chat.id:
+        deletion_scheduler.schedule(message.chat.id, [message.message_id, response_msg.message_id], delay)
+    else:
+        deletion_scheduler.schedule(message.chat.id, [message.message_id], delay)
+        deletion_scheduler.schedule(response_msg.chat.id, [response_msg.message_id], delay)
 
 async def register_all_chat_members(chat_id):
     """Регистрирует всех участников чата в базе данных с рейтингом 0"""
     try:
         print(f"🔄 Регистрирую всех участников чата {chat_id}")
 
-        # Получаем список участников чата
+        # Bot API отдаёт только администраторов - остальные регистрируются по сообщениям и вступлениям
         members_count = 0
         registered_count = 0
 
         try:
-            # Пробуем получить участников (может не работать в больших группах)
-            async for member in bot.get_chat_members(chat_id, limit=200):
-                members_count += 1
-                user_id = member.user.id
-                username = member.user.username or member.user.first_name or f"user_{user_id}"
-
-                # Загружаем текущие данные
-                chat_points = load_chat_data(chat_id)
-
-                # Если пользователя еще нет в базе, добавляем его
-                if user_id not in chat_points:
-                    chat_points[user_id] = {"username": username, "points": 0}
-                    registered_count += 1
-
-                # Сохраняем обновленные данные
-                save_chat_data(chat_id, chat_points)
-
-                # Небольшая задержка чтобы не спамить API
-                await asyncio.sleep(0.05)
+            admins = await bot.get_chat_administrators(chat_id)
+            members = [
+                (member.user.id, member.user.username or member.user.first_name or f"user_{member.user.id}")
+                for member in admins if not member.user.is_bot
+            ]
+            members_count = len(members)
+
+            # Одна запись в журнал и одно сохранение на весь список
+            registered_count, updated_count = get_chat_ledger(chat_id).register_many(members, reason="register_all")
+            if updated_count:
+                print(f"✏️ В чате {chat_id} обновлены имена: {updated_count}")
 
         except Exception as e:
-            print(f"⚠️ Не удалось получить всех участников чата {chat_id}: {e}")
+            print(f"⚠️ Не удалось получить участников чата {chat_id}: {e}")
 
         print(f"✅ В чате {chat_id}: {members_count} участников, зарегистрировано новых: {registered_count}")
         return registered_count
@@ -635,103 +2661,197 @@ async def register_all_chat_members(chat_id):
         print(f"❌ Ошибка при регистрации участников чата {chat_id}: {e}")
         return 0
 
-async def update_all_prefixes_on_start():
-    """Обновляет все префиксы при запуске бота"""
-    print("🔄 Начинаю обновление префиксов при запуске бота...")
-
-    # Ищем все файлы с данными чатов
-    points_files = glob.glob("points_*.json")
-
-    for points_file in points_files:
-        try:
-            # Извлекаем chat_id из имени файла
-            chat_id_str = points_file.replace("points_", "").replace(".json", "")
-            chat_id = int(chat_id_str)
+async def update_chat_prefixes_on_start(chat_id):
+    """Обновляет префиксы одного чата при запуске"""
+    # Загружаем данные чата (файл читается в пуле потоков)
+    await ledger_cache.preload(chat_id)
+    chat_points = get_chat_ledger(chat_id)
 
-            # Загружаем данные чата
-            chat_points = load_chat_data(chat_id)
+    if not chat_points:
+        return
 
-            if not chat_points:
-                continue
+    print(f"🔄 Обновляю префиксы для чата {chat_id} ({len(chat_points)} пользователей)")
 
-            print(f"🔄 Обновляю префиксы для чата {chat_id} ({len(chat_points)} пользователей)")
+    # Обновляем только отличающиеся префиксы
+    stats = await reconcile_chat_prefixes(chat_id)
+    print(f"✅ Чат {chat_id}: обновлено {stats[PREFIX_UPDATED]}, без изменений {stats[PREFIX_UNCHANGED]}, "
+          f"ошибок {stats[PREFIX_FAILED]}")
 
-            # Обновляем префиксы для каждого пользователя
-            for user_id, user_data in chat_points.items():
-                try:
-                    points = user_data["points"]
+async def send_restart_notice(chat_id):
+    """Уведомление о перезапуске в один чат (удаляется через 10 секунд)"""
+    try:
+        # Пытаемся отправить сообщение - если чат не найден, будет исключение
+        restart_msg = "🤖 Бот был перезапущен. Все префиксы обновлены!"
+        msg = await bot.send_message(chat_id=chat_id, text=restart_msg)
+        print(f"✅ Уведомление отправлено в чат {chat_id}")
 
-                    # Проверяем, является ли пользователь владельцем
-                    is_owner = False
-                    try:
-                        member_status = await bot.get_chat_member(chat_id, user_id)
-                        is_owner = member_status.status in ['creator', 'владелец', 'Владелец']
-                    except Exception as e:
-                        print(f"DEBUG: Не удалось получить статус пользователя {user_id}: {e}")
+        # Удаляем через 10 секунд, не задерживая остальные чаты
+        deletion_scheduler.schedule(chat_id, [msg.message_id], 10)
+        return True
 
-                    # Обновляем префикс
-                    prefix_success = await set_user_prefix(chat_id, user_id, points, is_owner)
-                    if prefix_success:
-                        print(f"✅ Префикс обновлен для пользователя {user_id}")
-                    else:
-                        print(f"⚠️ Не удалось обновить префикс для пользователя {user_id}")
+    except Exception as e:
+        # Проверяем, что это именно ошибка "Chat not found", а не другие ошибки
+        if "Chat not found" in str(e) or "чат не найден" in str(e).lower():
+            print(f"⚠️ Чат {chat_id} не найден (бот был удален из чата)")
+            chat_registry.set_bot_status(chat_id, "left")
+        elif "bot was kicked" in str(e).lower() or "bot is not a member" in str(e).lower():
+            print(f"⚠️ Бота удалили из чата {chat_id}")
+            chat_registry.set_bot_status(chat_id, "kicked")
+        elif "bot was blocked" in str(e).lower() or "бот заблокирован" in str(e).lower():
+            print(f"⚠️ Бот заблокирован в чате {chat_id}")
+        elif "chat not found" in str(e).lower():
+            print(f"⚠️ Чат {chat_id} не найден")
+        else:
+            print(f"❌ Не удалось отправить уведомление в чат {chat_id}: {e}")
+        return False
 
-                    await asyncio.sleep(0.5)  # Небольшая задержка чтобы не спамить API
+# НОВОЕ: Сверка чатов после запуска идёт в фоне по очереди с приоритетом
+class Reconciler:
+    """Сверяет префиксы и отправляет уведомление о перезапуске по чатам.
+    Порядок - недавно активные, затем крупные, затем спящие; прогресс переживает перезапуск"""
+
+    def __init__(self, path=RECONCILE_STATE_FILE):
+        self.path = path
+        self.heap = []
+        self.queued = {}  # chat_id -> приоритет; записи кучи с другим приоритетом устарели
+        self.running = set()
+        self.done = set()
+        self.failed = set()
+        self.resumed = 0
+        self.total = 0
+        self.started = None
+        self.finished = None
+        self.throttled = 0.0  # секунд ожидания из-за лимитов API
+        self.workers = []
+
+    def __len__(self):
+        return len(self.queued)
+
+    @staticmethod
+    def priority(chat_id, now):
+        record = chat_registry.get(chat_id) or {}
+        last_activity = record.get("last_activity") or 0
+        age = now - last_activity
+        if age < RECONCILE_RECENT:
+            return (0, -last_activity)
+        if age < CHAT_ACTIVE_DAYS * 86400:
+            return (1, -(record.get("members") or 0))
+        return (2, -last_activity)
+
+    def push(self, chat_id, priority):
+        self.queued[chat_id] = priority
+        heapq.heappush(self.heap, (priority, chat_id))
+
+    def pop(self):
+        while self.heap:
+            priority, chat_id = heapq.heappop(self.heap)
+            if self.queued.get(chat_id) == priority:
+                del self.queued[chat_id]
+                return chat_id
+        return None
 
-                except Exception as e:
-                    print(f"❌ Ошибка при обновлении префикса для пользователя {user_id}: {e}")
+    def promote(self, chat_id):
+        """В чате появилась активность - переносим его в начало очереди"""
+        priority = self.queued.get(chat_id)
+        if priority is not None and priority[0] > 0:
+            self.push(chat_id, (0, -time.time()))
 
+    def load_state(self):
+        storage_io.settle_now(self.path)
+        if not os.path.exists(self.path):
+            return None
+        try:
+            return read_json_file(self.path)
         except Exception as e:
-            print(f"❌ Ошибка при обработке файла {points_file}: {e}")
+            print(f"ERROR loading reconcile state: {e}")
+            return None
 
-    print("✅ Обновление префиксов завершено!")
+    def save_state(self):
+        state = {"started": self.started, "finished": self.finished,
+                 "done": sorted(self.done), "failed": sorted(self.failed)}
+        storage_io.write(self.path, state, "reconcile", compact=True)
 
-async def send_restart_notification():
-    """Отправляет уведомление о перезапуске во все чаты"""
-    print("📢 Отправляю уведомления о перезапуске...")
-
-    points_files = glob.glob("points_*.json")
-    successful_sends = 0
-    failed_sends = 0
-
-    for points_file in points_files:
-        try:
-            chat_id_str = points_file.replace("points_", "").replace(".json", "")
-            chat_id = int(chat_id_str)
+    def start(self, chat_ids, resume=True):
+        """Ставит чаты в очередь и запускает обработчики; незавершённая прошлая сверка продолжается"""
+        if self.is_running():
+            return False
+        now = time.time()
+        state = self.load_state() if resume else None
+        self.done, self.failed = set(), set()
+        self.started, self.finished = now, None
+        if state and not state.get("finished"):
+            self.done = set(state.get("done", []))
+            self.started = state.get("started") or now
+        self.resumed = len(self.done)
+        self.heap, self.queued = [], {}
+        for chat_id in chat_ids:
+            if chat_id not in self.done:
+                self.push(chat_id, self.priority(chat_id, now))
+        self.total = len(self.queued) + self.resumed
+        if self.resumed:
+            print(f"♻️ Сверка чатов: продолжаю с места остановки, уже обработано {self.resumed}/{self.total}")
+        print(f"🔄 Сверка чатов в фоне: {len(self.queued)} в очереди")
+        self.workers = [asyncio.create_task(self.worker()) for _ in range(min(RECONCILE_CONCURRENCY, len(self.queued)))]
+        if not self.workers:
+            self.finish()
+        return True
 
+    def is_running(self):
+        return any(not worker.done() for worker in self.workers)
+
+    async def wait_for_capacity(self):
+        """Пока пользователи ждут ответов или исчерпан общий лимит (в т.ч. после 429), новый чат не начинаем"""
+        while api_scheduler.interactive_waiting or api_scheduler.global_bucket.wait_time() > 0:
+            self.throttled += RECONCILE_BACKOFF
+            await asyncio.sleep(RECONCILE_BACKOFF)
+
+    async def worker(self):
+        while True:
+            chat_id = self.pop()
+            if chat_id is None:
+                break
+            await self.wait_for_capacity()
+            self.running.add(chat_id)
             try:
-                # Пытаемся отправить сообщение - если чат не найден, будет исключение
-                restart_msg = "🤖 Бот был перезапущен. Все префиксы обновлены!"
-                msg = await bot.send_message(chat_id=chat_id, text=restart_msg)
-                successful_sends += 1
-                print(f"✅ Уведомление отправлено в чат {chat_id}")
-
-                # Удаляем через 10 секунд
-                await asyncio.sleep(10)
-                try:
-                    await bot.delete_message(chat_id=chat_id, message_id=msg.message_id)
-                    print(f"✅ Уведомление удалено из чата {chat_id}")
-                except Exception as delete_e:
-                    print(f"⚠️ Не удалось удалить уведомление из чата {chat_id}: {delete_e}")
-
-                await asyncio.sleep(1)  # Задержка между чатами
-
+                with background_api_calls():
+                    await update_chat_prefixes_on_start(chat_id)
+                    if RESTART_NOTICE:
+                        await send_restart_notice(chat_id)
+                self.done.add(chat_id)
             except Exception as e:
-                failed_sends += 1
-                # Проверяем, что это именно ошибка "Chat not found", а не другие ошибки
-                if "Chat not found" in str(e) or "чат не найден" in str(e).lower():
-                    print(f"⚠️ Чат {chat_id} не найден (бот был удален из чата)")
-                elif "bot was blocked" in str(e).lower() or "бот заблокирован" in str(e).lower():
-                    print(f"⚠️ Бот заблокирован в чате {chat_id}")
-                elif "chat not found" in str(e).lower():
-                    print(f"⚠️ Чат {chat_id} не найден")
-                else:
-                    print(f"❌ Не удалось отправить уведомление в чат {chat_id}: {e}")
-
-        except Exception as e:
-            print(f"❌ Ошибка при обработке файла {points_file}: {e}")
-
-    print(f"✅ Уведомления о перезапуске отправлены! Успешно: {successful_sends}, Неудачно: {failed_sends}")
+                print(f"❌ Ошибка при сверке чата {chat_id}: {e}")
+                self.failed.add(chat_id)
+            finally:
+                self.running.discard(chat_id)
+            self.save_state()
+        if not self.queued and not self.running and self.finished is None:
+            self.finish()
+
+    def finish(self):
+        self.finished = time.time()
+        self.save_state()
+        print(f"✅ Сверка чатов завершена: {len(self.done)} успешно, {len(self.failed)} с ошибками")
+
+    def progress(self):
+        """Состояние для /reconcile и метрик"""
+        now = time.time()
+        processed = len(self.done) + len(self.failed)
+        elapsed = ((self.finished or now) - self.started) if self.started else 0
+        rate = (processed - self.resumed) / elapsed if elapsed else 0
+        return {
+            "total": self.total,
+            "done": len(self.done),
+            "failed": len(self.failed),
+            "pending": len(self.queued),
+            "running": len(self.running),
+            "elapsed": round(elapsed),
+            "eta": round(len(self.queued) / rate) if rate and self.finished is None else None,
+            "throttled": round(self.throttled),
+            "started": self.started is not None,
+            "finished": self.finished is not None,
+        }
+
+reconciler = Reconciler()
 
 # ДОБАВЛЕНО: Обработчик для новых участников чата
 @dp.message_handler(content_types=types.ContentTypes.NEW_CHAT_MEMBERS)
@@ -741,7 +2861,8 @@ async def on_new_chat_members(message: types.Message):
 
     print(f"🆕 Новые участники в чате {chat_id}")
 
-    # Обрабатываем всех новых участников
+    # Собираем всех новых участников, чтобы зарегистрировать их одной записью
+    new_members = []
     for new_member in message.new_chat_members:
         user_id = new_member.id
         username = new_member.username or new_member.first_name or f"user_{user_id}"
@@ -753,37 +2874,57 @@ async def on_new_chat_members(message: types.Message):
             await asyncio.sleep(2)
             continue
 
+        if new_member.is_bot:
+            continue
+
         print(f"🆕 Новый участник: @{username} (ID: {user_id})")
+        new_members.append((user_id, username))
 
-        # Регистрируем пользователя с рейтингом 0
-        registered = await register_user_if_not_exists(chat_id, user_id, username)
+    if not new_members:
+        return
 
-        if registered:
-            # Даем небольшую задержку перед установкой префикса
-            await asyncio.sleep(2)
+    # Регистрируем пользователей с рейтингом 0
+    chat_points = get_chat_ledger(chat_id)
+    unknown = [(user_id, username) for user_id, username in new_members if user_id not in chat_points]
+    try:
+        inserted, updated = chat_points.register_many(new_members, reason="join")
+        print(f"✅ Зарегистрировано новых участников: {inserted}, обновлено имён: {updated}")
+    except Exception as e:
+        print(f"❌ Ошибка при регистрации новых участников в чате {chat_id}: {e}")
+        return
 
-            # Проверяем, является ли пользователь владельцем
-            is_owner = False
-            try:
-                member_status = await bot.get_chat_member(chat_id, user_id)
-                is_owner = member_status.status == 'creator'
-            except Exception as e:
-                print(f"DEBUG: Не удалось получить статус пользователя {user_id}: {e}")
+    for user_id, username in unknown:
+        # Проверяем, является ли пользователь владельцем
+        is_owner = await is_chat_owner(chat_id, user_id)
 
-            # Устанавливаем префикс
-            prefix_success = await set_user_prefix(chat_id, user_id, 0, is_owner)
+        # Устанавливаем префикс
+        prefix_success = await set_user_prefix(chat_id, user_id, 0, is_owner)
 
-            if prefix_success:
-                print(f"✅ Автоматически установлен префикс новому участнику @{username}")
-            else:
-                print(f"⚠️ Не удалось установить префикс новому участнику @{username}")
+        if prefix_success:
+            print(f"✅ Автоматически установлен префикс новому участнику @{username}")
+        else:
+            print(f"⚠️ Не удалось установить префикс новому участнику @{username}")
+
+# НОВОЕ: Поддерживаем кэш администраторов в актуальном состоянии
+@dp.chat_member_handler()
+async def on_chat_member_updated(update: types.ChatMemberUpdated):
+    """Изменился статус участника (назначен/снят админ, вышел и т.п.)"""
+    new_member = update.new_chat_member
+    chat_rosters[update.chat.id].set_member(
+        new_member.user.id, new_member.status, getattr(new_member, "custom_title", None)
+    )
 
-        # Небольшая задержка между обработкой участников
-        await asyncio.sleep(1)
+@dp.my_chat_member_handler()
+async def on_my_chat_member_updated(update: types.ChatMemberUpdated):
+    """Изменились права самого бота - кэш чата больше не надёжен (статус в реестре обновил ChatRegistryMiddleware)"""
+    chat_rosters[update.chat.id].invalidate()
+    if update.new_chat_member.status not in BOT_PRESENT_STATUSES:
+        print(f"👋 Бот больше не в чате {update.chat.id} ({update.new_chat_member.status})")
+        chat_registry.save()
 
 @dp.message_handler(lambda message: message.chat.type == 'private')
 async def block_private_messages(message: types.Message):
-    print(f"BLOCKED: Private message from {message.from_user.id}: {message.text}")
+    log_event(access_log, logging.INFO, "private message blocked", user_id=message.from_user.id)
     return
 
 async def is_creator(user_id):
@@ -803,46 +2944,40 @@ async def check_thank_message(message: types.Message):
     if not message.reply_to_message:
         return
 
-    # Логируем входящее сообщение
-    print(f"📥 Получено сообщение от {message.from_user.id} в чате {message.chat.id}")
-    print(f"📝 Текст: '{message.text[:50]}...'")
+    # Логируем входящее сообщение (категория rating.messages ограничена по частоте)
+    log_event(messages_log, logging.DEBUG, "reply received", chat_id=message.chat.id,
+              user_id=message.from_user.id, text=message.text[:50])
+
+    # Проверяем наличие слов благодарности
+    if not contains_thank_word(message.text, message.chat.id):
+        return
 
-    # Проверяем кулдаун (быстрая проверка) - ВСЕГДА РАЗРЕШАЕМ
+    # Кулдаун проверяем только для настоящих благодарностей
     can_thank, wait_time = await can_thank_now(message.chat.id, message.from_user.id)
 
     if not can_thank:
-        print(f"⏰ Кулдаун для {message.from_user.id}: {wait_time} сек")
-        return
-
-    # Проверяем наличие слов благодарности
-    if not contains_thank_word(message.text):
+        log_event(thanks_log, logging.INFO, "thank cooldown", chat_id=message.chat.id,
+                  user_id=message.from_user.id, wait=wait_time)
         return
 
     # Получаем информацию о целевом пользователе
     target_user_id = message.reply_to_message.from_user.id
     target_username = message.reply_to_message.from_user.username or message.reply_to_message.from_user.first_name or f"user_{target_user_id}"
 
-    print(f"🎯 Начинаю обработку благодарности: {message.from_user.id} → {target_user_id}")
-
-    # Добавляем в очередь на обработку
+    # Добавляем в очередь на обработку и сразу освобождаем обработчик
     try:
-        success = await add_thank_to_queue(
+        add_thank_to_queue(
             chat_id=message.chat.id,
             sender_id=message.from_user.id,
             target_user_id=target_user_id,
             target_username=target_username,
             message_id=message.message_id
         )
+        log_event(thanks_log, logging.INFO, "thank queued", chat_id=message.chat.id,
+                  sender_id=message.from_user.id, user_id=target_user_id)
 
-        if success:
-            print(f"✅ Благодарность добавлена в очередь успешно")
-        else:
-            print(f"❌ Ошибка при добавлении в очередь")
-
-    except Exception as e:
-        print(f"🔥 КРИТИЧЕСКАЯ ОШИБКА в обработчике: {e}")
-        import traceback
-        traceback.print_exc()
+    except Exception:
+        thanks_log.exception("thank handler failed", extra={"fields": {"chat_id": message.chat.id}})
 
 @dp.message_handler(commands=["help", "start"])
 async def help_command(message: types.Message):
@@ -857,19 +2992,23 @@ async def help_command(message: types.Message):
 /add или /plus - добавить балл участнику (ответом на его сообщение)
 /plus 10 за хорошее поведение - добавить 10 баллов (ответом на сообщение, только создатель)*
 /minus 5 за опоздание - вычесть 5 баллов (ответом на сообщение, только создатель)*
+/plus @username 10 - то же без ответа на сообщение*
 
 📊 Информация:
 /my - мой профиль (баллы и статус) - удаляется через 10 секунд
 /top - ТОП-5 участников чата - удаляется через 60 секунд
+/top 20 - первые 20 мест, /top page 3 - третья страница рейтинга
 /info - информация о системе репутации - удаляется через 60 секунд
 
 ⚙️ Админ-команды:
 /update - обновить префиксы ВСЕХ участников (только создатель)*
+/words - слова благодарности этого чата: /words add слово, /words del слово (только создатель)*
+/reconcile - ход фоновой сверки чатов после запуска, /reconcile restart - сверить заново (только создатель)*
 
 🤖 Автоматически:
 • При входе в группу участник автоматически получает префикс ★☆☆ [0]
 • Баллы добавляются при словах: спасибо, благодарю, спс, саул, от души, мерси, спасибки и др.
-✅ Благодарить можно сколько угодно раз!
+⏰ Благодарить можно раз в {THANK_COOLDOWN // 60} минут
 ✅ +1 балл за благодарность удаляется через 10 секунд
 
 ⭐ ФОРМАТ ПРЕФИКСОВ:
@@ -888,7 +3027,7 @@ async def help_command(message: types.Message):
    Формат: /minus 5 за опоздание{creator_info}"""
 
     msg = await message.reply(help_text)
-    asyncio.create_task(delete_command_with_delay(message, msg, 60))
+    delete_command_with_delay(message, msg, 60)
 
 @dp.message_handler(commands=["info"])
 async def info(message: types.Message):
@@ -920,13 +3059,13 @@ async def info(message: types.Message):
 • Бот сам сделает вас администратором при начислении баллов
 
 🎉 Правила:
-• Благодарить можно сколько угодно раз!
+• Благодарить можно раз в {THANK_COOLDOWN // 60} минут
 • При повышении ранга все участники увидят праздничное уведомление! 🎉
 
 👑 Создатель: ID {CREATOR_ID}"""
 
     msg = await message.reply(info_text)
-    asyncio.create_task(delete_command_with_delay(message, msg, 60))
+    delete_command_with_delay(message, msg, 60)
 
 @dp.message_handler(commands=["add", "pa", "добавить"])
 async def add_points(message: types.Message):
@@ -935,14 +3074,15 @@ async def add_points(message: types.Message):
 
     if not message.reply_to_message:
         msg = await message.reply("↩️ Ответьте этой командой на сообщение участника, чтобы добавить ему балл.")
-        asyncio.create_task(delete_command_with_delay(message, msg, 5))
+        delete_command_with_delay(message, msg, 5)
         return
 
     target_user_id = message.reply_to_message.from_user.id
     target_username = message.reply_to_message.from_user.username or message.reply_to_message.from_user.first_name or f"user_{target_user_id}"
 
     # Используем ту же систему обработки что и для благодарностей
-    print(f"🔄 Обработка команды /add для {target_user_id}")
+    log_event(thanks_log, logging.INFO, "add command", chat_id=message.chat.id,
+              sender_id=message.from_user.id, user_id=target_user_id)
 
     success = await add_thank_to_queue(
         chat_id=message.chat.id,
@@ -953,22 +3093,17 @@ async def add_points(message: types.Message):
     )
 
     if success:
-        chat_points = load_chat_data(message.chat.id)
+        chat_points = get_chat_ledger(message.chat.id)
         if target_user_id in chat_points:
-            new_points = chat_points[target_user_id]["points"]
+            new_points = chat_points.get_points(target_user_id)
 
-            is_owner = False
-            try:
-                member_status = await bot.get_chat_member(message.chat.id, target_user_id)
-                is_owner = member_status.status in ['creator', 'владелец', 'Владелец']
-            except:
-                pass
+            is_owner = await is_chat_owner(message.chat.id, target_user_id)
 
             new_rank_display = get_rank_display(new_points, is_owner=is_owner)
 
             status_msg = f"✅ {new_rank_display}\n└─ @{target_username if target_username.startswith('@') else f'@{target_username}' if '@' not in target_username else target_username}"
             msg = await message.reply(status_msg)
-            asyncio.create_task(delete_command_with_delay(message, msg))
+            delete_command_with_delay(message, msg)
 
 @dp.message_handler(commands=["plus"])
 async def plus_points(message: types.Message):
@@ -978,13 +3113,24 @@ async def plus_points(message: types.Message):
     if not await is_creator(message.from_user.id):
         print(f"BLOCKED: Пользователь {message.from_user.id} пытался использовать /plus")
         msg = await message.reply("❌ Эта команда доступна только создателю бота!")
-        asyncio.create_task(delete_command_with_delay(message, msg, 5))
+        delete_command_with_delay(message, msg, 5)
         return
 
+    # Без ответа на сообщение цель берётся из упоминания: /plus @username 10 причина
+    target = None
+    command_args = message.text
     if not message.reply_to_message:
+        target, command_args = await resolve_command_target(message)
+
+    if not message.reply_to_message and target is None and MENTION_ARG_RE.match(message.get_args().strip()):
+        msg = await message.reply("❌ Пользователь не найден в рейтинге чата. Ответьте на его сообщение.")
+        delete_command_with_delay(message, msg, 10)
+        return
+
+    if not message.reply_to_message and target is None:
         help_text = """➕ Добавление баллов пользователю (только создатель):
 
-Эта команда работает ТОЛЬКО как ответ на сообщение!
+Ответьте на сообщение пользователя или укажите его @username.
 
 Формат:
 /plus 10 за хорошее поведение
@@ -996,29 +3142,30 @@ async def plus_points(message: types.Message):
 2. Напишите: /plus 10 за активность
 3. Пользователь получит 10 баллов
 
-⚠️ Важно: Команда работает только как ответ на сообщение!"""
+Или без ответа: /plus @username 10 за активность"""
 
         msg = await message.reply(help_text)
-        asyncio.create_task(delete_command_with_delay(message, msg, 15))
+        delete_command_with_delay(message, msg, 15)
         return
 
     # Извлекаем баллы и причину из команды
-    points, reason = extract_points_from_command(message.text)
+    points, reason = extract_points_from_command(command_args)
 
     if points <= 0:
         msg = await message.reply("❌ Неверный формат. Используйте: /plus N причина\nПример: /plus 10 за хорошее поведение")
-        asyncio.create_task(delete_command_with_delay(message, msg, 5))
+        delete_command_with_delay(message, msg, 5)
         return
 
     if points > 1000:
         msg = await message.reply("⚠️ Слишком много баллов за раз. Максимум 1000 за одну операцию.")
-        asyncio.create_task(delete_command_with_delay(message, msg, 5))
+        delete_command_with_delay(message, msg, 5)
         return
 
-    success, result_msg = await change_user_points_by_reply(message, points, is_addition=True, reason=reason)
+    success, result_msg = await run_in_chat(message.chat.id, change_user_points_by_reply,
+                                            message, points, is_addition=True, reason=reason, target=target)
 
     msg = await message.reply(result_msg)
-    asyncio.create_task(delete_command_with_delay(message, msg))
+    delete_command_with_delay(message, msg)
 
 @dp.message_handler(commands=["minus"])
 async def minus_points(message: types.Message):
@@ -1028,13 +3175,24 @@ async def minus_points(message: types.Message):
     if not await is_creator(message.from_user.id):
         print(f"BLOCKED: Пользователь {message.from_user.id} пытался использовать /minus")
         msg = await message.reply("❌ Эта команда доступна только создателю бота!")
-        asyncio.create_task(delete_command_with_delay(message, msg, 5))
+        delete_command_with_delay(message, msg, 5)
         return
 
+    # Без ответа на сообщение цель берётся из упоминания: /minus @username 10 причина
+    target = None
+    command_args = message.text
     if not message.reply_to_message:
+        target, command_args = await resolve_command_target(message)
+
+    if not message.reply_to_message and target is None and MENTION_ARG_RE.match(message.get_args().strip()):
+        msg = await message.reply("❌ Пользователь не найден в рейтинге чата. Ответьте на его сообщение.")
+        delete_command_with_delay(message, msg, 10)
+        return
+
+    if not message.reply_to_message and target is None:
         help_text = """➖ Вычитание баллов у пользователя (только создатель):
 
-Эта команда работает ТОЛЬКО как ответ на сообщение!
+Ответьте на сообщение пользователя или укажите его @username.
 
 Формат:
 /minus 10 за плохое поведение
@@ -1046,29 +3204,30 @@ async def minus_points(message: types.Message):
 2. Напишите: /minus 5 за опоздание
 3. У пользователя вычтут 5 баллов
 
-⚠️ Важно: Команда работает только как ответ на сообщение!"""
+Или без ответа: /minus @username 5 за опоздание"""
 
         msg = await message.reply(help_text)
-        asyncio.create_task(delete_command_with_delay(message, msg, 15))
+        delete_command_with_delay(message, msg, 15)
         return
 
     # Извлекаем баллы и причину из команды
-    points, reason = extract_points_from_command(message.text)
+    points, reason = extract_points_from_command(command_args)
 
     if points <= 0:
         msg = await message.reply("❌ Неверный формат. Используйте: /minus N причина\nПример: /minus 10 за плохое поведение")
-        asyncio.create_task(delete_command_with_delay(message, msg, 5))
+        delete_command_with_delay(message, msg, 5)
         return
 
     if points > 1000:
         msg = await message.reply("⚠️ Слишком много баллов за раз. Максимум 1000 за одну операцию.")
-        asyncio.create_task(delete_command_with_delay(message, msg, 5))
+        delete_command_with_delay(message, msg, 5)
         return
 
-    success, result_msg = await change_user_points_by_reply(message, points, is_addition=False, reason=reason)
+    success, result_msg = await run_in_chat(message.chat.id, change_user_points_by_reply,
+                                            message, points, is_addition=False, reason=reason, target=target)
 
     msg = await message.reply(result_msg)
-    asyncio.create_task(delete_command_with_delay(message, msg))
+    delete_command_with_delay(message, msg)
 
 @dp.message_handler(commands=["my", "me", "profile"])
 async def my_profile(message: types.Message):
@@ -1082,19 +3241,10 @@ async def my_profile(message: types.Message):
     # АВТОМАТИЧЕСКАЯ РЕГИСТРАЦИЯ ПОЛЬЗОВАТЕЛЯ, ЕСЛИ ЕГО НЕТ В БАЗЕ
     await register_user_if_not_exists(chat_id, user_id, username)
 
-    chat_points = load_chat_data(chat_id)
+    chat_points = get_chat_ledger(chat_id)
+    user_balance = chat_points.get_points(user_id)
 
-    if user_id in chat_points:
-        user_balance = chat_points[user_id]['points']
-    else:
-        user_balance = 0
-
-    is_owner = False
-    try:
-        member_status = await bot.get_chat_member(chat_id, user_id)
-        is_owner = member_status.status in ['creator', 'владелец', 'Владелец']
-    except Exception as e:
-        print(f"ERROR checking owner status: {e}")
+    is_owner = await is_chat_owner(chat_id, user_id)
 
     user_rank = get_rank_display(user_balance, is_owner=is_owner)
 
@@ -1117,7 +3267,12 @@ async def my_profile(message: types.Message):
     profile_text = "👤 ПРОФИЛЬ УЧАСТНИКА\n\n"
     profile_text += f"🆔 ID: {user_id}\n"
     profile_text += f"📛 Имя: @{username}\n"
-    profile_text += f"🏆 Баллы: {user_balance}\n\n"
+    profile_text += f"🏆 Баллы: {user_balance}\n"
+    leaderboard = chat_points.leaderboard()
+    position = leaderboard.rank(user_id)
+    if position:
+        profile_text += f"🏅 Место в рейтинге: #{position} из {len(leaderboard)}\n"
+    profile_text += "\n"
     profile_text += f"⭐ Текущий статус:\n{user_rank}\n\n"
 
     if points_to_next > 0:
@@ -1135,7 +3290,7 @@ async def my_profile(message: types.Message):
     profile_text += "\n💡 Совет: Помогайте другим участникам\nи получайте благодарности для повышения репутации!"
 
     msg = await message.reply(profile_text)
-    asyncio.create_task(delete_command_with_delay(message, msg, 10))  # 10 секунд для /my
+    delete_command_with_delay(message, msg, 10)  # 10 секунд для /my
 
 @dp.message_handler(commands=["top", "рейтинг", "лидеры"])
 async def top_players(message: types.Message):
@@ -1143,31 +3298,48 @@ async def top_players(message: types.Message):
         return
 
     chat_id = message.chat.id
-    chat_points = load_chat_data(chat_id)
+    chat_points = get_chat_ledger(chat_id)
 
     if not chat_points:
         msg = await message.reply("📭 Рейтинг пуст\nПока никто не получил баллов.")
-        asyncio.create_task(delete_command_with_delay(message, msg, 10))
+        delete_command_with_delay(message, msg, 10)
+        return
+
+    # /top, /top 20 или /top page 3
+    args = message.get_args().split()
+    limit, offset = TOP_DEFAULT_SIZE, 0
+    try:
+        if len(args) == 2 and args[0].lower() in ("page", "стр", "страница"):
+            page = max(1, int(args[1]))
+            limit, offset = TOP_PAGE_SIZE, (page - 1) * TOP_PAGE_SIZE
+        elif len(args) == 1:
+            limit = min(max(1, int(args[0])), TOP_MAX_SIZE)
+        elif args:
+            raise ValueError
+    except ValueError:
+        msg = await message.reply(f"❌ Используйте: /top, /top 20 (до {TOP_MAX_SIZE}) или /top page 2")
+        delete_command_with_delay(message, msg, 10)
         return
 
-    sorted_users = sorted(
-        chat_points.items(),
-        key=lambda x: x[1]['points'],
-        reverse=True
-    )[:5]
+    leaderboard = chat_points.leaderboard()
+    total_players = len(leaderboard)
+    entries = leaderboard.top(limit, offset)
+
+    if not entries:
+        msg = await message.reply(f"📭 На этой странице никого нет\nВсего участников: {total_players}")
+        delete_command_with_delay(message, msg, 10)
+        return
 
-    top_text = "🏆 ТОП-5 УЧАСТНИКОВ\n\n"
+    if offset:
+        pages = (total_players + TOP_PAGE_SIZE - 1) // TOP_PAGE_SIZE
+        top_text = f"🏆 РЕЙТИНГ: места {offset + 1}-{offset + len(entries)} (страница {offset // TOP_PAGE_SIZE + 1} из {pages})\n\n"
+    else:
+        top_text = f"🏆 ТОП-{limit} УЧАСТНИКОВ\n\n"
 
-    for i, (user_id, user_data) in enumerate(sorted_users, 1):
-        points = user_data['points']
-        username = user_data.get('username', f"user_{user_id}")
+    for i, user_id, points in entries:
+        username = chat_points.get_username(user_id, f"user_{user_id}")
 
-        is_owner = False
-        try:
-            member_status = await bot.get_chat_member(chat_id, user_id)
-            is_owner = member_status.status in ['creator', 'владелец', 'Владелец']
-        except:
-            pass
+        is_owner = await is_chat_owner(chat_id, user_id)
 
         rank_display = get_rank_display(points, is_owner=is_owner)
 
@@ -1184,16 +3356,14 @@ async def top_players(message: types.Message):
         top_text += f"{medal}{i}. {user_display}\n"
         top_text += f"   └─ {rank_display}\n\n"
 
-    total_players = len(chat_points)
-
-    # Подсчитываем пользователей с 0 баллами
-    zero_points_players = sum(1 for user_data in chat_points.values() if user_data['points'] == 0)
+    # Пользователи с 0 баллами считаются индексом, без прохода по всему чату
+    zero_points_players = leaderboard.zero_count
 
     top_text += f"📊 Статистика:\n• Всего участников: {total_players}\n• С 0 баллами: {zero_points_players}\n\n"
     top_text += f"💡 Новые участники автоматически получают префикс ★☆☆ [0]"
 
     msg = await message.reply(top_text, parse_mode="HTML")
-    asyncio.create_task(delete_command_with_delay(message, msg, 60))  # 60 секунд для /top
+    delete_command_with_delay(message, msg, 60)  # 60 секунд для /top
 
 # ИЗМЕНЕНО: Команда /update теперь регистрирует всех участников и обновляет префиксы
 @dp.message_handler(commands=["update", "u"])
@@ -1204,7 +3374,7 @@ async def update_prefix(message: types.Message):
     if not await is_creator(message.from_user.id):
         print(f"BLOCKED: Пользователь {message.from_user.id} пытался использовать /update")
         msg = await message.reply("❌ Эта команда доступна только создателю бота!")
-        asyncio.create_task(delete_command_with_delay(message, msg, 5))
+        delete_command_with_delay(message, msg, 5)
         return
 
     chat_id = message.chat.id
@@ -1217,7 +3387,7 @@ async def update_prefix(message: types.Message):
         registered = await register_all_chat_members(chat_id)
 
         # Загружаем данные чата
-        chat_points = load_chat_data(chat_id)
+        chat_points = get_chat_ledger(chat_id)
 
         if not chat_points:
             await bot.edit_message_text(
@@ -1225,57 +3395,33 @@ async def update_prefix(message: types.Message):
                 message_id=status_msg.message_id,
                 text="❌ В чате нет зарегистрированных участников"
             )
-            asyncio.create_task(delete_command_with_delay(message, status_msg, 10))
+            delete_command_with_delay(message, status_msg, 10)
             return
 
         print(f"🔄 Обновляю префиксы для чата {chat_id} ({len(chat_points)} пользователей)")
 
-        updated_count = 0
-        failed_count = 0
+        # Перечитываем список админов, чтобы сравнивать с тем, что реально стоит в Telegram
+        chat_rosters[chat_id].invalidate()
 
-        # Обновляем префиксы для каждого пользователя
-        for user_id, user_data in chat_points.items():
-            try:
-                points = user_data["points"]
-
-                # Проверяем, является ли пользователь владельцем
-                is_owner = False
-                try:
-                    member_status = await bot.get_chat_member(chat_id, user_id)
-                    is_owner = member_status.status in ['creator', 'владелец', 'Владелец']
-                except Exception as e:
-                    print(f"DEBUG: Не удалось получить статус пользователя {user_id}: {e}")
-
-                # Обновляем префикс
-                prefix_success = await set_user_prefix(chat_id, user_id, points, is_owner)
-                if prefix_success:
-                    updated_count += 1
-                    print(f"✅ Префикс обновлен для пользователя {user_id}")
-                else:
-                    failed_count += 1
-                    print(f"⚠️ Не удалось обновить префикс для пользователя {user_id}")
-
-                # Обновляем статус каждые 5 пользователей
-                if (updated_count + failed_count) % 5 == 0:
-                    await bot.edit_message_text(
-                        chat_id=chat_id,
-                        message_id=status_msg.message_id,
-                        text=f"🔄 Обновление префиксов...\nОбработано: {updated_count + failed_count}/{len(chat_points)}\nУспешно: {updated_count}, Неудачно: {failed_count}"
-                    )
-
-                await asyncio.sleep(0.5)  # Небольшая задержка чтобы не спамить API
+        async def report_progress(stats):
+            done = stats[PREFIX_UPDATED] + stats[PREFIX_FAILED] + stats[PREFIX_UNCHANGED]
+            await bot.edit_message_text(
+                chat_id=chat_id,
+                message_id=status_msg.message_id,
+                text=f"🔄 Обновление префиксов...\nОбработано: {done}/{stats['total']}\nУспешно: {stats[PREFIX_UPDATED]}, Неудачно: {stats[PREFIX_FAILED]}"
+            )
 
-            except Exception as e:
-                failed_count += 1
-                print(f"❌ Ошибка при обновлении префикса для пользователя {user_id}: {e}")
+        # Обновляем только отличающиеся префиксы
+        stats = await reconcile_chat_prefixes(chat_id, on_progress=report_progress)
 
         # Финальное сообщение
         result_text = f"""✅ Обновление префиксов завершено!
 
 📊 Статистика:
 👥 Всего участников: {len(chat_points)}
-✅ Успешно обновлено: {updated_count}
-❌ Не удалось обновить: {failed_count}
+✅ Успешно обновлено: {stats[PREFIX_UPDATED]}
+⏸ Без изменений: {stats[PREFIX_UNCHANGED]}
+❌ Не удалось обновить: {stats[PREFIX_FAILED]}
 ➕ Зарегистрировано новых: {registered}
 
 💡 Не удачные обновления обычно происходят из-за:
@@ -1290,7 +3436,7 @@ async def update_prefix(message: types.Message):
         )
 
         # Удаляем сообщения через 30 секунд
-        asyncio.create_task(delete_command_with_delay(message, status_msg, 30))
+        delete_command_with_delay(message, status_msg, 30)
 
     except Exception as e:
         await bot.edit_message_text(
@@ -1298,16 +3444,507 @@ async def update_prefix(message: types.Message):
             message_id=status_msg.message_id,
             text=f"❌ Ошибка при обновлении префиксов: {str(e)[:100]}..."
         )
-        asyncio.create_task(delete_command_with_delay(message, status_msg, 10))
+        delete_command_with_delay(message, status_msg, 10)
+
+@dp.message_handler(commands=["words"])
+async def thank_words_command(message: types.Message):
+    if message.chat.type == 'private':
+        return
+
+    if not await is_creator(message.from_user.id):
+        print(f"BLOCKED: Пользователь {message.from_user.id} пытался использовать /words")
+        msg = await message.reply("❌ Эта команда доступна только создателю бота!")
+        delete_command_with_delay(message, msg, 5)
+        return
+
+    chat_id = message.chat.id
+    words = list(custom_thank_words.get(chat_id, []))
+    parts = message.get_args().split(maxsplit=1)
+
+    if len(parts) == 2 and parts[0] in ("add", "del"):
+        word = parts[1].strip().lower()
+        if parts[0] == "add" and word not in words:
+            words.append(word)
+        elif parts[0] == "del" and word in words:
+            words.remove(word)
+        set_chat_thank_words(chat_id, words)
+
+    words_text = ", ".join(words) if words else "нет"
+    msg = await message.reply(f"💬 Слова благодарности чата: {words_text}\n\n"
+                              f"Общие слова: {', '.join(THANK_WORDS)}\n\n"
+                              f"Формат: /words add слово | /words del слово")
+    delete_command_with_delay(message, msg, 30)
+
+# НОВОЕ: Состояние всех процессов-шардов (межшардовая команда)
+@dp.message_handler(commands=["shards"])
+async def shards_command(message: types.Message):
+    if message.chat.type == 'private':
+        return
+
+    if not await is_creator(message.from_user.id):
+        print(f"BLOCKED: Пользователь {message.from_user.id} пытался использовать /shards")
+        msg = await message.reply("❌ Эта команда доступна только создателю бота!")
+        delete_command_with_delay(message, msg, 5)
+        return
+
+    try:
+        results = await shard_link.request("stats") if shard_link else [shard_stats()]
+    except asyncio.TimeoutError:
+        msg = await message.reply("⚠️ Не все шарды ответили вовремя")
+        delete_command_with_delay(message, msg, 10)
+        return
+
+    text = f"🧩 ШАРДЫ: {len(results)}\n\n"
+    for stats in sorted(results, key=lambda item: item["shard"]):
+        text += (f"#{stats['shard']}: чатов в реестре {stats['registered_chats']}, в памяти {stats['chats']}, "
+                 f"участников {stats['users']}, "
+                 f"благодарностей в очереди {stats['pending_thanks']}, удалений {stats['pending_deletions']}\n")
+    msg = await message.reply(text)
+    delete_command_with_delay(message, msg, 30)
+
+# НОВОЕ: Прогресс фоновой сверки чатов (/reconcile, /reconcile restart - начать новую полную сверку)
+@dp.message_handler(commands=["reconcile"])
+async def reconcile_command(message: types.Message):
+    if message.chat.type == 'private':
+        return
+
+    if not await is_creator(message.from_user.id):
+        print(f"BLOCKED: Пользователь {message.from_user.id} пытался использовать /reconcile")
+        msg = await message.reply("❌ Эта команда доступна только создателю бота!")
+        delete_command_with_delay(message, msg, 5)
+        return
+
+    restart = message.get_args().strip().lower() in ("restart", "заново")
+    try:
+        results = await shard_link.request("reconcile", [restart]) if shard_link else [await reconcile_shard(restart)]
+    except asyncio.TimeoutError:
+        msg = await message.reply("⚠️ Не все шарды ответили вовремя")
+        delete_command_with_delay(message, msg, 10)
+        return
+
+    text = "🔄 СВЕРКА ЧАТОВ\n\n"
+    for progress in sorted(results, key=lambda item: item["shard"]):
+        if not progress["started"]:
+            state = "не запускалась"
+        elif progress["finished"]:
+            state = "завершена"
+        else:
+            state = f"идёт, осталось ~{progress['eta']} с" if progress["eta"] else "идёт"
+        if len(results) > 1:
+            text += f"#{progress['shard']}: "
+        text += (f"{state}\nГотово {progress['done']}/{progress['total']}, ошибок {progress['failed']}, "
+                 f"в очереди {progress['pending']}, сейчас {progress['running']}\n"
+                 f"Прошло {progress['elapsed']} с, ожидание лимитов API {progress['throttled']} с\n")
+    msg = await message.reply(text)
+    delete_command_with_delay(message, msg, 30)
 
 @dp.message_handler()
 async def catch_all_messages(message: types.Message):
     if message.chat.type == 'private':
-        print(f"BLOCKED: Private message from {message.from_user.id}")
+        log_event(access_log, logging.INFO, "private message blocked", user_id=message.from_user.id)
         return
-    print(f"DEBUG: Message in chat {message.chat.id} from {message.from_user.id}")
+    log_event(messages_log, logging.DEBUG, "message", chat_id=message.chat.id, user_id=message.from_user.id)
+
+# Очереди и отложенные операции - считаются в момент запроса /metrics
+metrics.gauge("rating_thank_queue_depth", "Ключей в thank_queue", lambda: thank_queue.qsize())
+metrics.gauge("rating_thank_batches_pending", "Пачек благодарностей, ожидающих обработчика", lambda: len(pending_thanks))
+metrics.gauge("rating_thanks_pending", "Благодарностей в ожидающих пачках",
+              lambda: sum(len(batch.sender_ids) for batch in pending_thanks.values()))
+metrics.gauge("rating_thank_batches_in_flight", "Пачек благодарностей в обработке", lambda: len(thanks_in_flight))
+metrics.gauge("rating_chat_actor_backlog", "Операций в очередях исполнителей чатов",
+              lambda: sum(len(actor.mailbox) for actor in chat_actors.values()))
+metrics.gauge("rating_pending_deletions", "Сообщений, ожидающих отложенного удаления",
+              lambda: sum(len(message_ids) for _, _, _, message_ids in deletion_scheduler.heap))
+metrics.gauge("rating_ledgers_loaded", "Чатов в памяти", lambda: len(ledger_cache.ledgers))
+metrics.gauge("rating_chats_registered", "Чатов в реестре", lambda: len(chat_registry))
+metrics.gauge("rating_reconcile_pending", "Чатов в очереди фоновой сверки", lambda: len(reconciler))
+metrics.gauge("rating_reconcile_running", "Чатов, которые сверяются сейчас", lambda: len(reconciler.running))
+metrics.gauge("rating_reconcile_done", "Чатов, сверенных в текущем проходе", lambda: len(reconciler.done))
+metrics.gauge("rating_reconcile_failed", "Чатов, сверка которых завершилась ошибкой", lambda: len(reconciler.failed))
+metrics.gauge("rating_log_records_dropped", "Записей лога, отброшенных из-за переполненной очереди",
+              lambda: log_queue_handler.dropped)
+metrics.gauge("rating_storage_writes_pending", "Файлов, ожидающих записи в пуле storage_io", lambda: len(storage_io))
+
+# Запускаем обновление префиксов и отправку уведомлений при старте
+async def on_startup(dp):
+    await start_metrics_server()
+    restore_from_journal()
+    thank_cooldowns.load(THANK_COOLDOWN_SNAPSHOT_FILE)
+    deletion_scheduler.load()
+    asyncio.create_task(deletion_scheduler.run())
+    asyncio.create_task(ledger_flush_loop())
+    asyncio.create_task(journal_snapshot_loop())
+    start_thank_workers()
+    reconciler.start(list_chat_ids())
+
+async def on_shutdown(dp):
+    deletion_scheduler.save()
+    chat_registry.save()
+    await points_journal.snapshot_async()
+    thank_cooldowns.save(THANK_COOLDOWN_SNAPSHOT_FILE)
+    print("💾 Данные сохранены на диск")
+    if log_queue_handler.dropped:
+        print(f"⚠️ Записей лога отброшено из-за переполненной очереди: {log_queue_handler.dropped}")
+
+# НОВОЕ: Шардирование - управляющий процесс принимает обновления и раздаёт их процессам по чатам
+def shard_stats():
+    """Состояние этого процесса для /shards"""
+    return {
+        "shard": SHARD_ID,
+        "chats": len(ledger_cache.ledgers),
+        "users": sum(len(ledger) for ledger in ledger_cache.ledgers.values()),
+        "pending_thanks": len(pending_thanks),
+        "pending_deletions": len(deletion_scheduler),
+        "registered_chats": len(chat_registry),
+        "reconcile": reconciler.progress(),
+    }
+
+async def flush_shard():
+    return ledger_cache.flush_all()
+
+async def stats_shard():
+    return shard_stats()
+
+async def reload_thank_words_shard():
+    reload_custom_thank_words()
+    return True
+
+async def reconcile_shard(restart=False):
+    """Прогресс сверки этого процесса (restart - начать новую полную сверку, если текущая закончена)"""
+    if restart:
+        reconciler.start(list_chat_ids(), resume=False)
+    return {"shard": SHARD_ID, **reconciler.progress()}
+
+# Команды, которые управляющий процесс может разослать шардам
+SHARD_COMMANDS = {
+    "stats": stats_shard,
+    "flush": flush_shard,
+    "reload_thank_words": reload_thank_words_shard,
+    "reconcile": reconcile_shard,
+}
+
+def update_chat_id(update):
+    """chat_id из обновления в виде словаря (None, если чата нет)"""
+    for key in ("message", "edited_message", "channel_post", "chat_member", "my_chat_member", "chat_join_request"):
+        if key in update:
+            return update[key].get("chat", {}).get("id")
+    if "callback_query" in update:
+        return update["callback_query"].get("message", {}).get("chat", {}).get("id")
+    return None
+
+class ShardLink:
+    """Связь процесса-шарда с управляющим процессом: входящие обновления и команды, исходящие ответы"""
+
+    def __init__(self, inbox, outbox):
+        self.inbox = inbox
+        self.outbox = outbox
+        self.pending = {}
+        self.ids = itertools.count(1)
+
+    async def request(self, name, args=None):
+        """Выполняет команду на всех шардах, возвращает список их ответов"""
+        request_id = next(self.ids)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        self.outbox.put(("request", SHARD_ID, request_id, name, args))
+        try:
+            return await asyncio.wait_for(future, SHARD_COMMAND_TIMEOUT)
+        finally:
+            self.pending.pop(request_id, None)
+
+    def broadcast(self, name, args=None):
+        """Рассылает команду остальным шардам без ожидания ответа"""
+        self.outbox.put(("broadcast", SHARD_ID, None, name, args))
+
+    async def run_command(self, request_id, name, args):
+        try:
+            handler = SHARD_COMMANDS[name]
+            result = await (handler(*args) if args else handler())
+        except Exception as e:
+            print(f"❌ Ошибка межшардовой команды {name}: {e}")
+            result = None
+        if request_id is not None:
+            self.outbox.put(("reply", request_id, SHARD_ID, result))
+
+    async def serve(self):
+        """Читает входящие сообщения, пока не придёт команда остановки"""
+        loop = asyncio.get_running_loop()
+        while True:
+            kind, *payload = await loop.run_in_executor(None, self.inbox.get)
+            if kind == "update":
+                asyncio.create_task(dp.process_update(types.Update(**payload[0])))
+            elif kind == "command":
+                asyncio.create_task(self.run_command(*payload))
+            elif kind == "result":
+                request_id, results = payload
+                future = self.pending.get(request_id)
+                if future is not None and not future.done():
+                    future.set_result(results)
+            elif kind == "stop":
+                return
+
+shard_link = None
+
+def run_shard_worker(inbox, outbox):
+    """Точка входа процесса-шарда"""
+    global shard_link
+    # Останавливает шард управляющий процесс, Ctrl+C здесь не обрабатываем
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    shard_link = ShardLink(inbox, outbox)
+
+    async def main():
+        Bot.set_current(bot)
+        Dispatcher.set_current(dp)
+        await on_startup(dp)
+        try:
+            await shard_link.serve()
+        finally:
+            await on_shutdown(dp)
+            session = await bot.get_session()
+            await session.close()
+
+    print(f"🧩 Шард {SHARD_ID} из {SHARD_COUNT} запущен (PID {os.getpid()})")
+    asyncio.run(main())
+
+class ShardSupervisor:
+    """Управляющий процесс: запускает шарды, раздаёт обновления и пересылает межшардовые команды"""
+
+    def __init__(self, count):
+        self.count = count
+        self.context = multiprocessing.get_context("spawn")
+        self.inboxes = [self.context.Queue(maxsize=WEBHOOK_QUEUE_SIZE) for _ in range(count)]
+        self.outbox = self.context.Queue()
+        self.processes = []
+        self.replies = {}
+        self.loop = None
+
+    def start(self):
+        for shard_id, inbox in enumerate(self.inboxes):
+            # Дочерний процесс читает номер шарда из окружения при импорте модуля
+            os.environ[SHARD_ENV] = f"{shard_id}/{self.count}"
+            process = self.context.Process(target=run_shard_worker, args=(inbox, self.outbox),
+                                           name=f"rating-shard-{shard_id}", daemon=True)
+            process.start()
+            self.processes.append(process)
+        os.environ.pop(SHARD_ENV, None)
+
+    def route(self, update):
+        """Кладёт обновление в очередь шарда его чата; False - очередь шарда переполнена"""
+        shard_id = abs(int(update_chat_id(update) or 0)) % self.count
+        try:
+            self.inboxes[shard_id].put_nowait(("update", update))
+            return True
+        except queue.Full:
+            return False
+
+    def listen(self):
+        """Запускает поток, читающий ответы шардов (daemon - не мешает завершению процесса)"""
+        loop = self.loop = asyncio.get_running_loop()
+
+        def read():
+            while True:
+                message = self.outbox.get()
+                loop.call_soon_threadsafe(self.handle_message, message)
+
+        threading.Thread(target=read, name="shard-replies", daemon=True).start()
+
+    def deliver(self, inbox, message):
+        """Кладёт сообщение в очередь шарда, не блокируя цикл событий: при переполнении повторяет позже"""
+        try:
+            inbox.put_nowait(message)
+        except queue.Full:
+            self.loop.call_later(SHARD_RETRY_DELAY, self.deliver, inbox, message)
+
+    def handle_message(self, message):
+        """Пересылает межшардовые команды и собирает ответы"""
+        kind, *payload = message
+        if kind == "request":
+            shard_id, request_id, name, args = payload
+            key = (shard_id, request_id)
+            self.replies[key] = []
+            for inbox in self.inboxes:
+                self.deliver(inbox, ("command", key, name, args))
+        elif kind == "broadcast":
+            shard_id, _, name, args = payload
+            for other_id, inbox in enumerate(self.inboxes):
+                if other_id != shard_id:
+                    self.deliver(inbox, ("command", None, name, args))
+        elif kind == "reply":
+            key, _, result = payload
+            key = tuple(key)
+            results = self.replies.get(key)
+            if results is None:
+                return
+            results.append(result)
+            if len(results) == self.count:
+                del self.replies[key]
+                self.deliver(self.inboxes[key[0]], ("result", key[1], results))
+
+    def stop(self):
+        for inbox in self.inboxes:
+            inbox.put(("stop",))
+        for process in self.processes:
+            process.join(timeout=30)
+            if process.is_alive():
+                process.terminate()
+        # Шарды остановлены - недоставленное в очередях больше не нужно, не ждём его при выходе
+        for channel in self.inboxes + [self.outbox]:
+            channel.cancel_join_thread()
+
+async def poll_and_route(supervisor):
+    """Long polling в управляющем процессе: обновления сразу уходят шардам"""
+    supervisor.listen()
+
+    # Как skip_updates=True: пропускаем накопившееся за время простоя
+    updates = await bot.get_updates(offset=-1, timeout=1)
+    offset = updates[-1].update_id + 1 if updates else None
+
+    while True:
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=30, allowed_updates=ALLOWED_UPDATES)
+        except Exception as e:
+            print(f"⚠️ Ошибка получения обновлений: {e}")
+            await asyncio.sleep(5)
+            continue
+
+        for update in updates:
+            offset = update.update_id + 1
+            # Очередь шарда заполнена - ждём, а не теряем обновление
+            while not supervisor.route(update.to_python()):
+                await asyncio.sleep(SHARD_RETRY_DELAY)
+
+def run_sharded(count):
+    """Запускает count процессов-шардов и принимает обновления в этом процессе"""
+    supervisor = ShardSupervisor(count)
+    supervisor.start()
+    print(f"🧩 Запущено шардов: {count}")
+    try:
+        if "--webhook" in sys.argv:
+            run_webhook(router=supervisor)
+        else:
+            asyncio.run(poll_and_route(supervisor))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print("🛑 Останавливаю шарды...")
+        supervisor.stop()
+
+# НОВОЕ: Приём обновлений через webhook (aiohttp) с ограниченной очередью перед диспетчером
+class WebhookServer:
+    """HTTP-приёмник обновлений: проверяет секрет, кладёт обновление в очередь и сразу отвечает"""
+
+    def __init__(self, dispatcher, path=WEBHOOK_PATH, secret=WEBHOOK_SECRET,
+                 queue_size=WEBHOOK_QUEUE_SIZE, workers=WEBHOOK_WORKERS, router=None):
+        self.dispatcher = dispatcher
+        self.router = router  # ShardSupervisor: обновления уходят процессам-шардам, а не в диспетчер
+        self.path = path
+        self.secret = secret
+        self.queue_size = queue_size
+        self.workers_count = workers
+        self.queue = None
+        self.workers = []
+        self.rejected = 0
+
+    def create_app(self):
+        app = web.Application()
+        app.router.add_post(self.path, self.handle)
+        app.on_startup.append(self.start)
+        app.on_shutdown.append(self.stop)
+        return app
+
+    async def handle(self, request):
+        if self.secret and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != self.secret:
+            return web.Response(status=403)
+
+        try:
+            data = await request.json()
+            update = data if self.router else types.Update(**data)
+        except Exception:
+            return web.Response(status=400)
+
+        if self.router:
+            if not self.router.route(update):
+                self.rejected += 1
+                return web.Response(status=503)
+            return web.Response(text="ok")
+
+        try:
+            self.queue.put_nowait(update)
+        except asyncio.QueueFull:
+            # Telegram повторит доставку позже - так очередь не растёт без предела
+            self.rejected += 1
+            return web.Response(status=503)
+        return web.Response(text="ok")
+
+    async def worker(self):
+        Bot.set_current(self.dispatcher.bot)
+        Dispatcher.set_current(self.dispatcher)
+        while True:
+            update = await self.queue.get()
+            try:
+                await self.dispatcher.process_update(update)
+            except Exception as e:
+                print(f"❌ Ошибка при обработке обновления {update.update_id}: {e}")
+            finally:
+                self.queue.task_done()
+
+    async def start(self, app):
+        if self.router:
+            self.router.listen()
+            return
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        self.workers = [asyncio.create_task(self.worker()) for _ in range(self.workers_count)]
+
+    async def stop(self, app):
+        if self.router:
+            return
+        # Дорабатываем уже принятые обновления, затем останавливаем обработчики
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout=10)
+        except asyncio.TimeoutError:
+            print(f"⚠️ Не обработано обновлений при остановке: {self.queue.qsize()}")
+        for task in self.workers:
+            task.cancel()
+
+def run_webhook(router=None):
+    """Запускает бота в режиме webhook (с router - как приёмник для процессов-шардов)"""
+    host = cli_option("--host", WEBHOOK_HOST)
+    port = int(cli_option("--port", WEBHOOK_PORT))
+    path = cli_option("--path", WEBHOOK_PATH)
+    url = cli_option("--url", WEBHOOK_URL)
+    secret = cli_option("--secret", WEBHOOK_SECRET)
+
+    server = WebhookServer(dp, path=path, secret=secret, router=router)
+    app = server.create_app()
+
+    async def app_startup(app):
+        Bot.set_current(bot)
+        Dispatcher.set_current(dp)
+        # Данные чатов при шардировании обслуживают процессы-шарды
+        if router is None:
+            await on_startup(dp)
+        if url:
+            await bot.set_webhook(url.rstrip("/") + path, secret_token=secret or None,
+                                  allowed_updates=ALLOWED_UPDATES, drop_pending_updates=True)
+            print(f"🌐 Webhook зарегистрирован: {url.rstrip('/') + path}")
+
+    async def app_shutdown(app):
+        if router is None:
+            await on_shutdown(dp)
+        session = await bot.get_session()
+        await session.close()
+
+    app.on_startup.insert(0, app_startup)
+    app.on_shutdown.append(app_shutdown)
+
+    print(f"🌐 Режим webhook: http://{host}:{port}{path}")
+    web.run_app(app, host=host, port=port)
 
 if __name__ == '__main__':
+    if "--import-json" in sys.argv:
+        import_json_to_sqlite()
+        sys.exit(0)
+
     print("=" * 60)
     print("🤖 БОТ ЗАПУЩЕН С ОБНОВЛЁННОЙ СИСТЕМОЙ РЕПУТАЦИИ!")
     print("=" * 60)
@@ -1333,28 +3970,38 @@ if __name__ == '__main__':
     print("   /help - все команды")
     print("   /my - мой профиль (удаляется через 10 секунд)")
     print("   /top - топ-5 участников (удаляется через 60 секунд)")
+    print("   /top 20, /top page 3 - больше мест и страницы рейтинга")
     print("   /add - добавить балл (ответом на сообщение)")
     print("   /info - о системе (удаляется через 60 секунд)")
     print("\n🔐 ЗАЩИЩЕННЫЕ КОМАНДЫ (ТОЛЬКО СОЗДАТЕЛЬ):")
     print(f"   /plus N причина - добавить N баллов (создатель: {CREATOR_ID})")
     print(f"   /minus N причина - вычесть N баллов (создатель: {CREATOR_ID})")
     print(f"   /update - обновить префиксы всех участников (создатель: {CREATOR_ID})")
+    print(f"   /reconcile - ход фоновой сверки чатов (создатель: {CREATOR_ID})")
     print("\n⚠️ ВАЖНО О КОМАНДАХ /PLUS И /MINUS:")
     print("   • Работают ТОЛЬКО как ответ на сообщение")
     print("   • Формат: /plus 10 за хорошее поведение")
     print("   • Формат: /minus 5 за опоздание")
-    print("\n🔄 ПРИ ЗАПУСКЕ БОТА:")
-    print("   1. Обновляются все префиксы участников")
-    print("   2. Отправляется уведомление о перезапуске во все чаты")
+    print("\n🌐 РЕЖИМ РАБОТЫ:")
+    print("   • python rating.py - long polling")
+    print("   • python rating.py --webhook [--port 8080 --path /webhook --url https://... --secret ...]")
+    print("   • python rating.py --shards 4 [--webhook] - чаты делятся между 4 процессами")
+    print("   • python rating.py --api-base http://127.0.0.1:8081 - свой сервер Bot API (tools/fake_bot_api.py)")
+    print("\n🔄 ПРИ ЗАПУСКЕ БОТА (в фоне, бот отвечает сразу):")
+    print("   1. Сверяются префиксы участников - сначала активные чаты, затем крупные, затем спящие")
+    print("   2. После сверки чата в него отправляется уведомление о перезапуске")
     print("   3. Уведомление удаляется через 10 секунд")
     print("\n💬 Автоматическое повышение при словах:")
     print(f"   {', '.join(THANK_WORDS[:6])}...")
-    print("   • Теперь благодарить можно сколько угодно раз!")
+    print(f"   • Благодарить можно раз в {THANK_COOLDOWN // 60} минут")
+    if bot.server is not TELEGRAM_PRODUCTION:
+        print(f"\n🧪 Bot API: {bot.server.base.split('/bot')[0]}")
     print("=" * 60)
 
-    # Запускаем обновление префиксов и отправку уведомлений при старте
-    async def on_startup(dp):
-        await update_all_prefixes_on_start()
-        await send_restart_notification()
-
-    executor.start_polling(dp, skip_updates=True, on_startup=on_startup)
\ No newline at end of file
+    if int(cli_option("--shards", 1)) > 1:
+        run_sharded(int(cli_option("--shards")))
+    elif "--webhook" in sys.argv:
+        run_webhook()
+    else:
+        executor.start_polling(dp, skip_updates=True, on_startup=on_startup, on_shutdown=on_shutdown,
+                               allowed_updates=ALLOWED_UPDATES)
@@ -0,0 +1,60 @@
+#────────────────────────────── ❑ ──────────────────────────────
+# Проверки лимитов ApiScheduler: сообщения в группу не чаще лимита Telegram
+# Запуск из корня репозитория: python -m unittest discover tests
+#────────────────────────────── ❑ ──────────────────────────────
+import os
+import io
+import sys
+import unittest
+import unittest.mock
+import contextlib
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)  # rating.py читает token.txt, lang.txt и translations.json из текущей папки
+
+with contextlib.redirect_stdout(io.StringIO()):
+    import rating
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+class GroupLimitTest(unittest.TestCase):
+    def send_greedily(self, bucket, clock, seconds, step=0.1):
+        """Отправляет, как только лимит позволяет; возвращает моменты отправки"""
+        sent = []
+        end = clock.now + seconds
+        while clock.now < end:
+            if bucket.wait_time() <= 0:
+                bucket.take()
+                sent.append(clock.now)
+            else:
+                clock.now += step
+        return sent
+
+    def test_group_never_exceeds_limit_per_minute(self):
+        clock = FakeClock()
+        with unittest.mock.patch.object(rating.time, "monotonic", clock):
+            bucket = rating.ApiScheduler().chat_bucket(-100)
+            sent = self.send_greedily(bucket, clock, 180)
+        limit = rating.API_GROUP_MESSAGES_PER_MINUTE
+        # В любом окне в 60 секунд - не больше лимита
+        for i, started in enumerate(sent):
+            self.assertLessEqual(sum(1 for at in sent[i:] if at < started + 60), limit)
+        self.assertGreaterEqual(len(sent), 3 * limit)
+
+    def test_block_after_retry_after(self):
+        clock = FakeClock()
+        with unittest.mock.patch.object(rating.time, "monotonic", clock):
+            bucket = rating.ApiScheduler().chat_bucket(-100)
+            bucket.block(5)
+            self.assertAlmostEqual(bucket.wait_time(), 5)
+            clock.now += 5
+            self.assertEqual(bucket.wait_time(), 0)
+
+if __name__ == '__main__':
+    unittest.main()
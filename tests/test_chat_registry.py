@@ -0,0 +1,66 @@
+#────────────────────────────── ❑ ──────────────────────────────
+# Проверки ChatRegistry: в реестре и в сверке только группы
+# Запуск из корня репозитория: python -m unittest discover tests
+#────────────────────────────── ❑ ──────────────────────────────
+import os
+import io
+import sys
+import json
+import shutil
+import asyncio
+import tempfile
+import unittest
+import unittest.mock
+import contextlib
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)  # rating.py читает token.txt, lang.txt и translations.json из текущей папки
+
+with contextlib.redirect_stdout(io.StringIO()):
+    import rating
+from aiogram import types
+
+def chat_record(chat_type, bot_status="member"):
+    return {"title": None, "type": chat_type, "first_seen": 1.0, "last_activity": 1.0,
+            "bot_status": bot_status, "members": None}
+
+class ChatRegistryTest(unittest.TestCase):
+    def setUp(self):
+        work_dir = tempfile.mkdtemp(prefix="rating_registry_")
+        self.addCleanup(shutil.rmtree, work_dir, True)
+        self.path = os.path.join(work_dir, "chats.json")
+
+    def test_old_registry_is_cleaned(self):
+        with open(self.path, "w", encoding="utf-8") as f:
+            json.dump({"-100": chat_record("supergroup"), "-200": chat_record(None), "300": chat_record("private"),
+                       "-1001": chat_record("channel")}, f)
+        registry = rating.ChatRegistry(self.path)
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertEqual(sorted(registry.chat_ids()), [-200, -100])
+            self.assertEqual(sorted(registry.chat_ids(active_only=False)), [-200, -100])
+            registry.save()
+        rating.storage_io.wait()
+        with open(self.path, encoding="utf-8") as f:
+            self.assertEqual(sorted(json.load(f)), ["-100", "-200"])
+
+    def test_private_my_chat_member_is_ignored(self):
+        registry = rating.ChatRegistry(self.path)
+        registry.chats = {}
+        update = types.ChatMemberUpdated(**{
+            "chat": {"id": 300, "type": "private", "first_name": "user"},
+            "from": {"id": 300, "is_bot": False, "first_name": "user"}, "date": 1,
+            "old_chat_member": {"user": {"id": 1, "is_bot": True, "first_name": "bot"}, "status": "kicked"},
+            "new_chat_member": {"user": {"id": 1, "is_bot": True, "first_name": "bot"}, "status": "member"},
+        })
+        with unittest.mock.patch.object(rating, "chat_registry", registry):
+            asyncio.run(rating.ChatRegistryMiddleware().on_pre_process_my_chat_member(update, {}))
+            self.assertEqual(registry.chat_ids(active_only=False), [])
+
+            update.chat.type = "supergroup"
+            update.chat.id = -300
+            asyncio.run(rating.ChatRegistryMiddleware().on_pre_process_my_chat_member(update, {}))
+            self.assertEqual(registry.chat_ids(), [-300])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+#────────────────────────────── ❑ ──────────────────────────────
+# Проверки ColumnarUsers: записи ведут себя как прежний словарь словарей
+# Запуск из корня репозитория: python -m unittest discover tests
+#────────────────────────────── ❑ ──────────────────────────────
+import os
+import io
+import sys
+import unittest
+import contextlib
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)  # rating.py читает token.txt, lang.txt и translations.json из текущей папки
+
+with contextlib.redirect_stdout(io.StringIO()):
+    import rating
+
+class ColumnarUsersTest(unittest.TestCase):
+    def test_matches_dict_of_dicts(self):
+        data = {1: {"username": "alice", "points": 5, "title": "PRO"}, 2: {"username": "bob", "points": 0}}
+        users = rating.ColumnarUsers(data)
+        self.assertEqual({user_id: dict(record) for user_id, record in users.items()}, data)
+        self.assertEqual(users.snapshot(), {str(k): v for k, v in data.items()})
+
+    def test_empty_username(self):
+        for username in ("", None):
+            with self.subTest(username=username):
+                users = rating.ColumnarUsers({1: {"username": username, "points": 3}})
+                self.assertEqual(users[1]["username"], username)
+                self.assertEqual(dict(users[1]), {"username": username, "points": 3})
+                self.assertEqual(users.snapshot(), {"1": {"username": username, "points": 3}})
+
+                ledger = rating.ChatLedger(-1, users)
+                self.assertEqual(ledger.get_username(1), username)
+                self.assertIsNone(ledger.find_user(""))
+
+    def test_empty_username_is_replaced_on_rename(self):
+        ledger = rating.ChatLedger(-1, {1: {"username": "", "points": 3}})
+        ledger.store(1, 4, "carol")
+        self.assertEqual(ledger.users[1]["username"], "carol")
+        self.assertEqual(ledger.find_user("@Carol"), 1)
+
+    def test_swap_remove(self):
+        users = rating.ColumnarUsers({1: {"username": "a", "points": 1}, 2: {"username": "", "points": 2},
+                                      3: {"username": "c", "points": 3}})
+        del users[1]
+        self.assertEqual(sorted(users), [2, 3])
+        self.assertEqual(dict(users[2]), {"username": "", "points": 2})
+        self.assertEqual(dict(users[3]), {"username": "c", "points": 3})
+
+if __name__ == '__main__':
+    unittest.main()
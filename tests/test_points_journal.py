@@ -0,0 +1,71 @@
+#────────────────────────────── ❑ ──────────────────────────────
+# Проверки снимка журнала: неудачная запись файла баллов не теряет изменения
+# Запуск из корня репозитория: python -m unittest discover tests
+#────────────────────────────── ❑ ──────────────────────────────
+import os
+import io
+import sys
+import shutil
+import tempfile
+import unittest
+import unittest.mock
+import contextlib
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)  # rating.py читает token.txt, lang.txt и translations.json из текущей папки
+
+with contextlib.redirect_stdout(io.StringIO()):
+    import rating
+
+CHAT_ID = -100
+
+class SnapshotFailureTest(unittest.TestCase):
+    def setUp(self):
+        work_dir = tempfile.mkdtemp(prefix="rating_journal_")
+        self.addCleanup(shutil.rmtree, work_dir, True)
+        os.chdir(work_dir)
+        self.addCleanup(os.chdir, ROOT)
+
+        self.journal = rating.PointsJournal()
+        self.addCleanup(self.journal.rotate)  # закрывает файл журнала
+        for name, value in (("points_journal", self.journal), ("ledger_cache", rating.LedgerCache(10)),
+                            ("sqlite_storage", None)):
+            patcher = unittest.mock.patch.object(rating, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def saved_points(self):
+        return rating.load_chat_data(CHAT_ID).get(7, {}).get("points")
+
+    def test_failed_write_keeps_journal_and_retries(self):
+        rating.get_chat_ledger(CHAT_ID).set_points(7, 5, "user7")
+
+        disk_full = OSError(28, "No space left on device")
+        with unittest.mock.patch.object(rating, "write_json_atomic", side_effect=disk_full), \
+                contextlib.redirect_stdout(io.StringIO()):
+            self.journal.snapshot()
+
+        # Файл не записан: журнал снимка остаётся, чат снова помечен изменённым
+        self.assertIsNone(self.saved_points())
+        self.assertTrue(os.path.exists(self.journal.rotated_path))
+        self.assertGreater(rating.get_chat_ledger(CHAT_ID).dirty, 0)
+
+        # Журнал по-прежнему восстанавливает баллы
+        with unittest.mock.patch.object(rating, "ledger_cache", rating.LedgerCache(10)):
+            self.journal.replay()
+            self.assertEqual(rating.get_chat_ledger(CHAT_ID).get_points(7), 5)
+
+        # Следующий снимок повторяет запись и только тогда удаляет журнал
+        self.journal.snapshot()
+        self.assertEqual(self.saved_points(), 5)
+        self.assertFalse(os.path.exists(self.journal.rotated_path))
+
+    def test_successful_snapshot_drops_journal(self):
+        rating.get_chat_ledger(CHAT_ID).set_points(7, 3, "user7")
+        self.journal.snapshot()
+        self.assertEqual(self.saved_points(), 3)
+        self.assertFalse(os.path.exists(self.journal.rotated_path))
+
+if __name__ == '__main__':
+    unittest.main()
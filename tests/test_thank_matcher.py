@@ -0,0 +1,64 @@
+#────────────────────────────── ❑ ──────────────────────────────
+# Проверки ThankMatcher: совпадения как у поиска по нормализованному тексту
+# Запуск из корня репозитория: python -m unittest discover tests
+#────────────────────────────── ❑ ──────────────────────────────
+import os
+import io
+import re
+import sys
+import random
+import unittest
+import contextlib
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)  # rating.py читает token.txt, lang.txt и translations.json из текущей папки
+
+with contextlib.redirect_stdout(io.StringIO()):
+    import rating
+
+WORDS = ["спасибо", "спс", "от души", "мерси", "thanks", "благодарю", "ссс"]
+
+def reference(text, word_boundary):
+    """Медленный эталон: нормализуем сам текст и ищем каждое слово отдельно"""
+    text = rating.normalize_thank_word(text)
+    for word in {rating.normalize_thank_word(word) for word in WORDS}:
+        pattern = rf"(?<!\w){re.escape(word)}(?!\w)" if word_boundary else re.escape(word)
+        if re.search(pattern, text):
+            return True
+    return False
+
+class ThankMatcherTest(unittest.TestCase):
+    CASES = [
+        "спасибо", "Спасибо!", "СПАСИИИИБО", "спс", "от души", "от  души", "мерси", "Thanks a lot",
+        # Первая буква повторена
+        "сспасибо", "ссспасибо!", "ну сспс", "ммерси", "оот души", "tthanks", "ббблагодарю",
+        # Слово внутри другого слова
+        "спасибочки", "всспасибо", "неспс", "спсс", "спсибо", "мерсиии", "ссср", "сс",
+        "", "просто сообщение",
+    ]
+
+    def check(self, texts):
+        for word_boundary in (False, True):
+            matcher = rating.ThankMatcher(WORDS, word_boundary=word_boundary)
+            for text in texts:
+                with self.subTest(text=text, word_boundary=word_boundary):
+                    self.assertEqual(matcher.matches(text), reference(text, word_boundary))
+
+    def test_cases(self):
+        self.check(self.CASES)
+
+    def test_doubled_first_letter_whole_word(self):
+        matcher = rating.ThankMatcher(WORDS, word_boundary=True)
+        for text in ("сспасибо", "Ссспс", "ммерси!", "tthanks", "оот души"):
+            with self.subTest(text=text):
+                self.assertTrue(matcher.matches(text))
+        self.assertFalse(matcher.matches("всспасибо"))
+
+    def test_random_texts(self):
+        rnd = random.Random(7)
+        alphabet = "спасибоотдушимерthanks ,!"
+        self.check(["".join(rnd.choice(alphabet) for _ in range(rnd.randint(1, 12))) for _ in range(3000)])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,323 @@
+#────────────────────────────── ❑ ──────────────────────────────
+# Локальный заменитель Telegram Bot API (aiohttp) для нагрузочных тестов и проверки отказов
+# Запуск сервера:  python tools/fake_bot_api.py --port 8081 --feed 50 --latency 40 --error-rate 0.01 --flood-rate 0.02
+# Запуск бота:     python rating.py --api-base http://127.0.0.1:8081
+# Статистика:      http://127.0.0.1:8081/stats (также печатается при остановке)
+#────────────────────────────── ❑ ──────────────────────────────
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+from collections import Counter, defaultdict, deque
+
+from aiohttp import web
+
+from webhook_harness import make_message_update
+
+OWNER_ID = 1  # создатель всех тестовых чатов
+BOT_USER = {"id": 999000999, "is_bot": True, "first_name": "rating", "username": "rating_test_bot"}
+
+def ok(result):
+    return web.json_response({"ok": True, "result": result})
+
+def fail(status, description, **parameters):
+    body = {"ok": False, "error_code": status, "description": description}
+    if parameters:
+        body["parameters"] = parameters
+    return web.json_response(body, status=status)
+
+class FakeChat:
+    """Состояние одной группы: участники, администраторы и отправленные сообщения"""
+
+    def __init__(self, chat_id):
+        self.chat_id = chat_id
+        self.admins = {OWNER_ID: {"status": "creator"}}  # user_id -> {"status", "custom_title"}
+        self.messages = {}  # message_id -> текст
+        self.next_message_id = 1
+        self.sent = deque()  # время последних сообщений бота - для лимита сообщений в минуту
+
+    def chat(self):
+        return {"id": self.chat_id, "type": "supergroup", "title": f"Чат {self.chat_id}"}
+
+    def member(self, user_id):
+        info = self.admins.get(user_id, {"status": "member"})
+        result = {"user": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}",
+                           "username": f"user{user_id}"}, "status": info["status"]}
+        if info["status"] == "administrator":
+            result.update(can_be_edited=True, custom_title=info.get("custom_title"), can_manage_chat=True,
+                          can_delete_messages=False, can_manage_video_chats=False, can_restrict_members=False,
+                          can_promote_members=False, can_change_info=False, can_invite_users=True,
+                          can_pin_messages=False, is_anonymous=False)
+        elif info["status"] == "creator":
+            result.update(is_anonymous=False)
+        return result
+
+    def add_message(self, text):
+        message_id = self.next_message_id
+        self.next_message_id += 1
+        self.messages[message_id] = text
+        return {"message_id": message_id, "date": int(time.time()), "chat": self.chat(), "from": BOT_USER,
+                "text": text}
+
+class FakeBotApi:
+    """Методы Bot API, которые использует rating.py, с настраиваемыми задержкой, ошибками и 429"""
+
+    def __init__(self, args):
+        self.args = args
+        self.rnd = random.Random(args.seed)
+        self.chats = {}
+        self.updates = deque()
+        self.next_update_id = 1
+        self.webhook_url = ""
+        self.new_updates = asyncio.Event()
+        self.calls = Counter()  # (метод, статус) -> количество
+        self.latencies = defaultdict(list)
+        self.started = time.monotonic()
+        self.methods = {
+            "getMe": self.get_me,
+            "getUpdates": self.get_updates,
+            "getWebhookInfo": self.get_webhook_info,
+            "deleteWebhook": self.delete_webhook,
+            "setWebhook": self.set_webhook,
+            "sendMessage": self.send_message,
+            "editMessageText": self.edit_message_text,
+            "deleteMessage": self.delete_message,
+            "deleteMessages": self.delete_messages,
+            "getChatMember": self.get_chat_member,
+            "getChatAdministrators": self.get_chat_administrators,
+            "promoteChatMember": self.promote_chat_member,
+            "setChatAdministratorCustomTitle": self.set_custom_title,
+        }
+
+    def chat(self, chat_id):
+        chat_id = int(chat_id)
+        if chat_id not in self.chats:
+            self.chats[chat_id] = FakeChat(chat_id)
+        return self.chats[chat_id]
+
+    # ──────────────── HTTP ────────────────
+    async def handle(self, request):
+        method = request.match_info["method"]
+        handler = self.methods.get(method)
+        if handler is None:
+            return self.count(method, fail(404, "Not Found: method not found"))
+
+        if request.content_type == "application/json":
+            data = await request.json()
+        else:
+            data = dict(await request.post())
+
+        # getUpdates ждёт сам (long polling) - искусственная задержка и сбои только для остальных методов
+        if method != "getUpdates":
+            if self.args.latency:
+                delay = self.rnd.gauss(self.args.latency, self.args.jitter) / 1000
+                await asyncio.sleep(max(0, delay))
+            if self.rnd.random() < self.args.flood_rate:
+                return self.count(method, fail(429, f"Too Many Requests: retry after {self.args.retry_after}",
+                                               retry_after=self.args.retry_after))
+            if self.rnd.random() < self.args.error_rate:
+                return self.count(method, fail(500, "Internal Server Error"))
+
+        started = time.perf_counter()
+        try:
+            response = await handler(data)
+        except (KeyError, ValueError) as e:
+            response = fail(400, f"Bad Request: invalid parameters ({e})")
+        self.latencies[method].append(time.perf_counter() - started)
+        return self.count(method, response)
+
+    def count(self, method, response):
+        self.calls[(method, response.status)] += 1
+        return response
+
+    async def stats(self, request):
+        return web.json_response(self.summary())
+
+    def summary(self):
+        methods = defaultdict(dict)
+        for (method, status), count in sorted(self.calls.items()):
+            methods[method][str(status)] = count
+        return {
+            "uptime": round(time.monotonic() - self.started, 1),
+            "calls": sum(self.calls.values()),
+            "methods": methods,
+            "updates_pending": len(self.updates),
+            "chats": len(self.chats),
+        }
+
+    # ──────────────── Методы ────────────────
+    async def get_me(self, data):
+        return ok({**BOT_USER, "can_join_groups": True, "can_read_all_group_messages": True,
+                   "supports_inline_queries": False})
+
+    async def get_webhook_info(self, data):
+        return ok({"url": self.webhook_url, "has_custom_certificate": False, "pending_update_count": len(self.updates)})
+
+    async def set_webhook(self, data):
+        # Обновления сервер сам не отправляет: для webhook используйте tools/webhook_harness.py
+        self.webhook_url = data.get("url", "")
+        return ok(True)
+
+    async def delete_webhook(self, data):
+        self.webhook_url = ""
+        return ok(True)
+
+    async def get_updates(self, data):
+        if self.webhook_url:
+            return fail(409, "Conflict: can't use getUpdates method while webhook is active; use deleteWebhook to delete the webhook first")
+        offset = int(data.get("offset", 0))
+        limit = int(data.get("limit", 100))
+        timeout = min(int(data.get("timeout", 0)), 50)
+
+        if offset < 0:
+            # Как в Telegram: offset=-1 - только последнее обновление, остальные подтверждены
+            while len(self.updates) > -offset:
+                self.updates.popleft()
+        else:
+            while self.updates and self.updates[0]["update_id"] < offset:
+                self.updates.popleft()
+
+        if not self.updates and timeout:
+            self.new_updates.clear()
+            try:
+                await asyncio.wait_for(self.new_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return ok(list(self.updates)[:limit])
+
+    async def send_message(self, data):
+        chat = self.chat(data["chat_id"])
+        limit = self.args.group_limit if chat.chat_id < 0 else 0
+        if limit:
+            # Лимит сообщений в группу за минуту, как у настоящего Telegram
+            now = time.monotonic()
+            while chat.sent and chat.sent[0] <= now - 60:
+                chat.sent.popleft()
+            if len(chat.sent) >= limit:
+                retry_after = int(chat.sent[0] + 60 - now) + 1
+                return fail(429, f"Too Many Requests: retry after {retry_after}", retry_after=retry_after)
+            chat.sent.append(now)
+        return ok(chat.add_message(data["text"]))
+
+    async def edit_message_text(self, data):
+        chat = self.chat(data["chat_id"])
+        message_id = int(data["message_id"])
+        if message_id not in chat.messages:
+            return fail(400, "Bad Request: message to edit not found")
+        if chat.messages[message_id] == data["text"]:
+            return fail(400, "Bad Request: message is not modified")
+        chat.messages[message_id] = data["text"]
+        return ok({"message_id": message_id, "date": int(time.time()), "chat": chat.chat(), "from": BOT_USER,
+                   "text": data["text"], "edit_date": int(time.time())})
+
+    async def delete_message(self, data):
+        # Удалять можно и сообщения участников - их сервер не хранит
+        chat = self.chat(data["chat_id"])
+        chat.messages.pop(int(data["message_id"]), None)
+        return ok(True)
+
+    async def delete_messages(self, data):
+        chat = self.chat(data["chat_id"])
+        message_ids = data["message_ids"]
+        for message_id in json.loads(message_ids) if isinstance(message_ids, str) else message_ids:
+            chat.messages.pop(int(message_id), None)
+        return ok(True)
+
+    async def get_chat_member(self, data):
+        return ok(self.chat(data["chat_id"]).member(int(data["user_id"])))
+
+    async def get_chat_administrators(self, data):
+        chat = self.chat(data["chat_id"])
+        return ok([chat.member(user_id) for user_id in chat.admins])
+
+    async def promote_chat_member(self, data):
+        chat = self.chat(data["chat_id"])
+        user_id = int(data["user_id"])
+        if chat.admins.get(user_id, {}).get("status") == "creator":
+            return fail(400, "Bad Request: can't remove chat owner")
+        rights = [value for key, value in data.items() if key.startswith(("can_", "is_"))]
+        if any(str(value).lower() == "true" for value in rights):
+            chat.admins.setdefault(user_id, {"status": "administrator", "custom_title": None})
+        else:
+            chat.admins.pop(user_id, None)
+        return ok(True)
+
+    async def set_custom_title(self, data):
+        chat = self.chat(data["chat_id"])
+        admin = chat.admins.get(int(data["user_id"]))
+        if admin is None or admin["status"] != "administrator":
+            return fail(400, "Bad Request: user is not an administrator")
+        if len(data.get("custom_title", "")) > 16:
+            return fail(400, "Bad Request: ADMIN_RANK_INVALID")
+        admin["custom_title"] = data.get("custom_title")
+        return ok(True)
+
+    # ──────────────── Поток обновлений ────────────────
+    def push_update(self, update):
+        update["update_id"] = self.next_update_id
+        self.next_update_id += 1
+        self.updates.append(update)
+        self.new_updates.set()
+
+    async def feed(self):
+        """Генерирует обновления с частотой --feed в секунду: благодарности, команды и обычные сообщения"""
+        interval = 1 / self.args.feed
+        generated = 0
+        while not self.args.total or generated < self.args.total:
+            chat_id = -1001000000000 - self.rnd.randrange(self.args.chats)
+            user_id = 100 + self.rnd.randrange(self.args.users)
+            update_id = self.next_update_id
+            kind = self.rnd.random()
+            if kind < 0.5:
+                target = 100 + self.rnd.randrange(self.args.users)
+                update = make_message_update(update_id, chat_id, user_id, "спасибо!", target)
+            elif kind < 0.6:
+                update = make_message_update(update_id, chat_id, user_id, self.rnd.choice(["/my", "/top"]))
+            else:
+                update = make_message_update(update_id, chat_id, user_id, "обычное сообщение")
+            self.push_update(update)
+            generated += 1
+            await asyncio.sleep(interval)
+
+def create_app(api):
+    app = web.Application(client_max_size=10 * 1024 * 1024)
+    app.router.add_route("*", "/bot{token}/{method}", api.handle)
+    app.router.add_get("/stats", api.stats)
+
+    async def start_feed(app):
+        if api.args.feed:
+            app["feed"] = asyncio.create_task(api.feed())
+
+    async def stop_feed(app):
+        if "feed" in app:
+            app["feed"].cancel()
+        print(json.dumps(api.summary(), ensure_ascii=False, indent=2))
+
+    app.on_startup.append(start_feed)
+    app.on_cleanup.append(stop_feed)
+    return app
+
+def main():
+    parser = argparse.ArgumentParser(description="Локальный заменитель Telegram Bot API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0, help="средняя задержка ответа, мс")
+    parser.add_argument("--jitter", type=float, default=0, help="разброс задержки, мс")
+    parser.add_argument("--error-rate", type=float, default=0, help="доля ответов 500 (0..1)")
+    parser.add_argument("--flood-rate", type=float, default=0, help="доля ответов 429 (0..1)")
+    parser.add_argument("--retry-after", type=int, default=3, help="retry_after в ответах 429, с")
+    parser.add_argument("--group-limit", type=int, default=20, help="сообщений в минуту в группу (0 - без лимита)")
+    parser.add_argument("--feed", type=float, default=0, help="обновлений в секунду для getUpdates (0 - нет)")
+    parser.add_argument("--total", type=int, default=0, help="сколько обновлений сгенерировать (0 - без конца)")
+    parser.add_argument("--chats", type=int, default=5)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    print(f"🧪 Bot API: http://{args.host}:{args.port} (бот: python rating.py --api-base http://{args.host}:{args.port})")
+    web.run_app(create_app(FakeBotApi(args)), host=args.host, port=args.port, print=None)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,107 @@
+#────────────────────────────── ❑ ──────────────────────────────
+# Локальная проверка режима webhook: отправляет POST-запросы с обновлениями Telegram
+# Сначала запустите бота: python rating.py --webhook --secret test
+# Затем: python tools/webhook_harness.py --url http://127.0.0.1:8080/webhook --secret test --updates 500
+#────────────────────────────── ❑ ──────────────────────────────
+import sys
+import time
+import random
+import asyncio
+import argparse
+from collections import Counter
+
+import aiohttp
+
+def make_message_update(update_id, chat_id, user_id, text, reply_to_user_id=None):
+    """Обновление с сообщением в группе (при reply_to_user_id - ответом на сообщение)"""
+    chat = {"id": chat_id, "type": "supergroup", "title": f"Чат {chat_id}"}
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": chat,
+        "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}", "username": f"user{user_id}"},
+        "text": text,
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    if reply_to_user_id:
+        message["reply_to_message"] = {
+            "message_id": update_id - 1,
+            "date": int(time.time()),
+            "chat": chat,
+            "from": {"id": reply_to_user_id, "is_bot": False, "first_name": f"user{reply_to_user_id}",
+                     "username": f"user{reply_to_user_id}"},
+            "text": "вопрос",
+        }
+    return {"update_id": update_id, "message": message}
+
+def generate_updates(count, chats, users, seed=1):
+    """Смесь обычных сообщений, благодарностей и команд /my и /top"""
+    rnd = random.Random(seed)
+    updates = []
+    for update_id in range(1, count + 1):
+        chat_id = -1001000000000 - rnd.randrange(chats)
+        user_id = 100 + rnd.randrange(users)
+        kind = rnd.random()
+        if kind < 0.5:
+            target = 100 + rnd.randrange(users)
+            updates.append(make_message_update(update_id, chat_id, user_id, "спасибо!", target))
+        elif kind < 0.6:
+            updates.append(make_message_update(update_id, chat_id, user_id, rnd.choice(["/my", "/top"])))
+        else:
+            updates.append(make_message_update(update_id, chat_id, user_id, "обычное сообщение"))
+    return updates
+
+async def post_update(session, url, secret, update, statuses, latencies):
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret} if secret else {}
+    started = time.perf_counter()
+    try:
+        async with session.post(url, json=update, headers=headers) as response:
+            await response.read()
+            statuses[response.status] += 1
+    except aiohttp.ClientError as e:
+        statuses[type(e).__name__] += 1
+    latencies.append(time.perf_counter() - started)
+
+async def run(args):
+    updates = generate_updates(args.updates, args.chats, args.users)
+    statuses = Counter()
+    latencies = []
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async with aiohttp.ClientSession() as session:
+        # Запрос с неверным секретом должен быть отклонён
+        if args.secret:
+            wrong = Counter()
+            await post_update(session, args.url, args.secret + "-wrong", updates[0], wrong, [])
+            print(f"Неверный секрет: {dict(wrong)} ({'✅' if wrong.get(403) else '❌ ожидался 403'})")
+
+        async def limited(update):
+            async with semaphore:
+                await post_update(session, args.url, args.secret, update, statuses, latencies)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(limited(update) for update in updates))
+        elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    p50 = latencies[len(latencies) // 2] * 1000
+    p95 = latencies[int(len(latencies) * 0.95)] * 1000
+    print(f"Отправлено обновлений: {len(updates)} за {elapsed:.2f} с ({len(updates) / elapsed:.0f}/с)")
+    print(f"Ответы: {dict(statuses)}")
+    print(f"Задержка ответа: p50 {p50:.1f} мс, p95 {p95:.1f} мс")
+    return statuses.get(200, 0) == len(updates)
+
+def main():
+    parser = argparse.ArgumentParser(description="Отправка тестовых обновлений в webhook бота")
+    parser.add_argument("--url", default="http://127.0.0.1:8080/webhook")
+    parser.add_argument("--secret", default="")
+    parser.add_argument("--updates", type=int, default=200)
+    parser.add_argument("--chats", type=int, default=5)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=20)
+    ok = asyncio.run(run(parser.parse_args()))
+    sys.exit(0 if ok else 1)
+
+if __name__ == "__main__":
+    main()